@@ -0,0 +1,203 @@
+"""
+Local stand-in for the Telegram Bot API, used to benchmark the bot without a token or network access.
+
+Point the bot at it with TG_API_URL=http://127.0.0.1:<port>/bot{0}/{1}. The server serves getUpdates (long polling)
+from an in-memory queue, records sendMessage/sendDocument calls and can inject latency and 429 responses.
+"""
+
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Lock, Thread
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+
+
+class FakeBotAPI:
+    def __init__(self, port: int = 0, latency: float = 0.0, rate_limit_every: int = 0, retry_after: int = 1):
+        """
+        :param port: Port to bind to (0 picks a free port)
+        :param latency: Seconds added to every API call
+        :param rate_limit_every: Answer every Nth sendMessage with a 429 (0 disables)
+        :param retry_after: retry_after seconds reported in injected 429 responses
+        """
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+
+        self._updates: list[dict] = []
+        self._updates_changed = Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+
+        self._lock = Lock()
+        self.calls: dict[str, int] = {}
+        self.sent_messages: list[dict] = []
+        self.sent_documents: list[dict] = []
+        self.rate_limited = 0
+        self._send_message_count = 0
+        # {message_id: enqueue time} of injected updates and {message_id: reply time} of the bot's replies
+        self.enqueued_at: dict[int, float] = {}
+        self.replied_at: dict[int, float] = {}
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+        self._thread = Thread(target=self.httpd.serve_forever, name="FakeBotAPI", daemon=True)
+
+    @property
+    def api_url(self) -> str:
+        """Value for TG_API_URL / apihelper.API_URL"""
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/bot{{0}}/{{1}}"
+
+    def start(self) -> "FakeBotAPI":
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        with self._updates_changed:
+            self._updates_changed.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    """----- Test control -----"""
+    def push_message(self, user_id: int, text: str, username: Optional[str] = None) -> int:
+        """Queues a private text message update from the given user and returns its message_id"""
+        with self._updates_changed:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+            command_length = len(text.split(" ")[0]) if text.startswith('/') else 0
+            message = {"message_id": message_id, "date": int(time.time()),
+                       "chat": {"id": user_id, "type": "private"},
+                       "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}",
+                                "username": username or f"user{user_id}"},
+                       "text": text}
+            if command_length > 0:
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+            self._updates.append({"update_id": self._next_update_id, "message": message})
+            self._next_update_id += 1
+            self.enqueued_at[message_id] = time.perf_counter()
+            self._updates_changed.notify_all()
+        return message_id
+
+    def take_updates(self, count: int) -> list[dict]:
+        """Removes and returns up to `count` queued updates (for feeding process_new_updates directly)"""
+        with self._updates_changed:
+            updates, self._updates = self._updates[:count], self._updates[count:]
+        return updates
+
+    def wait_for_replies(self, message_ids: list[int], timeout: float) -> bool:
+        """Blocks until the bot replied to every given message (or the timeout expires)"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if all(message_id in self.replied_at for message_id in message_ids):
+                    return True
+            time.sleep(0.005)
+        return False
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.sent_messages.clear()
+            self.sent_documents.clear()
+            self.rate_limited = 0
+            self._send_message_count = 0
+
+    """----- Bot API -----"""
+    def _make_request_handler(self):
+        api = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+                elif content_type.startswith('application/json') and body:
+                    params.update(json.loads(body))
+
+                status, payload = api.handle(method, params, body_size=len(body))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    def _message(self, chat_id, **fields) -> dict:
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        return {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": int(chat_id), "type": "private"}, **fields}
+
+    @staticmethod
+    def _reply_to(params: dict) -> Optional[int]:
+        if params.get('reply_to_message_id'):
+            return int(params['reply_to_message_id'])
+        if params.get('reply_parameters'):
+            reply_parameters = params['reply_parameters']
+            if isinstance(reply_parameters, str):
+                reply_parameters = json.loads(reply_parameters)
+            return int(reply_parameters['message_id'])
+        return None
+
+    def handle(self, method: str, params: dict, body_size: int = 0) -> tuple[int, dict]:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'getMe':
+            return 200, {"ok": True, "result": BOT_USER}
+        if method == 'getUpdates':
+            return 200, {"ok": True, "result": self._get_updates(int(params.get('offset', 0) or 0),
+                                                                 float(params.get('timeout', 0) or 0),
+                                                                 int(params.get('limit', 100) or 100))}
+        if method == 'sendMessage':
+            with self._lock:
+                self._send_message_count += 1
+                if self.rate_limit_every and self._send_message_count % self.rate_limit_every == 0:
+                    self.rate_limited += 1
+                    return 429, {"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {self.retry_after}",
+                                 "parameters": {"retry_after": self.retry_after}}
+                self.sent_messages.append(params)
+                reply_to = self._reply_to(params)
+                if reply_to is not None:
+                    self.replied_at.setdefault(reply_to, time.perf_counter())
+            return 200, {"ok": True, "result": self._message(params.get('chat_id', 0), text=params.get('text', ''))}
+        if method == 'sendDocument':
+            with self._lock:
+                self.sent_documents.append({"chat_id": params.get('chat_id'), "size": body_size})
+                reply_to = self._reply_to(params)
+                if reply_to is not None:
+                    self.replied_at.setdefault(reply_to, time.perf_counter())
+            return 200, {"ok": True, "result": self._message(params.get('chat_id', 0))}
+        if method in ('setWebhook', 'deleteWebhook', 'close', 'logOut'):
+            return 200, {"ok": True, "result": True}
+        return 404, {"ok": False, "error_code": 404, "description": f"Not Found: method {method} not supported"}
+
+    def _get_updates(self, offset: int, timeout: float, limit: int) -> list[dict]:
+        deadline = time.monotonic() + timeout
+        with self._updates_changed:
+            # Updates below the offset are acknowledged by the bot
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while len(self._updates) == 0 and time.monotonic() < deadline:
+                self._updates_changed.wait(deadline - time.monotonic())
+            return self._updates[:limit]
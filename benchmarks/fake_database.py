@@ -0,0 +1,113 @@
+"""
+SQLite backed stand-in for the MySQL connection used by MySQLBackend, so database code paths can be benchmarked
+without a MySQL server.
+
+Pass FakeDatabase.connect as the `connect` callable of MySQLBackend (or SQLiteBackend, to count its statements). The
+MySQL specific bits the backend relies on (%s placeholders, DESCRIBE, SHOW TABLES, INSERT IGNORE, is_connected())
+are translated, and every statement and commit is counted as one round trip so benchmarks can report round trips per
+command.
+"""
+
+import re
+import sqlite3
+from threading import Lock
+
+_DESCRIBE = re.compile(r"^\s*DESCRIBE\s+(\w+)\s*$", re.IGNORECASE)
+_SHOW_TABLES = re.compile(r"^\s*SHOW\s+TABLES\s+LIKE\s+%s\s*$", re.IGNORECASE)
+_INSERT_IGNORE = re.compile(r"^\s*INSERT\s+IGNORE\s+", re.IGNORECASE)
+
+
+def _translate(operation: str) -> str:
+    return _INSERT_IGNORE.sub("INSERT OR IGNORE ", operation)
+
+
+class FakeCursor:
+    def __init__(self, database: "FakeDatabase", cursor: sqlite3.Cursor):
+        self._database = database
+        self._cursor = cursor
+
+    def execute(self, operation: str, params=()):
+        self._database.count_round_trip()
+        operation = _translate(operation)
+        match = _DESCRIBE.match(operation)
+        if match is not None:
+            # Field, Type, Null, Key, Default, Extra - like MySQL
+            operation = (f"SELECT name, type, CASE WHEN \"notnull\" THEN 'NO' ELSE 'YES' END, "
+                         f"CASE WHEN pk > 0 THEN 'PRI' ELSE '' END, dflt_value, '' "
+                         f"FROM pragma_table_info('{match.group(1)}')")
+        elif _SHOW_TABLES.match(operation):
+            operation = "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE %s"
+        self._cursor.execute(operation.replace("%s", "?"), tuple(params or ()))
+        return self
+
+    def executemany(self, operation: str, seq_params):
+        self._database.count_round_trip()
+        self._cursor.executemany(_translate(operation).replace("%s", "?"), [tuple(params) for params in seq_params])
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+class FakeConnection:
+    def __init__(self, database: "FakeDatabase"):
+        self._database = database
+        # Pooled connections are handed between handler threads, so the thread check is disabled
+        self._conn = sqlite3.connect(database.path, timeout=30, check_same_thread=False)
+        self._closed = False
+
+    def cursor(self, **kwargs) -> FakeCursor:
+        return FakeCursor(self._database, self._conn.cursor())
+
+    def commit(self):
+        self._database.count_round_trip()
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def is_connected(self) -> bool:
+        return not self._closed
+
+    def close(self):
+        self._closed = True
+        self._conn.close()
+
+
+class FakeDatabase:
+    """SQLite database file shared by every FakeConnection, with a round trip counter"""
+
+    def __init__(self, path: str):
+        """:param path: SQLite database file (created if missing)"""
+        self.path = path
+        self.round_trips = 0
+        self.connections = 0
+        self._lock = Lock()
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+
+    def connect(self) -> FakeConnection:
+        with self._lock:
+            self.connections += 1
+        return FakeConnection(self)
+
+    def count_round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+
+    def reset_counters(self):
+        with self._lock:
+            self.round_trips = 0
@@ -0,0 +1,77 @@
+"""
+Replays recorded Telegram updates against a running webhook receiver and reports throughput and latency.
+
+Usage:
+    python benchmarks/replay_webhook.py updates.jsonl --url http://localhost:8443/ --secret <token> --concurrency 16
+
+The updates file holds one Update JSON object per line (e.g. recorded from getUpdates results).
+"""
+
+import argparse
+import json
+import time
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def load_updates(path: str, repeat: int) -> list[bytes]:
+    with open(path, 'r') as infile:
+        updates = [json.loads(line) for line in infile if line.strip()]
+    bodies = []
+    for i in range(repeat):
+        for update in updates:
+            # Unique update IDs so the bot does not treat repeats as duplicates
+            update = dict(update, update_id=update.get('update_id', 0) + i * len(updates))
+            bodies.append(json.dumps(update).encode())
+    return bodies
+
+
+def post_update(url: str, secret: str, body: bytes) -> tuple[int, float]:
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as exc:
+        status = exc.code
+    return status, time.perf_counter() - started
+
+
+def replay(url: str, secret: str, bodies: list[bytes], concurrency: int) -> dict:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda body: post_update(url, secret, body), bodies))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency * 1000 for status, latency in results]
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {"updates": len(bodies), "elapsed_s": round(elapsed, 3),
+            "updates_per_s": round(len(bodies) / elapsed, 1) if elapsed > 0 else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 2), "p99_ms": round(percentile(latencies, 99), 2),
+            "statuses": statuses}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('updates', help='File with one recorded Update JSON object per line')
+    parser.add_argument('--url', default='http://localhost:8443/', help='Webhook receiver URL')
+    parser.add_argument('--secret', default='', help='Webhook secret token')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent POST requests')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay the file')
+    args = parser.parse_args()
+
+    print(json.dumps(replay(args.url, args.secret, load_updates(args.updates, args.repeat), args.concurrency),
+                     indent=2))
@@ -0,0 +1,242 @@
+"""
+Offline benchmarks for TelebotTemplate - no bot token or MySQL server required.
+
+The bot polls a local fake Bot API (fake_bot_api.py) and stores users in a SQLite file behind either storage backend
+(--backend mysql runs the MySQL backend's queries against the stand-in in fake_database.py, --backend sqlite runs the
+embedded SQLite backend); statements are counted through fake_database.py in both cases.
+Each scenario reports updates/sec, p99 latency (update queued -> reply received), DB round trips per command and
+Bot API calls per command.
+
+Usage:
+    python benchmarks/run_benchmarks.py --save-baseline baseline.json
+    python benchmarks/run_benchmarks.py --baseline baseline.json --tolerance 10
+    python benchmarks/run_benchmarks.py --scenarios setconfig alert_users --rate-limit-every 50
+    python benchmarks/run_benchmarks.py --backend sqlite
+    python benchmarks/run_benchmarks.py --workers 2 --latency 0.05
+
+When comparing against a baseline the script exits with status 1 if any metric regressed by more than the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+from threading import Thread
+
+from fake_bot_api import FakeBotAPI
+from fake_database import FakeDatabase
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+FIRST_ADMIN_ID = 1
+FIRST_USER_ID = 100
+SCENARIOS = ("viewconfig", "setconfig", "whitelist", "alert_users")
+
+# Whether a higher value of the metric is better (used when diffing against a baseline)
+HIGHER_IS_BETTER = {"updates_per_s": True, "p99_ms": False, "db_round_trips_per_command": False,
+                    "api_calls_per_command": False}
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if len(samples) == 0:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def admin_ids(workers: int) -> list[int]:
+    """:return: One administrator per handler shard, so admin commands can be spread over all shards"""
+    return [FIRST_ADMIN_ID + i for i in range(workers)]
+
+
+def configure_environment(api: FakeBotAPI, work_dir: str, backend: str, workers: int):
+    """Points the bot configuration at the fake services (must run before the bot package is imported)"""
+    admin_file = join(work_dir, 'administrators.json')
+    with open(admin_file, 'w') as outfile:
+        json.dump({"administrators": [str(admin_id) for admin_id in admin_ids(workers)]}, outfile)
+
+    os.environ.update({"TG_BOT_TOKEN": "123456:BENCHMARK", "TG_API_URL": api.api_url, "TG_BOT_MODE": "polling",
+                       "TG_EXECUTION_ENGINE": "sync", "TG_METRICS_PORT": "0", "TG_ADMINISTRATORS_FILE": admin_file,
+                       "DB_BACKEND": backend, "MYSQL_DB_PASSWORD": "benchmark", "MYSQL_DB_HOST_IP": "localhost",
+                       "DB_NAME": "benchmark", "TG_HANDLER_WORKERS": str(workers),
+                       "TG_UPDATE_OFFSET_FILE": join(work_dir, 'update_offset.json')})
+
+
+class BenchmarkRunner:
+    def __init__(self, api: FakeBotAPI, database: FakeDatabase, backend: str, users: int, workers: int,
+                 timeout: float):
+        from bot.telegram_bot import TelebotTemplate
+        from bot.mysql_database.database_handler import DatabaseHandler
+        from bot.mysql_database.storage_backends import MySQLBackend, SQLiteBackend
+
+        self.api = api
+        self.database = database
+        self.timeout = timeout
+        self.user_ids = [FIRST_USER_ID + i for i in range(users)]
+        self.admin_ids = admin_ids(workers)
+        self._next_new_user_id = 10_000_000
+
+        if backend == "sqlite":
+            storage = SQLiteBackend(database.path, connect=database.connect)
+        else:
+            storage = MySQLBackend(connect=database.connect)
+        # The user table is created by the startup migration
+        db_client = DatabaseHandler(backend=storage)
+        for user_id in self.user_ids:
+            db_client.whitelist_user(str(user_id))
+
+        self.bot = TelebotTemplate(db_client=db_client)
+        self._polling = Thread(target=self.bot.polling, kwargs={"non_stop": True, "interval": 0, "timeout": 1},
+                               name="BenchmarkPolling", daemon=True)
+        self._polling.start()
+
+    def stop(self):
+        self.bot.stop_polling()
+        self._polling.join(timeout=5)
+        self.bot.db_client.close()
+
+    def _reset(self):
+        self.database.reset_counters()
+        self.api.reset_counters()
+
+    def _result(self, commands: int, elapsed: float, latencies: list[float]) -> dict:
+        api_calls = sum(calls for method, calls in self.api.calls.items() if method != 'getUpdates')
+        return {"commands": commands, "elapsed_s": round(elapsed, 3),
+                "updates_per_s": round(commands / elapsed, 1) if elapsed > 0 else 0.0,
+                "p50_ms": round(percentile(latencies, 50), 2), "p99_ms": round(percentile(latencies, 99), 2),
+                "db_round_trips_per_command": round(self.database.round_trips / commands, 2),
+                "api_calls_per_command": round(api_calls / commands, 2)}
+
+    def run_commands(self, messages: list[tuple[int, str]]) -> dict:
+        """
+        Queues the (user_id, text) messages on the fake API and waits until the bot replied to each of them.
+        Fails if any message was rejected by a full handler queue - its "busy" reply is not a handled command.
+        """
+        self._reset()
+        dropped = self.bot.dispatcher.stats()["dropped"]
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        message_ids = [self.api.push_message(user_id, text) for user_id, text in messages]
+        while True:
+            # Rejected commands are not all answered - look for them while waiting instead of running into the timeout
+            answered = self.api.wait_for_replies(message_ids, max(0.0, min(1.0, deadline - time.monotonic())))
+            rejected = self.bot.dispatcher.stats()["dropped"] - dropped
+            if rejected > 0:
+                raise RuntimeError(f"{rejected}/{len(message_ids)} commands were rejected by a full handler queue - "
+                                   f"send fewer commands or raise TG_HANDLER_QUEUE_SIZE")
+            if answered:
+                break
+            if time.monotonic() >= deadline:
+                missing = sum(1 for message_id in message_ids if message_id not in self.api.replied_at)
+                if missing == 0:
+                    break
+                raise TimeoutError(f"{missing}/{len(message_ids)} commands were not answered within {self.timeout}s")
+
+        elapsed = max(self.api.replied_at[message_id] for message_id in message_ids) - started
+        latencies = [(self.api.replied_at[message_id] - self.api.enqueued_at[message_id]) * 1000
+                     for message_id in message_ids]
+        return self._result(len(message_ids), elapsed, latencies)
+
+    """----- Scenarios -----"""
+    def viewconfig(self, commands: int) -> dict:
+        return self.run_commands([(self.user_ids[i % len(self.user_ids)], "/viewconfig") for i in range(commands)])
+
+    def setconfig(self, commands: int) -> dict:
+        # Every settable column of the default schema, changed in one message
+        pairs = ("contract_type=future loop_count=5000 max_qty=3 target_price_interval_add=0.02 "
+                 "result_price_interval_start=-0.3 result_price_interval_add=0.02 result_price_interval_end=0.3 "
+                 "strike_percentage=0.1 zip_output=true option_data_source=cex")
+        return self.run_commands([(self.user_ids[i % len(self.user_ids)], f"/setconfig {pairs}")
+                                  for i in range(commands)])
+
+    def whitelist(self, commands: int, batch: int = 25) -> dict:
+        # Sent by one administrator per shard - the commands of a single sender queue up on one shard
+        messages = []
+        for command in range(commands):
+            new_users = [str(self._next_new_user_id + i) for i in range(batch)]
+            self._next_new_user_id += batch
+            messages.append((self.admin_ids[command % len(self.admin_ids)], f"/whitelist {','.join(new_users)}"))
+        return self.run_commands(messages)
+
+    def alert_users(self, commands: int) -> dict:
+        # One broadcast to every whitelisted user - per command figures are per delivered message
+        self._reset()
+        report = self.bot.alert_users("Benchmark alert")
+        result = self._result(max(report.total, 1), report.duration, [])
+        result.update({"p50_ms": None, "p99_ms": None, "delivered": report.sent, "failed": report.failed,
+                       "retried": report.retried, "rate_limited": self.api.rate_limited})
+        return result
+
+
+def diff_against_baseline(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Prints the relative change of every metric and returns whether any regressed by more than tolerance (%)"""
+    regressed = False
+    print(f"\n{'scenario':<14}{'metric':<30}{'baseline':>12}{'current':>12}{'change':>10}")
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            continue
+        for metric, higher_is_better in HIGHER_IS_BETTER.items():
+            before, after = baseline[scenario].get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before != 0 else (0.0 if after == 0 else float('inf'))
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressed = True
+            print(f"{scenario:<14}{metric:<30}{before:>12}{after:>12}{change:>+9.1f}%{flag}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--backend', choices=('mysql', 'sqlite'), default='mysql', help='Storage backend to run')
+    parser.add_argument('--workers', type=int, default=8, help='Handler worker threads (TG_HANDLER_WORKERS)')
+    parser.add_argument('--commands', type=int, default=200, help='Commands sent per scenario')
+    parser.add_argument('--users', type=int, default=100, help='Whitelisted users (alert_users fan-out size)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every fake Bot API call')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='Answer every Nth sendMessage with a 429')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for a scenario to finish')
+    parser.add_argument('--save-baseline', metavar='PATH', help='Write the results to PATH')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare the results against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=10, help='Allowed regression (%%) against the baseline')
+    parser.add_argument('--verbose', action='store_true', help='Keep the bot console logging')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bot-benchmark-')
+    api = FakeBotAPI(latency=args.latency, rate_limit_every=args.rate_limit_every).start()
+    configure_environment(api, work_dir, args.backend, args.workers)
+    database = FakeDatabase(join(work_dir, 'benchmark.sqlite3'))
+
+    if not args.verbose:
+        from bot._logger import stream_handler
+        stream_handler.setLevel(logging.ERROR)
+
+    runner = BenchmarkRunner(api, database, args.backend, users=args.users, workers=args.workers,
+                             timeout=args.timeout)
+    results = {}
+    try:
+        for scenario in args.scenarios:
+            results[scenario] = getattr(runner, scenario)(args.commands)
+            print(f"{scenario}: {json.dumps(results[scenario])}")
+    finally:
+        runner.stop()
+        api.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            if diff_against_baseline(results, json.load(infile), args.tolerance):
+                sys.exit(1)
@@ -1,16 +1,106 @@
+import atexit
+import copy
+import gzip
+import json
 import logging
+import os
+import queue
+import shutil
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from threading import Lock
 
 from .io_handler import get_logfile
 
-formatter = logging.Formatter('%(module)s : %(levelname)s : %(asctime)s : %(message)s')
+"""----- Logging Configuration -----"""
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json" (one JSON object per line)
+LOG_ROTATION = os.getenv("LOG_ROTATION", "size")  # "size" or "time"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))  # Size based rotation threshold
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")  # Time based rotation interval (TimedRotatingFileHandler)
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 10))  # Number of compressed archives kept
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))  # Records waiting for the writer thread before dropping
+
+assert LOG_FORMAT in ("text", "json")
+assert LOG_ROTATION in ("size", "time")
+
+# Extras attached to every record logged in the current context (set by metrics.timed while a handler runs)
+log_context: ContextVar[dict] = ContextVar("log_context", default={})
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as single JSON lines, including the handler/user_id/latency_ms extras when present (every record
+    logged while a handler runs carries handler and user_id, latency_ms is only set on slow call warnings)
+    """
+
+    EXTRA_FIELDS = ("handler", "user_id", "latency_ms")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record), "level": record.levelname, "module": record.module,
+                 "message": record.getMessage()}
+        for field in self.EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the calling thread - records are dropped (and counted) when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = Lock()
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge args into the message and render tracebacks up front (the listener may run after they change), but
+        # keep the traceback separate from the message so the listener's formatter decides how to lay it out
+        record = copy.copy(record)
+        for field, value in log_context.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+def _compress_rotated(source: str, dest: str):
+    # Runs on the listener thread, never on a handler thread
+    with open(source, 'rb') as infile, gzip.open(dest, 'wb') as outfile:
+        shutil.copyfileobj(infile, outfile)
+    os.remove(source)
+
+
+formatter = JsonFormatter() if LOG_FORMAT == "json" else \
+    logging.Formatter('%(module)s : %(levelname)s : %(asctime)s : %(message)s')
 
 # Get logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# Get logfile name & setup file handler
+# Get logfile name & setup rotating file handler (rotated logs are gzip compressed)
 logfile = get_logfile()
-file_handler = logging.FileHandler(logfile)
+if LOG_ROTATION == "time":
+    file_handler = TimedRotatingFileHandler(logfile, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+else:
+    file_handler = RotatingFileHandler(logfile, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+file_handler.namer = lambda name: name + '.gz'
+file_handler.rotator = _compress_rotated
 file_handler.setFormatter(formatter)
 file_handler.setLevel(logging.WARN)
 
@@ -19,6 +109,17 @@ stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
 stream_handler.setLevel(logging.INFO)
 
-# Add handlers
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Handlers only enqueue records - a background listener thread does the file and console I/O
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(log_queue)
+queue_handler.setLevel(logging.INFO)
+logger.addHandler(queue_handler)
+
+listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)  # Flushes queued records on shutdown
+
+
+def logging_stats() -> dict:
+    """:return: Current queue depth, queue capacity and number of dropped records of the logging pipeline"""
+    return {"queue_depth": log_queue.qsize(), "queue_size": LOG_QUEUE_SIZE, "dropped": queue_handler.dropped}
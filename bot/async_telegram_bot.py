@@ -0,0 +1,215 @@
+import asyncio
+import functools
+import os
+import time
+from os.path import basename
+from typing import Optional
+
+from .tg_config import *
+from ._logger import logger
+from .io_handler import get_administrators, administrator_registry
+from .mysql_database.async_database_handler import AsyncDatabaseHandler
+from .broadcast import AsyncBroadcaster, DeliveryReport
+from .commands import COMMANDS, Command
+from .steps import run_steps_async
+from . import handlers
+from .metrics import timed, MetricsServer
+from .startup_profile import startup_profiler
+from .restart import RestartRequested, Backoff, AlertCoalescer
+from .jobs import JobManager, Job, DONE as JOB_DONE
+from ._logger import logging_stats
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import User
+
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL
+
+
+class AsyncTelebotTemplate(AsyncTeleBot):
+    """
+    asyncio variant of TelebotTemplate - every update is handled as a task on one event loop, so the number of
+    in-flight updates is not capped by a thread pool. Commands are defined once for both bots (see commands.py).
+
+    Run with `asyncio.run(AsyncTelebotTemplate().run_bot())`.
+    """
+
+    def __init__(self):
+        super().__init__(token=TELEGRAM_BOT_TOKEN)
+
+        self.db_client: Optional[AsyncDatabaseHandler] = None
+        self._identity: Optional[User] = None
+        self.broadcaster = AsyncBroadcaster(self)
+        self.jobs = JobManager(self.deliver_job)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._restart_request: Optional[RestartRequested] = None
+
+        for command in COMMANDS:
+            self.register_command(command)
+
+    def message_handler(self, *args, **kwargs):
+        """Registers a message handler (see AsyncTeleBot.message_handler), recording its latency and errors"""
+        register = super().message_handler(*args, **kwargs)
+
+        def decorator(handler):
+            register(timed("handler", slow_threshold=SLOW_HANDLER_THRESHOLD)(handler))
+            return handler
+
+        return decorator
+
+    def register_command(self, command: Command):
+        """Registers a command (see commands.py) behind its guard, awaiting its Bot API and database calls"""
+
+        @functools.wraps(command.body)
+        async def handler(message):
+            return await run_steps_async(command.body(self, message))
+
+        self.message_handler(**command.filters)(getattr(self, command.guard)(handler))
+
+    def run_blocking(self, func, *args, **kwargs):
+        """Runs blocking work of a command (see commands.py) on a thread, off the event loop"""
+        return asyncio.to_thread(func, *args, **kwargs)
+
+    async def restart(self, message):
+        """Restarts polling in-process (the database pool, caches and pending handler tasks stay warm)"""
+        await self.reply_to(message, 'Bot restarting...')
+        # Handler exceptions do not reach polling() in AsyncTeleBot - stop it and let run_bot restart it
+        self._restart_request = RestartRequested(message.from_user.id)
+        self._polling = False
+
+    async def identity(self, refresh: bool = False) -> User:
+        """Async counterpart of TelebotTemplate.identity"""
+        if self._identity is None or refresh:
+            self._identity = await self.get_me()
+        return self._identity
+
+    def metrics_gauges(self) -> dict:
+        """:return: Point-in-time gauges exported next to the latency metrics"""
+        gauges = {}
+        if self.db_client is not None:
+            for name, value in self.db_client.whitelist_cache_stats().items():
+                gauges[f"bot_whitelist_cache_{name}"] = value
+            for name, value in self.db_client.user_config_cache_stats().items():
+                gauges[f"bot_user_config_cache_{name}"] = value
+            for name, value in self.db_client.pool_stats().items():
+                gauges[f"bot_db_pool_{name}"] = value
+        for name, value in logging_stats().items():
+            gauges[f"bot_log_{name}"] = value
+        for name, value in self.jobs.stats().items():
+            gauges[f"bot_jobs_{name}"] = value
+        return gauges
+
+    def user_is_whitelisted(self, func):
+        """(Decorator) Async counterpart of TelebotTemplate.user_is_whitelisted"""
+
+        @timed("auth", "user_is_whitelisted")
+        async def is_whitelisted(user_id: str) -> bool:
+            return await self.db_client.is_whitelisted(user_id)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kw):
+            message = args[0]
+            if await is_whitelisted(str(message.from_user.id)):
+                return await func(*args, **kw)
+            await self.reply_to(message, handlers.not_whitelisted_text(message))
+            return False
+
+        return wrapper
+
+    def user_is_administrator(self, func):
+        """(Decorator) Async counterpart of TelebotTemplate.user_is_administrator"""
+        is_administrator = timed("auth", "user_is_administrator")(administrator_registry.is_administrator)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kw):
+            message = args[0]
+            if is_administrator(message.from_user.id):
+                return await func(*args, **kw)
+            await self.reply_to(message, handlers.not_administrator_text(message))
+            return False
+
+        return wrapper
+
+    async def alert_users(self, message: str) -> DeliveryReport:
+        return await self.broadcaster.broadcast(await self.db_client.load_whitelist(), message)
+
+    async def alert_admins(self, message: str) -> DeliveryReport:
+        return await self.broadcaster.broadcast(get_administrators(), message)
+
+    def deliver_job(self, job: Job):
+        """
+        Sends the report of a finished job (or why it has none) to the chat it was started from. Called on a
+        JobManager delivery thread - blocks until the event loop sent it, as the report is removed afterwards.
+        """
+        asyncio.run_coroutine_threadsafe(self.send_job_result(job), self._loop).result()
+
+    async def send_job_result(self, job: Job):
+        """Async counterpart of TelebotTemplate.deliver_job"""
+        if job.state != JOB_DONE:
+            await self.send_message(job.chat_id, handlers.job_result_text(job))
+        elif os.path.getsize(job.result_path) > TELEGRAM_UPLOAD_LIMIT:
+            await self.send_message(job.chat_id, f'{handlers.job_result_text(job)}, but its report exceeds the '
+                                                 f'upload limit of {TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)} MB.')
+        else:
+            with open(job.result_path, 'rb') as report:
+                await self.send_document(job.chat_id, report, visible_file_name=basename(job.result_path),
+                                         caption=handlers.job_result_text(job))
+
+    async def run_bot(self):
+        if BOT_MODE != "polling":
+            logger.warning(f"{BOT_MODE} mode is not supported by the asyncio engine - falling back to polling")
+
+        with startup_profiler.phase("database"):
+            self.db_client = await AsyncDatabaseHandler.create()
+        if METRICS_PORT:
+            MetricsServer(METRICS_PORT, gauges=self.metrics_gauges).start()
+        with startup_profiler.phase("bot identity (getMe)"):
+            me = await self.identity()
+        logger.info(f'{me.first_name} initialized (asyncio)')
+        startup_profiler.report()
+
+        # Alerts and job reports are scheduled on this loop from the coalescer's timer and the job delivery threads
+        self._loop = loop = asyncio.get_running_loop()
+        crash_alerts = AlertCoalescer(lambda msg: asyncio.run_coroutine_threadsafe(self.alert_admins(msg), loop))
+        backoff = Backoff()
+        try:
+            while True:
+                started = time.monotonic()
+                logger.info("Bot started (asyncio)")
+                polling = asyncio.create_task(self.polling(non_stop=False))
+                try:
+                    # polling() returns instead of raising when it is cancelled, so it is shielded from the
+                    # cancellation of run_bot (Ctrl-C in asyncio.run) and cancelled explicitly below
+                    await asyncio.shield(polling)
+                except asyncio.CancelledError:
+                    logger.info("Bot stopping for keyboard interrupt...")
+                    polling.cancel()
+                    await asyncio.wait({polling})
+                    break
+                except Exception as exc:
+                    delay = backoff.next_delay(uptime=time.monotonic() - started)
+                    logger.exception(f'Bot has unexpectedly crashed - restarting in {delay:.1f} seconds:',
+                                     exc_info=exc)
+                    crash_alerts.alert(f'Bot has unexpectedly crashed - Error {exc}')
+                    await asyncio.sleep(delay)
+                    continue
+
+                if self._restart_request is not None:
+                    logger.info(f'{self._restart_request} - restarting')
+                    self._restart_request = None
+                    backoff.reset()
+                    continue
+                # polling(non_stop=False) returns (instead of raising) after a Bot API or network error
+                delay = backoff.next_delay(uptime=time.monotonic() - started)
+                err_msg = f'Bot stopped receiving updates - restarting in {delay:.1f} seconds...'
+                logger.error(err_msg)
+                crash_alerts.alert(err_msg)
+                await asyncio.sleep(delay)
+        finally:
+            # Job deliveries wait for this loop, so the job processes are stopped off it
+            await asyncio.to_thread(self.jobs.shutdown)
+            crash_alerts.flush()
+            await self.close_session()
+            await self.db_client.close()
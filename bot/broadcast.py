@@ -0,0 +1,227 @@
+"""Rate-limited, concurrent message fan-out used by TelebotTemplate.alert_users / alert_admins"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+
+from telebot.apihelper import ApiTelegramException
+from requests.exceptions import ConnectionError, ReadTimeout
+
+from .tg_config import (BROADCAST_WORKERS, BROADCAST_GLOBAL_RATE, BROADCAST_PER_CHAT_RATE,
+                        BROADCAST_GROUP_CHAT_RATE, BROADCAST_MAX_RETRIES)
+from ._logger import logger
+
+
+class TokenBucket:
+    """Thread-safe token bucket - acquire() blocks until a token is available"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: Tokens refilled per second
+        :param capacity: Maximum burst size (defaults to one second worth of tokens, minimum 1)
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _try_acquire(self) -> float:
+        """:return: 0 if a token was taken, otherwise the number of seconds to wait before trying again"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self._paused_until and self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return max(self._paused_until - now, (1 - self._tokens) / self.rate)
+
+    def acquire(self):
+        while (wait := self._try_acquire()) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while (wait := self._try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for the given number of seconds (e.g. after a 429 retry_after)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def is_idle(self) -> bool:
+        """:return: True if the bucket is full, i.e. it holds no rate limiting state worth keeping"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self.capacity and time.monotonic() >= self._paused_until
+
+
+@dataclass
+class DeliveryReport:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    errors: dict = field(default_factory=dict)  # {chat_id: error message} for failed deliveries
+    duration: float = 0.0  # In seconds
+
+    def summary(self) -> str:
+        rate = self.sent / self.duration if self.duration > 0 else 0.0
+        return (f"Delivered {self.sent}/{self.total} messages ({self.failed} failed, {self.retried} retried) "
+                f"in {self.duration:.2f}s ({rate:.1f} msg/s)")
+
+
+class Broadcaster:
+    """
+    Sends the same message to many chats using a bounded worker pool.
+
+    Throughput is capped by a global token bucket and a per-chat token bucket (Telegram allows roughly 30 messages
+    per second overall, 1 per second to the same private chat and 20 per minute to the same group). 429 responses
+    pause the global limiter for the returned retry_after before the message is retried.
+    """
+
+    # Per-chat buckets are pruned once this many are held, dropping those that are fully refilled
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, bot, workers: int = BROADCAST_WORKERS, global_rate: float = BROADCAST_GLOBAL_RATE,
+                 per_chat_rate: float = BROADCAST_PER_CHAT_RATE, group_chat_rate: float = BROADCAST_GROUP_CHAT_RATE,
+                 max_retries: int = BROADCAST_MAX_RETRIES):
+        """
+        :param bot: The TeleBot instance used to send messages
+        :param workers: Maximum number of concurrent send requests
+        :param global_rate: Messages per second across all chats
+        :param per_chat_rate: Messages per second to a single private chat
+        :param group_chat_rate: Messages per second to a single group chat (negative chat IDs)
+        :param max_retries: Retries per message after a 429, timeout or server error
+        """
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.max_retries = max_retries
+        self.global_limiter = TokenBucket(global_rate)
+        self._chat_limiters: dict[str, TokenBucket] = {}
+        self._chat_limiters_lock = Lock()
+
+    def _chat_limiter(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        with self._chat_limiters_lock:
+            limiter = self._chat_limiters.get(key)
+            if limiter is None:
+                if len(self._chat_limiters) >= self.MAX_CHAT_BUCKETS:
+                    self._chat_limiters = {k: v for k, v in self._chat_limiters.items() if not v.is_idle()}
+                rate = self.group_chat_rate if key.startswith('-') else self.per_chat_rate
+                limiter = self._chat_limiters[key] = TokenBucket(rate, capacity=1)
+            return limiter
+
+    def _should_retry(self, exc, retries: int) -> bool:
+        """Decides whether a failed Bot API call is retried, pausing the global limiter on 429s"""
+        if retries >= self.max_retries or (exc.error_code != 429 and exc.error_code < 500):
+            return False
+        if exc.error_code == 429:
+            retry_after = (exc.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            logger.warning(f"Broadcast rate limited by Telegram - pausing for {retry_after} seconds")
+            self.global_limiter.pause(retry_after)
+        return True
+
+    def _deliver(self, chat_id, text: str, send_kwargs: dict) -> tuple[bool, int, str]:
+        """:return: (delivered, retries, error message)"""
+        retries = 0
+        while True:
+            self._chat_limiter(chat_id).acquire()
+            self.global_limiter.acquire()
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, **send_kwargs)
+                return True, retries, ""
+            except ApiTelegramException as exc:
+                if not self._should_retry(exc, retries):
+                    return False, retries, exc.description
+            except (ConnectionError, ReadTimeout) as exc:
+                if retries >= self.max_retries:
+                    return False, retries, str(exc)
+            except Exception as exc:
+                return False, retries, str(exc)
+            retries += 1
+
+    def broadcast(self, chat_ids, text: str, **send_kwargs) -> DeliveryReport:
+        """
+        :param chat_ids: Recipients (duplicates are only sent to once)
+        :param text: Message text
+        :param send_kwargs: Extra keyword arguments passed on to send_message (e.g. parse_mode)
+        :return: Delivery report with sent/failed/retried counts and timing
+        """
+        chat_ids = list(dict.fromkeys(chat_ids))
+        report = DeliveryReport(total=len(chat_ids))
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(chat_ids)))) as executor:
+            futures = {chat_id: executor.submit(self._deliver, chat_id, text, send_kwargs) for chat_id in chat_ids}
+            for chat_id, future in futures.items():
+                delivered, retries, error = future.result()
+                report.retried += retries
+                if delivered:
+                    report.sent += 1
+                else:
+                    report.failed += 1
+                    report.errors[chat_id] = error
+
+        report.duration = time.perf_counter() - started
+        if report.failed > 0:
+            logger.warning(f"Broadcast: {report.summary()}")
+        return report
+
+
+class AsyncBroadcaster(Broadcaster):
+    """Broadcaster for AsyncTeleBot - concurrency is bounded by a semaphore instead of a thread pool"""
+
+    async def _deliver_async(self, semaphore: asyncio.Semaphore, chat_id, text: str,
+                             send_kwargs: dict) -> tuple[bool, int, str]:
+        # Imported here so the sync bot does not depend on aiohttp
+        from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException, RequestTimeout
+
+        retries = 0
+        async with semaphore:
+            while True:
+                await self._chat_limiter(chat_id).acquire_async()
+                await self.global_limiter.acquire_async()
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, **send_kwargs)
+                    return True, retries, ""
+                except AsyncApiTelegramException as exc:
+                    if not self._should_retry(exc, retries):
+                        return False, retries, exc.description
+                except (RequestTimeout, asyncio.TimeoutError) as exc:
+                    if retries >= self.max_retries:
+                        return False, retries, str(exc)
+                except Exception as exc:
+                    return False, retries, str(exc)
+                retries += 1
+
+    async def broadcast(self, chat_ids, text: str, **send_kwargs) -> DeliveryReport:
+        chat_ids = list(dict.fromkeys(chat_ids))
+        report = DeliveryReport(total=len(chat_ids))
+        started = time.perf_counter()
+
+        semaphore = asyncio.Semaphore(self.workers)
+        results = await asyncio.gather(*[self._deliver_async(semaphore, chat_id, text, send_kwargs)
+                                         for chat_id in chat_ids])
+        for chat_id, (delivered, retries, error) in zip(chat_ids, results):
+            report.retried += retries
+            if delivered:
+                report.sent += 1
+            else:
+                report.failed += 1
+                report.errors[chat_id] = error
+
+        report.duration = time.perf_counter() - started
+        if report.failed > 0:
+            logger.warning(f"Broadcast: {report.summary()}")
+        return report
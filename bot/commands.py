@@ -0,0 +1,246 @@
+"""
+Commands of the sync (TelebotTemplate) and async (AsyncTelebotTemplate) bots, each defined once.
+
+A command body is a generator taking (bot, message) that yields every Telegram/database call it makes (see steps.py):
+the sync bot runs the calls as they are made, the async bot awaits them. Both bots register COMMANDS with their own
+adapter (register_command) and guard decorator, and provide the calls the bodies use:
+
+- reply_to, send_document, get_file, download_file (the library's Bot API methods)
+- identity(), restart(message), metrics_gauges() and run_blocking(func, *args, **kwargs) for blocking work that is
+  not a Bot API or database call (moved to a thread by the async bot)
+- db_client (DatabaseHandler or AsyncDatabaseHandler) and jobs (JobManager, never awaited)
+"""
+
+from itertools import chain
+from os.path import basename
+from typing import Callable, Generator, NamedTuple
+
+from .tg_config import TELEGRAM_DOWNLOAD_LIMIT, TELEGRAM_UPLOAD_LIMIT
+from ._logger import logger
+from .io_handler import administrator_registry, get_logfile, find_log_offset, iter_log_records, iter_zip_parts
+from .metrics import registry as metrics_registry
+from . import handlers
+
+from telebot.util import smart_split
+
+# Guards - the name of the bot's decorator checking the sender before the command runs
+WHITELISTED_USERS = "user_is_whitelisted"
+ADMINISTRATORS = "user_is_administrator"
+
+
+class Command(NamedTuple):
+    guard: str
+    filters: dict  # Keyword arguments of message_handler, e.g. {"commands": ["help"]}
+    body: Callable[..., Generator]
+
+
+COMMANDS: list[Command] = []
+
+
+def command(guard: str, **filters):
+    """(Decorator) Adds a command body to COMMANDS"""
+
+    def decorator(body):
+        COMMANDS.append(Command(guard, filters, body))
+        return body
+
+    return decorator
+
+
+@command(WHITELISTED_USERS, commands=['help'])
+def on_help(bot, message):
+    yield bot.reply_to(message, handlers.help_text())
+
+
+@command(WHITELISTED_USERS, commands=['viewconfig'])
+def on_viewconfig(bot, message):
+    """Returns the current configuration of the bot (used as reference for /setconfig)"""
+    try:
+        config = yield bot.db_client.pull_user_config(user_id=message.from_user.id)
+        me = yield bot.identity()
+        yield bot.reply_to(message, handlers.viewconfig_text(message.from_user.username, me.first_name, config))
+    except Exception as exc:
+        logger.exception('Could not call /viewconfig', exc_info=exc)
+        yield bot.reply_to(message, str(exc))
+
+
+@command(WHITELISTED_USERS, commands=['setconfig'])
+def on_setconfig(bot, message):
+    """Used to change configuration variables of the bot"""
+    user_id = message.from_user.id
+    try:
+        # Validated against the cached column types (no database round trip once they are loaded)
+        yield bot.db_client.get_table_metadata()
+        changes, failed = handlers.parse_config_changes(message.text, bot.db_client.coerce_config_value)
+
+        if len(changes) > 0:
+            # Push all config updates to the database in a single transaction:
+            yield bot.db_client.update_user_configs(user_id=user_id, changes=changes)
+            for conf, val in changes.items():
+                logger.info(f"{user_id}: {conf} set to {val} ({type(val)})\n")
+
+        for reply in handlers.setconfig_replies(changes, failed):
+            yield bot.reply_to(message, reply)
+    except Exception as exc:
+        logger.exception('Could not set config', exc_info=exc)
+        yield bot.reply_to(message, str(exc))
+
+
+@command(WHITELISTED_USERS, commands=['runjob'])
+def on_runjob(bot, message):
+    """
+    Runs the job (see jobs.JobKind) with the user's configuration in the background.
+    Usage: /runjob [setting=new_value ...] (overrides for this job only)
+    """
+    user_id = message.from_user.id
+    try:
+        yield bot.db_client.get_table_metadata()
+        overrides, failed = handlers.parse_config_changes(message.text, bot.db_client.coerce_config_value)
+        if len(failed) > 0:
+            for reply in handlers.setconfig_replies({}, failed):
+                yield bot.reply_to(message, reply)
+            return
+        config = {**(yield bot.db_client.pull_user_config(user_id=user_id)), **overrides}
+        job = bot.jobs.submit(str(user_id), message.chat.id, config)
+        yield bot.reply_to(message, handlers.job_submitted_text(job))
+    except ValueError as exc:
+        yield bot.reply_to(message, str(exc))
+    except Exception as exc:
+        logger.exception('Could not start job', exc_info=exc)
+        yield bot.reply_to(message, str(exc))
+
+
+@command(WHITELISTED_USERS, commands=['jobstatus'])
+def on_jobstatus(bot, message):
+    """Lists the user's queued, running and recently finished jobs"""
+    yield bot.reply_to(message, handlers.jobs_status_text(bot.jobs.jobs(str(message.from_user.id))))
+
+
+@command(WHITELISTED_USERS, commands=['canceljob'])
+def on_canceljob(bot, message):
+    """Cancels a queued or running job of the user"""
+    try:
+        job = bot.jobs.cancel(str(message.from_user.id), handlers.parse_job_id(message.text))
+        yield bot.reply_to(message, f'Cancelling job {job.job_id}...')
+    except KeyError as exc:
+        yield bot.reply_to(message, exc.args[0])
+    except ValueError as exc:
+        yield bot.reply_to(message, str(exc))
+
+
+@command(ADMINISTRATORS, commands=['whitelist'])
+def on_whitelist(bot, message):
+    """Whitelists the given user IDs (or shows the whitelist if none are given)"""
+    try:
+        user_ids = handlers.parse_user_ids(message.text)
+        if len(user_ids) > 0:
+            yield from bulk_update_whitelist(bot, message, user_ids, blacklist=False)
+        else:
+            me = yield bot.identity()
+            whitelist = yield bot.db_client.load_whitelist()
+            for msg in smart_split(handlers.whitelist_text(me.full_name, whitelist)):
+                yield bot.reply_to(message, msg)
+    except Exception as exc:
+        yield bot.reply_to(message, str(exc))
+
+
+@command(ADMINISTRATORS, commands=['blacklist'])
+def on_blacklist(bot, message):
+    """Removes the given user IDs from the whitelist"""
+    try:
+        user_ids = handlers.parse_user_ids(message.text)
+        if len(user_ids) > 0:
+            yield from bulk_update_whitelist(bot, message, user_ids, blacklist=True)
+        else:
+            yield bot.reply_to(message, 'Usage: /blacklist USER_ID,USER_ID')
+    except Exception as exc:
+        yield bot.reply_to(message, str(exc))
+
+
+@command(ADMINISTRATORS, content_types=['document'],
+         func=lambda msg: handlers.caption_command(msg.caption) in ('whitelist', 'blacklist'))
+def on_user_ids_document(bot, message):
+    """Whitelists/blacklists the user IDs of a CSV document sent with /whitelist or /blacklist as caption"""
+    try:
+        if message.document.file_size and message.document.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+            yield bot.reply_to(message, f'The document exceeds the download limit of '
+                                        f'{TELEGRAM_DOWNLOAD_LIMIT // (1024 * 1024)} MB.')
+            return
+        file = yield bot.get_file(message.document.file_id)
+        data = yield bot.download_file(file.file_path)
+        yield from bulk_update_whitelist(bot, message, handlers.parse_user_ids_csv(data),
+                                         blacklist=handlers.caption_command(message.caption) == 'blacklist')
+    except Exception as exc:
+        logger.exception('Could not process the user ID document', exc_info=exc)
+        yield bot.reply_to(message, str(exc))
+
+
+@command(ADMINISTRATORS, commands=['restartbot'])
+def on_restartbot(bot, message):
+    """Restarts the bot (see restart)"""
+    yield bot.restart(message)
+
+
+@command(ADMINISTRATORS, commands=['reloadadmins'])
+def on_reloadadmins(bot, message):
+    """Reloads administrators.json without restarting the bot"""
+    try:
+        yield bot.reply_to(message, handlers.administrators_text(administrator_registry.reload()))
+    except Exception as exc:
+        logger.exception('Could not reload administrators', exc_info=exc)
+        yield bot.reply_to(message, f'Could not reload administrators (keeping the previous list): {exc}')
+
+
+@command(ADMINISTRATORS, commands=['stats'])
+def on_stats(bot, message):
+    """Shows handler/check/query latency percentiles and cache, pool and logging statistics"""
+    try:
+        for msg in smart_split(handlers.stats_text(metrics_registry.render_text(), bot.metrics_gauges())):
+            yield bot.reply_to(message, msg)
+    except Exception as exc:
+        logger.exception('Could not send stats', exc_info=exc)
+        yield bot.reply_to(message, str(exc))
+
+
+@command(ADMINISTRATORS, commands=['getlogs'])
+def on_getlogs(bot, message):
+    """
+    Sends the logfile as compressed zip part(s) below the upload limit.
+    Usage: /getlogs [last=N] [since=30m|2h|1d] [level=warning]
+    """
+    try:
+        options = handlers.parse_getlogs_options(message.text)
+    except ValueError as exc:
+        yield bot.reply_to(message, f'{exc}\nUsage: /getlogs [last=N] [since=30m|2h|1d] [level=warning]')
+        return
+
+    yield bot.reply_to(message, 'Fetching logfile...')
+    try:
+        logfile = get_logfile()
+        # Scanning and compressing the logfile is blocking file I/O
+        offset = yield bot.run_blocking(find_log_offset, logfile, **options)
+        records = iter_log_records(logfile, offset, options['level'])
+        # The level filter may drop every selected record - check before sending an empty archive
+        first_chunk = yield bot.run_blocking(next, records, None)
+        if first_chunk is None:
+            yield bot.reply_to(message, 'No matching log entries.')
+            return
+        parts = iter_zip_parts(chain([first_chunk], records), entry_name=basename(logfile), zip_name='logs.zip',
+                               max_part_size=TELEGRAM_UPLOAD_LIMIT)
+        while (item := (yield bot.run_blocking(next, parts, None))) is not None:
+            file_name, part = item
+            with part:
+                yield bot.send_document(message.chat.id, part, visible_file_name=file_name)
+    except Exception as exc:
+        logger.exception('Could not send logs', exc_info=exc)
+        yield bot.reply_to(message, str(exc))
+
+
+def bulk_update_whitelist(bot, message, user_ids: list[str], blacklist: bool):
+    """Whitelists (or blacklists) user_ids in one transaction and replies with the per user outcomes"""
+    if blacklist:
+        outcomes = yield bot.db_client.blacklist_users(user_ids)
+    else:
+        outcomes = yield bot.db_client.whitelist_users(user_ids)
+    logger.info(f"{'Blacklisted' if blacklist else 'Whitelisted'} {len(outcomes)} user IDs: {outcomes}")
+    yield bot.reply_to(message, handlers.bulk_outcomes_text(outcomes))
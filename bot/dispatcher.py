@@ -0,0 +1,225 @@
+"""Handler dispatch for TelebotTemplate - replaces pyTelegramBotAPI's shared, unbounded worker pool"""
+
+import itertools
+import queue
+import time
+from collections import OrderedDict
+from threading import Thread, Event, Lock, current_thread
+from typing import Callable, Optional
+
+from .tg_config import (HANDLER_WORKERS, HANDLER_QUEUE_SIZE, HANDLER_OVERLOAD_POLICY, HANDLER_OVERLOAD_REPLY_INTERVAL,
+                        HANDLER_OVERLOAD_REPLY_QUEUE_SIZE)
+from ._logger import logger
+
+
+class ShardedDispatcher:
+    """
+    Runs handler tasks on a fixed number of worker threads, each draining its own bounded queue.
+
+    Tasks are routed by the user an update came from (from_user.id, falling back to chat.id), so the updates of one
+    user run one at a time and in the order they were received - two /setconfig messages can no longer race on the
+    same row - while different users are handled in parallel. When the queue of a shard is full the update is not
+    queued: with the "reply" policy on_overload is called with it (TelebotTemplate asks the user to retry), with the
+    "drop" policy it is only counted. on_overload runs on a separate thread, so a burst of rejected updates never
+    blocks the caller (the polling thread), and at most once per user every overload_reply_interval seconds.
+
+    Implements the interface of telebot.util.ThreadPool (put, exception_event, raise_exceptions, clear_exceptions and
+    close), so it is installed as TeleBot.worker_pool and serves both polling and webhook dispatch. Like ThreadPool,
+    exceptions not handled by the bot's exception_handler are re-raised in the polling thread (see /restartbot).
+    """
+
+    def __init__(self, bot, workers: int = HANDLER_WORKERS, queue_size: int = HANDLER_QUEUE_SIZE,
+                 overload_policy: str = HANDLER_OVERLOAD_POLICY,
+                 on_overload: Optional[Callable[[object], None]] = None,
+                 on_task_done: Optional[Callable[[], None]] = None, key_stride: int = 1,
+                 overload_reply_interval: float = HANDLER_OVERLOAD_REPLY_INTERVAL,
+                 overload_reply_queue_size: int = HANDLER_OVERLOAD_REPLY_QUEUE_SIZE):
+        """
+        :param bot: The TeleBot instance whose exception_handler is consulted for failed tasks
+        :param workers: Number of shards (one worker thread each)
+        :param queue_size: Maximum number of queued tasks per shard
+        :param overload_policy: "reply" (call on_overload with the rejected update) or "drop"
+        :param on_overload: Callable(update) answering an update that was rejected because its shard is full
+        :param on_task_done: Callable() run by a worker after each task (e.g. to persist the handled update offset)
+        :param key_stride: Keys are divided by this before sharding - a worker process of the multiprocess engine only
+            receives keys with the same remainder modulo the number of processes, which key % workers would pile
+            onto a few shards whenever the two counts share a factor
+        :param overload_reply_interval: Seconds before on_overload is called again for updates of the same user
+        :param overload_reply_queue_size: Rejected updates waiting for on_overload (further ones are not answered)
+        """
+        self.bot = bot
+        self.overload_policy = overload_policy
+        self.on_overload = on_overload
+        self.on_task_done = on_task_done
+        self.key_stride = key_stride
+        self.queues: list[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processed = [0] * workers
+        self.dropped = [0] * workers
+        self.max_depth = [0] * workers  # High-water mark of each queue
+        self.overload_reply_interval = overload_reply_interval
+        self.overload_replies = 0
+        self.overload_replies_skipped = 0  # Rejected updates not answered (user answered recently, or queue full)
+        self._overload_replied: OrderedDict = OrderedDict()  # {key: monotonic time of the last answer}, oldest first
+        self._overload_queue: queue.Queue = queue.Queue(maxsize=overload_reply_queue_size)
+        self._counter_lock = Lock()
+        self._round_robin = itertools.count()
+        # Every queued task gets a sequence number - pending holds those of tasks that have not finished yet
+        self.sequence = 0
+        self._pending: set[int] = set()
+
+        self.exception_event = Event()
+        self.exception_info: Optional[BaseException] = None
+
+        self._running = True
+        self.workers = [Thread(target=self._work, args=(shard,), name=f"HandlerShard-{shard}", daemon=True)
+                        for shard in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        self._overload_replier = Thread(target=self._reply_overloaded, name="OverloadReplies", daemon=True)
+        self._overload_replier.start()
+
+    @staticmethod
+    def shard_key(update) -> Optional[int]:
+        """:return: The ID of the user (or chat) the update belongs to, None for updates without one"""
+        user = getattr(update, 'from_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, 'chat', None)
+        return chat.id if chat is not None else None
+
+    def shard(self, update) -> int:
+        key = self.shard_key(update)
+        if key is None:
+            # Not tied to a user (e.g. the list passed to update listeners) - spread over the shards
+            return next(self._round_robin) % len(self.queues)
+        return (key // self.key_stride) % len(self.queues)
+
+    def put(self, func: Callable, *args, **kwargs):
+        """Queues func(*args, **kwargs) on the shard of the update passed as its first argument"""
+        update = args[0] if len(args) > 0 else None
+        shard = self.shard(update)
+        tasks = self.queues[shard]
+        with self._counter_lock:
+            self.sequence += 1
+            sequence = self.sequence
+            self._pending.add(sequence)
+        try:
+            tasks.put_nowait((sequence, func, args, kwargs))
+        except queue.Full:
+            with self._counter_lock:
+                self._pending.discard(sequence)
+                self.dropped[shard] += 1
+            logger.warning(f"Handler shard {shard} is full ({tasks.maxsize} queued) - "
+                           f"{'rejecting' if self.overload_policy == 'reply' else 'dropping'} an update from "
+                           f"{self.shard_key(update)}")
+            if self.overload_policy == "reply" and self.on_overload is not None:
+                self._queue_overload_reply(update)
+            return
+
+        depth = tasks.qsize()
+        if depth > self.max_depth[shard]:
+            with self._counter_lock:
+                self.max_depth[shard] = max(self.max_depth[shard], depth)
+
+    def _queue_overload_reply(self, update):
+        """Hands a rejected update to the OverloadReplies thread, unless its user was answered recently"""
+        key = self.shard_key(update)
+        now = time.monotonic()
+        with self._counter_lock:
+            while len(self._overload_replied) > 0 and \
+                    next(iter(self._overload_replied.values())) <= now - self.overload_reply_interval:
+                self._overload_replied.popitem(last=False)
+            if key in self._overload_replied:
+                self.overload_replies_skipped += 1
+                return
+            self._overload_replied[key] = now
+        try:
+            self._overload_queue.put_nowait(update)
+        except queue.Full:
+            with self._counter_lock:
+                self._overload_replied.pop(key, None)
+                self.overload_replies_skipped += 1
+
+    def _reply_overloaded(self):
+        while self._running:
+            try:
+                update = self._overload_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.on_overload(update)
+            except Exception as exc:
+                logger.exception('Could not answer a rejected update', exc_info=exc)
+            with self._counter_lock:
+                self.overload_replies += 1
+
+    def _work(self, shard: int):
+        tasks = self.queues[shard]
+        while self._running:
+            try:
+                sequence, func, args, kwargs = tasks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                func(*args, **kwargs)
+            except Exception as exc:
+                self.on_exception(exc)
+            finally:
+                with self._counter_lock:
+                    self._pending.discard(sequence)
+                    self.processed[shard] += 1
+            if self.on_task_done is not None:
+                try:
+                    self.on_task_done()
+                except Exception as exc:
+                    logger.exception('Task completion callback failed', exc_info=exc)
+
+    def completed_watermark(self) -> int:
+        """:return: The highest sequence number up to which every queued task has finished (or was dropped)"""
+        with self._counter_lock:
+            return min(self._pending) - 1 if len(self._pending) > 0 else self.sequence
+
+    def drain(self, timeout: float) -> bool:
+        """Waits up to timeout seconds for the queued tasks to finish and returns whether they did"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._counter_lock:
+                if len(self._pending) == 0:
+                    return True
+            time.sleep(0.05)
+        with self._counter_lock:
+            return len(self._pending) == 0
+
+    def on_exception(self, exc: Exception):
+        handled = self.bot.exception_handler is not None and self.bot.exception_handler.handle(exc)
+        if not handled:
+            self.exception_info = exc
+            self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        """Stops the workers once their current task is done (queued tasks are discarded)"""
+        self._running = False
+        for worker in self.workers + [self._overload_replier]:
+            if worker is not current_thread():
+                worker.join()
+
+    def stats(self) -> dict:
+        """:return: Totals and per shard queue depth, high-water mark, processed and dropped counters"""
+        with self._counter_lock:
+            stats = {"workers": len(self.queues), "queue_depth": sum(tasks.qsize() for tasks in self.queues),
+                     "processed": sum(self.processed), "dropped": sum(self.dropped),
+                     "overload_replies": self.overload_replies,
+                     "overload_replies_skipped": self.overload_replies_skipped}
+            for shard, tasks in enumerate(self.queues):
+                stats.update({f"shard_{shard}_queue_depth": tasks.qsize(),
+                              f"shard_{shard}_max_queue_depth": self.max_depth[shard],
+                              f"shard_{shard}_processed": self.processed[shard],
+                              f"shard_{shard}_dropped": self.dropped[shard]})
+            return stats
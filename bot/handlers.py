@@ -0,0 +1,225 @@
+"""
+Parsing and reply formatting of the commands in commands.py (shared by the sync and async bots).
+
+These functions make no Telegram or database calls, so the command bodies can use them with either engine.
+"""
+
+import csv
+import io
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from .tg_config import EXTERNAL_DOCUMENTATION_LINK, DEVELOPER_CONTACT
+
+
+def split_message(message: str, convert_type=None) -> list:
+    """Returns the whitespace separated arguments following the command"""
+    chunks = [chunk.strip() for chunk in message.split(" ")[1:] if
+              not all(char == " " for char in chunk) and len(chunk) > 0]
+    if convert_type is None:
+        return chunks
+    return [convert_type(chunk) for chunk in chunks]
+
+
+def help_text() -> str:
+    return f'View the documentation for the bot here:\n{EXTERNAL_DOCUMENTATION_LINK}'
+
+
+def not_whitelisted_text(message) -> str:
+    return (f"{message.from_user.username} is not whitelisted.\n"
+            f"Please send your user ID ({message.from_user.id}) the developer: {DEVELOPER_CONTACT}")
+
+
+def not_administrator_text(message) -> str:
+    return f"{message.from_user.username} ({message.from_user.id}) is not an administrator."
+
+
+def overloaded_text() -> str:
+    return "The bot is busy right now - please try again in a moment."
+
+
+def viewconfig_text(username: str, bot_name: str, config: dict) -> str:
+    msg = f"{username} {bot_name} Configuration:\n\n"
+    for k, v in config.items():
+        msg += f'{k}={v}\n'
+    return msg
+
+
+def parse_config_changes(text: str, coerce: Callable) -> tuple[dict, list[tuple[str, str]]]:
+    """
+    Parses the key=value pairs of a /setconfig message.
+
+    :param text: Message text
+    :param coerce: Callable(config_name, raw_value) validating a single change (e.g. DatabaseHandler.coerce_config_value)
+    :return: ({config_name: coerced_value}, [(raw change, error message)])
+    """
+    changes = {}
+    failed = []
+    for change in split_message(text):
+        try:
+            conf, val = change.split('=')
+            changes[conf] = coerce(conf, val)
+        except Exception as exc:
+            failed.append((change, str(exc)))
+    return changes, failed
+
+
+def setconfig_replies(changes: dict, failed: list[tuple[str, str]]) -> list[str]:
+    """:return: The reply messages for the applied and failed /setconfig changes"""
+    replies = []
+    if len(changes) > 0:
+        replies.append("Successfully set configuration:\n\n" +
+                       "".join(f"{conf} set to {val}\n" for conf, val in changes.items()))
+    if len(failed) > 0:
+        replies.append("Failed to set:\n\n" + "".join(f"- {fail[0]} (Error: {fail[1]})\n" for fail in failed))
+    return replies
+
+
+def whitelist_text(bot_name: str, whitelist: list[str]) -> str:
+    msg = f"{bot_name} Whitelist:\n"
+    for user in whitelist:
+        msg += f"- {user}\n"
+    return msg
+
+
+_USER_ID_SEPARATORS = re.compile(r"[\s,;]+")
+
+
+def parse_user_ids(text: str) -> list[str]:
+    """Returns the user IDs following the command, separated by commas, semicolons and/or whitespace"""
+    return [user_id for user_id in _USER_ID_SEPARATORS.split(" ".join(split_message(text))) if len(user_id) > 0]
+
+
+def caption_command(caption: Optional[str]) -> Optional[str]:
+    """Returns the command a document caption starts with (e.g. "whitelist" for "/whitelist@MyBot ..."), if any"""
+    if not caption or not caption.startswith("/"):
+        return None
+    return caption.split()[0][1:].split("@")[0].lower()
+
+
+def parse_user_ids_csv(data: bytes) -> list[str]:
+    """
+    Parses the user IDs of an uploaded CSV document - the "user_id" column if the first row is a header naming it,
+    otherwise the first column of every row (a non-numeric first row is skipped as a header).
+    """
+    rows = [row for row in csv.reader(io.StringIO(data.decode("utf-8-sig"))) if len(row) > 0]
+    if len(rows) == 0:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    column = header.index("user_id") if "user_id" in header else 0
+    if "user_id" in header or not header[0].lstrip("-").isdigit():
+        rows = rows[1:]
+    return [row[column].strip() for row in rows if len(row) > column and len(row[column].strip()) > 0]
+
+
+def bulk_outcomes_text(outcomes: dict[str, str], max_listed: int = 50) -> str:
+    """
+    :param outcomes: {user_id: outcome} as returned by DatabaseHandler.whitelist_users/blacklist_users
+    :param max_listed: Maximum number of user IDs listed per outcome (keeps large uploads in one message)
+    """
+    if len(outcomes) == 0:
+        return "No user IDs given."
+    grouped = defaultdict(list)
+    for user_id, outcome in outcomes.items():
+        grouped[outcome].append(user_id)
+    msg = ""
+    for outcome, user_ids in grouped.items():
+        listed = ", ".join(user_ids[:max_listed])
+        more = f" (+{len(user_ids) - max_listed} more)" if len(user_ids) > max_listed else ""
+        msg += f"{outcome.capitalize()} ({len(user_ids)}): {listed}{more}\n"
+    return msg
+
+
+def administrators_text(administrators) -> str:
+    msg = f"Reloaded {len(administrators)} administrators:\n"
+    for admin in sorted(administrators):
+        msg += f"- {admin}\n"
+    return msg
+
+
+_TIME_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+
+
+def parse_getlogs_options(text: str) -> dict:
+    """
+    Parses the options of a /getlogs message, e.g. "/getlogs last=200 since=2h level=error".
+
+    :return: {"last": Optional[int], "since": Optional[datetime], "level": Optional[int]}
+    :raises ValueError: If an option is unknown or malformed
+    """
+    options = {"last": None, "since": None, "level": None}
+    for option in split_message(text):
+        try:
+            key, val = option.split('=')
+        except ValueError:
+            raise ValueError(f"Malformed option: {option} (expected key=value)")
+        key = key.lower()
+        if key == 'last':
+            options['last'] = int(val)
+            if options['last'] < 1:
+                raise ValueError("last must be a positive number of log entries")
+        elif key == 'since':
+            if len(val) < 2 or val[-1].lower() not in _TIME_UNITS or not val[:-1].isdigit():
+                raise ValueError(f"since expects a time window like 30m, 2h or 1d, got {val}")
+            options['since'] = datetime.now() - timedelta(**{_TIME_UNITS[val[-1].lower()]: int(val[:-1])})
+        elif key == 'level':
+            level = logging.getLevelName(val.upper())
+            if not isinstance(level, int):
+                raise ValueError(f"Unknown log level: {val}")
+            options['level'] = level
+        else:
+            raise ValueError(f"Unknown option: {key} (available: last, since, level)")
+    return options
+
+
+_SHARD_GAUGE = re.compile(r"^(\w+?)_shard_\d+_(\w+)$")
+
+
+def stats_text(metrics_text: str, gauges: dict) -> str:
+    msg = f"Latency (n=calls, err=raised):\n{metrics_text}\n\n"
+    # Per shard gauges (e.g. bot_dispatch_shard_3_processed) are summarized in one line per statistic
+    shards: dict[str, list] = defaultdict(list)
+    for name, value in gauges.items():
+        match = _SHARD_GAUGE.match(name)
+        if match is not None:
+            shards[f"{match.group(1)}_shard_{match.group(2)}"].append(value)
+        else:
+            msg += f"{name}={value}\n"
+    for name, values in shards.items():
+        msg += f"{name}: min={min(values)} max={max(values)} sum={sum(values)} ({len(values)} shards)\n"
+    return msg
+
+
+def parse_job_id(text: str) -> int:
+    """:return: The job ID following the command (raises ValueError if there is none)"""
+    args = split_message(text)
+    if len(args) != 1 or not args[0].isdigit():
+        raise ValueError("Usage: /canceljob JOB_ID (see /jobstatus)")
+    return int(args[0])
+
+
+def job_submitted_text(job) -> str:
+    return (f"Job {job.job_id} queued: {job.summary}.\n"
+            f"The report is sent here when it is done - check on it with /jobstatus or stop it with "
+            f"/canceljob {job.job_id}")
+
+
+def jobs_status_text(jobs: list) -> str:
+    if len(jobs) == 0:
+        return "You have no jobs - start one with /runjob"
+    msg = "Your jobs:\n\n"
+    for job in jobs:
+        msg += f"{job.job_id}: {job.state} ({job.duration:.0f}s)"
+        msg += f" - {job.error}\n" if job.error is not None else "\n"
+    return msg
+
+
+def job_result_text(job) -> str:
+    if job.state == "done":
+        return f"Job {job.job_id} finished in {job.duration:.1f}s"
+    if job.state == "failed":
+        return f"Job {job.job_id} failed: {job.error}"
+    return f"Job {job.job_id} was {job.state}."
@@ -1,9 +1,20 @@
 import json
-from os.path import isdir, join, basename, dirname, abspath
-from os import getcwd, mkdir, listdir
-from shutil import rmtree
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from os.path import isdir, join, basename, dirname, abspath, getsize
+from os import getcwd, mkdir, listdir, stat
+from shutil import rmtree, copyfileobj
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from typing import Iterable, Iterator, Optional, Union
 import zipfile
 
+# In-memory size of zip buffers before they spill over to an anonymous temporary file
+ZIP_SPOOL_SIZE = 8 * 1024 * 1024
+
 
 # import yaml
 
@@ -24,13 +35,24 @@ def clr_temp_dir(dir_path: str):
     rmtree(dir_path)
 
 
-def create_zip_archive(file_paths: list[str], output_path: str, zip_name: str = 'archive.zip') -> str:
+def create_zip_archive(file_paths: list[str], output_path: Optional[str],
+                       zip_name: str = 'archive.zip') -> Union[str, SpooledTemporaryFile]:
     """
     :param zip_name: Name of the zip archive
     :param file_paths: List of file paths to zip
-    :param output_path: Path to output the zip archive (could be the temp dir)
-    :return: The filepath of the zip archive
+    :param output_path: Path to output the zip archive (could be the temp dir).
+                        If None, the archive is streamed into a spooled in-memory buffer instead of a file on disk
+    :return: The filepath of the zip archive, or the rewound buffer holding the archive if output_path is None
     """
+    if output_path is None:
+        buffer = SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for file_path in file_paths:
+                with open(file_path, 'rb') as infile, zip_file.open(basename(file_path), 'w', force_zip64=True) as entry:
+                    copyfileobj(infile, entry)
+        buffer.seek(0)
+        return buffer
+
     zipfile_path = join(output_path, zip_name)
     with zipfile.ZipFile(zipfile_path, 'a') as zip_file:
         for file_path in file_paths:
@@ -38,6 +60,50 @@ def create_zip_archive(file_paths: list[str], output_path: str, zip_name: str =
     return zipfile_path
 
 
+def iter_zip_parts(chunks: Iterable[bytes], entry_name: str, max_part_size: int,
+                   zip_name: str = 'archive.zip') -> Iterator[tuple[str, SpooledTemporaryFile]]:
+    """
+    Compresses a stream of chunks into one or more zip archives, starting a new archive whenever the compressed size
+    approaches max_part_size. Each part is a standalone archive (entries are named <entry_name>.partN when split).
+
+    :param chunks: Byte chunks to compress (parts are only split between chunks)
+    :param entry_name: Name of the compressed file inside the archive(s)
+    :param max_part_size: Upper bound (in bytes) for the size of every archive
+    :param zip_name: Archive file name - parts are named <stem>.partN.zip when split
+    :return: (archive name, rewound spooled buffer) pairs, yielded one at a time so only one part is held in memory
+    """
+    # Deflate holds back some compressed output until the entry is closed, so split a safe distance below the limit
+    split_size = max(max_part_size - 1024 * 1024, max_part_size // 2)
+    stem = zip_name[:-4] if zip_name.endswith('.zip') else zip_name
+    part = 0
+    buffer = zip_file = entry = None
+    written = False
+
+    def open_part():
+        nonlocal part, buffer, zip_file, entry, written
+        part += 1
+        buffer = SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+        zip_file = zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED)
+        entry = zip_file.open(f"{entry_name}.part{part}" if part > 1 else entry_name, 'w', force_zip64=True)
+        written = False
+
+    def close_part(last: bool = False) -> tuple[str, SpooledTemporaryFile]:
+        entry.close()
+        zip_file.close()
+        buffer.seek(0)
+        return f"{stem}.part{part}.zip" if part > 1 or not last else zip_name, buffer
+
+    open_part()
+    for chunk in chunks:
+        entry.write(chunk)
+        written = True
+        if buffer.tell() >= split_size:
+            yield close_part()
+            open_part()
+    if written or part == 1:
+        yield close_part(last=True)
+
+
 def walk_dir(directory: str) -> list[str]:
     """Returns a list of full filepaths for each file n the directory"""
     return [join(directory, file) for file in listdir(directory)]
@@ -51,11 +117,221 @@ def get_logfile() -> str:
     return join(log_dir, 'log.txt')
 
 
-# Get administrator users (these are hardcoded)
+# Text log records start with the header written by _logger's formatter: "module : LEVEL : 2022-01-01 12:00:00,000 : msg"
+_LOG_HEADER = re.compile(rb'^[\w.]+ : (DEBUG|INFO|WARNING|ERROR|CRITICAL) : (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d{3} : ')
+
+
+def parse_log_header(line: bytes) -> Optional[tuple[int, datetime]]:
+    """:return: (numeric log level, timestamp) if the line starts a log record, otherwise None (continuation line)"""
+    if line.startswith(b'{'):
+        # Structured (LOG_FORMAT=json) records are single JSON lines
+        try:
+            record = json.loads(line)
+            return logging.getLevelName(record['level']), datetime.strptime(record['time'][:19], '%Y-%m-%d %H:%M:%S')
+        except (ValueError, KeyError, TypeError):
+            return None
+    match = _LOG_HEADER.match(line)
+    if match is None:
+        return None
+    return logging.getLevelName(match.group(1).decode()), datetime.strptime(match.group(2).decode(), '%Y-%m-%d %H:%M:%S')
+
+
+def _iter_lines_reversed(file, end: int, block_size: int = 64 * 1024) -> Iterator[tuple[int, bytes]]:
+    """Yields (byte offset, line) from the end of the file backwards, reading one block at a time"""
+    position = end
+    remainder = b''
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        file.seek(position)
+        lines = (file.read(read_size) + remainder).split(b'\n')
+        remainder = lines[0]
+        offset = position + len(remainder) + 1
+        tail = []
+        for line in lines[1:]:
+            tail.append((offset, line))
+            offset += len(line) + 1
+        yield from reversed(tail)
+    yield 0, remainder
+
+
+def find_log_offset(path: str, last: Optional[int] = None, since: Optional[datetime] = None,
+                    level: Optional[int] = None) -> int:
+    """
+    Scans the logfile backwards (without loading it) to find where a selection of records starts.
+
+    :param path: Logfile path
+    :param last: Only select the last N records (that match level)
+    :param since: Only select records logged at or after this time
+    :param level: Only count records at or above this numeric level towards `last`
+    :return: Byte offset of the first selected record
+    """
+    if last is None and since is None:
+        return 0
+
+    matched = 0
+    with open(path, 'rb') as infile:
+        next_record = getsize(path)
+        for offset, line in _iter_lines_reversed(infile, next_record):
+            header = parse_log_header(line)
+            if header is None:
+                continue
+            record_level, logged_at = header
+            if since is not None and logged_at < since:
+                return next_record
+            if level is None or record_level >= level:
+                matched += 1
+                if last is not None and matched >= last:
+                    return offset
+            next_record = offset
+    return 0
+
+
+def iter_log_records(path: str, offset: int = 0, level: Optional[int] = None,
+                     chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+    """
+    Streams the logfile forwards from the given offset, optionally dropping records below the given level.
+
+    :return: Byte chunks ending on record boundaries (about chunk_size bytes each)
+    """
+    with open(path, 'rb') as infile:
+        infile.seek(offset)
+        if level is None:
+            while chunk := infile.read(chunk_size):
+                yield chunk
+            return
+
+        chunk = []
+        chunk_length = 0
+        keep = False
+        for line in infile:
+            header = parse_log_header(line)
+            if header is not None:
+                keep = header[0] >= level
+                if chunk_length >= chunk_size:
+                    yield b''.join(chunk)
+                    chunk = []
+                    chunk_length = 0
+            if keep:
+                chunk.append(line)
+                chunk_length += len(line)
+        if len(chunk) > 0:
+            yield b''.join(chunk)
+
+
+class AdministratorRegistry:
+    """
+    Cached view of administrators.json.
+
+    The administrators are held in memory as a frozenset. The file is only re-read when its mtime, size or inode
+    change (checked at most every `check_interval` seconds) or when reload() is called. A malformed file is rejected
+    as a whole and the last good administrator list stays in place.
+    """
+
+    def __init__(self, path: str, check_interval: float = 5):
+        """
+        :param path: Path to the administrators JSON file ({"administrators": ["<user_id>", ...]})
+        :param check_interval: Minimum number of seconds between file change checks
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._admins: frozenset = frozenset()
+        self._signature = None
+        self._rejected_signature = None
+        self._next_check = 0.0
+        self._lock = Lock()
+        self.reload()
+
+    def _file_signature(self) -> tuple:
+        file_stat = stat(self.path)
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+    def _parse(self) -> frozenset:
+        with open(self.path, 'r') as infile:
+            admins = json.loads(infile.read())['administrators']
+        if not isinstance(admins, list) or not all(isinstance(admin, (str, int)) for admin in admins):
+            raise ValueError("'administrators' must be a list of user IDs")
+        return frozenset(str(admin) for admin in admins)
+
+    def reload(self) -> frozenset:
+        """
+        Re-reads the administrators file.
+
+        :return: The new administrator set
+        :raises: The parsing error if the file is malformed (the previous administrator set is kept)
+        """
+        with self._lock:
+            signature = self._file_signature()
+            self._admins = self._parse()
+            self._signature = signature
+            self._next_check = time.monotonic() + self.check_interval
+            return self._admins
+
+    def get(self) -> frozenset:
+        """:return: The current administrators, reloading the file first if it changed on disk"""
+        if time.monotonic() >= self._next_check:
+            signature = None
+            try:
+                with self._lock:
+                    self._next_check = time.monotonic() + self.check_interval
+                    signature = self._file_signature()
+                if signature != self._signature and signature != self._rejected_signature:
+                    self.reload()
+            except Exception as exc:
+                # Only report a broken file once per change
+                self._rejected_signature = signature
+                logging.getLogger(f'{__package__}._logger').error(
+                    f'Could not reload {self.path} - keeping the previous administrators: {exc}')
+        return self._admins
+
+    def is_administrator(self, user_id) -> bool:
+        return str(user_id) in self.get()
+
+
+class UpdateOffsetStore:
+    """
+    Persists the ID of the last Telegram update whose handlers finished, so a restarted bot resumes polling right after
+    it instead of handling updates Telegram delivers again because their acknowledgement never reached it.
+    """
+
+    def __init__(self, path: str):
+        """:param path: JSON file holding {"last_update_id": <int>} (created on the first save)"""
+        self.path = path
+        self._saved: Optional[int] = None
+        self._lock = Lock()
+
+    def load(self) -> int:
+        """:return: The persisted update ID, or 0 if none was saved yet (or the file is unreadable)"""
+        try:
+            with open(self.path, 'r') as infile:
+                self._saved = int(json.load(infile)["last_update_id"])
+        except FileNotFoundError:
+            return 0
+        except (ValueError, KeyError, TypeError, OSError) as exc:
+            logging.getLogger(f'{__package__}._logger').warning(
+                f"Ignoring unreadable update offset file {self.path}: {exc}")
+            return 0
+        return self._saved
+
+    def save(self, update_id: int):
+        """Writes update_id (if it changed) atomically, so a crash mid-write never leaves a truncated file"""
+        with self._lock:
+            if update_id == self._saved:
+                return
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as outfile:
+                json.dump({"last_update_id": update_id}, outfile)
+            os.replace(temp_path, self.path)
+            self._saved = update_id
+
+
+# Administrator users (these are hardcoded in administrators.json, or the file set by TG_ADMINISTRATORS_FILE)
+administrator_registry = AdministratorRegistry(os.getenv("TG_ADMINISTRATORS_FILE",
+                                                         join(dirname(abspath(__file__)), 'administrators.json')))
+
+
 def get_administrators() -> list[str]:
-    admins_file = join(dirname(abspath(__file__)), 'administrators.json')
-    with open(admins_file, 'r') as infile:
-        return [admin for admin in json.loads(infile.read())['administrators']]
+    return list(administrator_registry.get())
 
 # DEPRECATED - Now using MySQL database
 # def load_config() -> dict:
@@ -0,0 +1,349 @@
+"""
+Background jobs - long running, config driven computations started with /runjob run in a process pool, so they
+neither block a handler thread nor compete with the bot for the GIL.
+
+The computation is a JobKind passed to JobManager. The template ships EXAMPLE_PRICE_SWEEP, a self-contained
+simulation showing how a job reads the user's settings, checks for cancellation and writes its report - replace it
+with your own JobKind.
+
+Each job gets its own temp dir (removed with clr_temp_dir once the result was delivered) that also carries its
+cancellation marker, so a running job can be stopped from the bot process without shared memory. numpy and
+xlsxwriter are only imported by the job processes.
+"""
+
+import functools
+import itertools
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from os.path import exists, join
+from tempfile import mkdtemp
+from threading import Lock
+from typing import Callable, Mapping, Optional
+
+from .tg_config import (JOB_WORKERS, JOB_MAX_PER_USER, JOB_HISTORY, JOB_MAX_LOOP_COUNT, JOB_MAX_GRID_POINTS,
+                        JOB_MAX_QTY, JOB_CHUNK_SIZE)
+from ._logger import logger
+from .io_handler import get_temp_dir, clr_temp_dir, create_zip_archive
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# File in a job's temp dir telling the job process to stop
+CANCEL_MARKER = "CANCELLED"
+
+
+class JobCancelled(Exception):
+    """Raised inside a job process when its cancellation marker is found"""
+
+
+def check_cancelled(job_dir: str):
+    """Raises JobCancelled if the job was cancelled - call it between the steps of a job"""
+    if exists(join(job_dir, CANCEL_MARKER)):
+        raise JobCancelled()
+
+
+def sweep_grid_size(config: Mapping) -> int:
+    """
+    Validates the settings of a price sweep (cheap enough to run in a handler before the job is queued).
+
+    :return: Number of price intervals the sweep covers
+    """
+    loop_count, max_qty = int(config["loop_count"]), int(config["max_qty"])
+    start, step, end = (float(config["result_price_interval_start"]), float(config["result_price_interval_add"]),
+                        float(config["result_price_interval_end"]))
+    if not 0 < loop_count <= JOB_MAX_LOOP_COUNT:
+        raise ValueError(f"loop_count must be between 1 and {JOB_MAX_LOOP_COUNT}")
+    if not 0 < max_qty <= JOB_MAX_QTY:
+        raise ValueError(f"max_qty must be between 1 and {JOB_MAX_QTY}")
+    if step <= 0 or end < start:
+        raise ValueError("result_price_interval_add must be positive and result_price_interval_end must not be "
+                         "below result_price_interval_start")
+    if float(config["target_price_interval_add"]) < 0:
+        raise ValueError("target_price_interval_add must not be negative")
+    grid_size = int((end - start) / step + 0.5) + 1
+    if grid_size > JOB_MAX_GRID_POINTS:
+        raise ValueError(f"The result price interval covers {grid_size} steps (at most {JOB_MAX_GRID_POINTS})")
+    return grid_size
+
+
+def describe_price_sweep(config: Mapping) -> str:
+    """:return: Summary of the example price sweep with the given settings (raises ValueError for invalid ones)"""
+    return f"{int(config['loop_count'])} simulations over {sweep_grid_size(config)} price intervals"
+
+
+def example_price_sweep(config: dict, job_dir: str, output_name: str, seed: Optional[int] = None) -> str:
+    """
+    Example job: simulates loop_count relative price moves and evaluates every point of the result price interval
+    grid against all of them at once - the probability of the price moving at least that far, and the P&L of 1 to
+    max_qty contracts (options struck strike_percentage above the current price, priced at their simulated mean
+    payoff). The simulations are drawn in chunks of JOB_CHUNK_SIZE and the report is written row by row, so memory
+    does not grow with loop_count or max_qty.
+
+    The price moves are drawn from a normal distribution instead of being read from market data, so
+    option_data_source is only recorded in the report - a real job would load its prices from that source.
+
+    :param config: Settings of the user (see database_schema.py), with the overrides of the job applied
+    :param job_dir: Temp dir of the job - receives the report and is checked for the cancellation marker
+    :param output_name: File name (without extension) of the report
+    :param seed: Seed of the simulations (random if None)
+    :return: Path of the xlsx report, or of the zip archive holding it if zip_output is set
+    """
+    import numpy as np
+    import xlsxwriter
+
+    sweep_grid_size(config)
+    loop_count, max_qty = int(config["loop_count"]), int(config["max_qty"])
+    start, step, end = (float(config["result_price_interval_start"]), float(config["result_price_interval_add"]),
+                        float(config["result_price_interval_end"]))
+    tick = float(config["target_price_interval_add"])
+    is_option = config.get("contract_type") == "option"
+    strike = 1 + float(config["strike_percentage"])
+
+    moves = np.round(np.arange(start, end + step / 2, step), 10)
+    # The swept range spans about two standard deviations of the simulated moves to either side
+    sigma = max(abs(start), abs(end)) / 2 or step
+
+    rng = np.random.default_rng(seed)
+    below = np.zeros(len(moves), dtype=np.int64)  # Simulations ending below each move
+    at_or_below = np.zeros(len(moves), dtype=np.int64)
+    payoff_sum = 0.0
+    for offset in range(0, loop_count, JOB_CHUNK_SIZE):
+        check_cancelled(job_dir)
+        samples = np.sort(rng.normal(0.0, sigma, min(JOB_CHUNK_SIZE, loop_count - offset)))
+        below += np.searchsorted(samples, moves, side='left')
+        at_or_below += np.searchsorted(samples, moves, side='right')
+        payoff_sum += float(np.maximum(samples + 1 - strike, 0).sum() if is_option else samples.sum())
+    premium = payoff_sum / loop_count
+
+    # Downward moves: probability of ending at or below them - upward moves: at or above them
+    probability = np.where(moves < 0, at_or_below / loop_count, 1 - below / loop_count)
+    prices = 1 + moves
+    if tick > 0:
+        prices = np.round(prices / tick) * tick
+    payoff = np.maximum(prices - strike, 0) if is_option else prices - 1
+    quantities = np.arange(1, max_qty + 1)
+
+    report_path = join(job_dir, f"{output_name}.xlsx")
+    # constant_memory flushes every row once the next one is started - rows have to be written in order
+    workbook = xlsxwriter.Workbook(report_path, {'constant_memory': True})
+    try:
+        summary = workbook.add_worksheet("Summary")
+        settings = [(name, value if isinstance(value, (int, float, str)) else str(value))
+                    for name, value in config.items()]
+        for row, (name, value) in enumerate(settings + [("simulated_premium", premium), ("seed", str(seed))]):
+            summary.write_row(row, 0, [name, value])
+
+        sweep = workbook.add_worksheet("Sweep")
+        sweep.write_row(0, 0, ["price_move", "target_price", "probability"] +
+                        [f"pnl_qty_{qty}" for qty in range(1, max_qty + 1)])
+        # One row at a time - the P&L of every quantity is only computed for the row being written
+        rows = zip(moves.tolist(), prices.tolist(), probability.tolist(), (payoff - premium).tolist())
+        for row, (move, price, move_probability, unit_pnl) in enumerate(rows, start=1):
+            if row % 10000 == 0:
+                check_cancelled(job_dir)
+            sweep.write_row(row, 0, [move, price, move_probability] + (unit_pnl * quantities).tolist())
+    finally:
+        workbook.close()
+
+    if config.get("zip_output"):
+        return create_zip_archive([report_path], job_dir, zip_name=f"{output_name}.zip")
+    return report_path
+
+
+@dataclass(frozen=True)
+class JobKind:
+    """
+    A computation JobManager runs for /runjob.
+
+    run(config, job_dir, output_name) runs in a job process (so it has to be a module level function): it writes
+    its report to job_dir, returns the report's path and should call check_cancelled(job_dir) between its steps.
+    describe(config) runs in the bot process before the job is queued: it raises ValueError for invalid settings and
+    returns a summary of the work for the user.
+    """
+    name: str
+    run: Callable[[dict, str, str], str]
+    describe: Callable[[Mapping], str]
+
+
+EXAMPLE_PRICE_SWEEP = JobKind("example price sweep", run=example_price_sweep, describe=describe_price_sweep)
+
+
+@dataclass
+class Job:
+    job_id: int
+    user_id: str
+    chat_id: int
+    config: dict
+    job_dir: str
+    summary: str = ""  # See JobKind.describe
+    state: str = QUEUED
+    submitted: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+    result_path: Optional[str] = None
+    error: Optional[str] = None
+    future: Optional[Future] = field(default=None, repr=False)
+
+    @property
+    def active(self) -> bool:
+        return self.state in (QUEUED, RUNNING)
+
+    @property
+    def duration(self) -> float:
+        """:return: Seconds since the job was submitted (until it finished)"""
+        return (self.finished if self.finished is not None else time.time()) - self.submitted
+
+
+class JobManager:
+    """
+    Queues jobs on a process pool (started on the first job) and hands every finished job to `deliver` on a
+    delivery thread, after which its temp dir is removed. Keeps the last JOB_HISTORY finished jobs of each user.
+    """
+
+    def __init__(self, deliver: Callable[[Job], object], kind: JobKind = EXAMPLE_PRICE_SWEEP,
+                 workers: int = JOB_WORKERS, max_per_user: int = JOB_MAX_PER_USER, history: int = JOB_HISTORY):
+        """
+        :param deliver: Callable(job) sending the result (or failure) of a finished job to its user
+        :param kind: The computation the jobs run (the template's example price sweep by default)
+        :param workers: Number of job processes
+        :param max_per_user: Queued or running jobs a user may have at a time
+        :param history: Finished jobs kept per user
+        """
+        self.deliver = deliver
+        self.kind = kind
+        self.workers = workers
+        self.max_per_user = max_per_user
+        self.history = history
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._delivery = ThreadPoolExecutor(max_workers=2, thread_name_prefix="JobDelivery")
+        self._jobs: dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+
+    def _submit(self, func: Callable, *args) -> Future:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            try:
+                return self._executor.submit(func, *args)
+            except BrokenProcessPool:
+                # A job process died (e.g. killed for its memory) - the jobs it took down were failed, start over
+                logger.warning('Job process pool is broken - restarting it')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                return self._executor.submit(func, *args)
+
+    def submit(self, user_id: str, chat_id: int, config: Mapping) -> Job:
+        """Queues a job with the given settings (raises ValueError for invalid ones or too many jobs)"""
+        summary = f"{self.kind.name} - {self.kind.describe(config)}"
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job.user_id == user_id and job.active)
+            if active >= self.max_per_user:
+                raise ValueError(f"You already have {active} jobs queued or running - wait for one to finish or "
+                                 f"cancel it with /canceljob")
+            job_id = next(self._ids)
+            job = Job(job_id, user_id, chat_id, dict(config), job_dir=mkdtemp(prefix=f"job_{job_id}_",
+                                                                                dir=get_temp_dir()),
+                      summary=summary)
+            self._jobs[job_id] = job
+        try:
+            job.future = self._submit(self.kind.run, job.config, job.job_dir,
+                                      f"{self.kind.name.replace(' ', '_')}_{job_id}")
+        except Exception:
+            # Not queued - forget the job, so it neither shows up as queued nor counts towards the user's limit
+            with self._lock:
+                del self._jobs[job_id]
+            clr_temp_dir(job.job_dir)
+            raise
+        job.future.add_done_callback(functools.partial(self._finished, job))
+        logger.info(f"Job {job_id} of {user_id} queued")
+        return job
+
+    def jobs(self, user_id: str) -> list[Job]:
+        """:return: The active and recently finished jobs of the user, oldest first"""
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.user_id == user_id]
+        for job in jobs:
+            if job.state == QUEUED and job.future is not None and job.future.running():
+                job.state = RUNNING
+        return jobs
+
+    def cancel(self, user_id: str, job_id: int) -> Job:
+        """Cancels a queued job, or asks a running one to stop (raises KeyError/ValueError if it can't be)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            raise KeyError(f"You have no job {job_id}")
+        if not job.active:
+            raise ValueError(f"Job {job_id} already {job.state}")
+        self._cancel(job)
+        return job
+
+    def _cancel(self, job: Job):
+        if job.future is None or not job.future.cancel():
+            # Already running - the job process checks for the marker between steps
+            try:
+                with open(join(job.job_dir, CANCEL_MARKER), 'w'):
+                    pass
+            except FileNotFoundError:
+                pass  # Finished (and cleaned up) meanwhile
+
+    def _finished(self, job: Job, future: Future):
+        if future.cancelled():
+            job.state = CANCELLED
+        elif future.exception() is None:
+            job.state = DONE
+            job.result_path = future.result()
+        elif isinstance(future.exception(), JobCancelled):
+            job.state = CANCELLED
+        else:
+            job.state = FAILED
+            job.error = str(future.exception()) or type(future.exception()).__name__
+            logger.warning(f"Job {job.job_id} of {job.user_id} failed: {job.error}")
+        job.finished = time.time()
+        try:
+            self._delivery.submit(self._deliver, job)
+        except RuntimeError:
+            self._deliver(job)  # Shutting down
+
+    def _deliver(self, job: Job):
+        try:
+            self.deliver(job)
+        except Exception as exc:
+            logger.exception(f'Could not deliver job {job.job_id}', exc_info=exc)
+        finally:
+            clr_temp_dir(job.job_dir)
+            self._prune(job.user_id)
+
+    def _prune(self, user_id: str):
+        with self._lock:
+            finished = [job.job_id for job in self._jobs.values() if job.user_id == user_id and not job.active]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self._jobs[job_id]
+
+    def stats(self) -> dict:
+        """:return: Number of jobs per state"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        stats = {state: 0 for state in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+        for job in jobs:
+            state = RUNNING if job.state == QUEUED and job.future is not None and job.future.running() else job.state
+            stats[state] += 1
+        return stats
+
+    def shutdown(self):
+        """Cancels the active jobs (their users are told) and stops the job processes"""
+        with self._lock:
+            active = [job for job in self._jobs.values() if job.active]
+        for job in active:
+            self._cancel(job)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._delivery.shutdown(wait=True)
@@ -0,0 +1,267 @@
+"""
+Lightweight latency/error instrumentation for message handlers, permission checks and database calls.
+
+Every observation is a counter increment plus a fixed-bucket histogram update under a per-metric lock, so the
+instrumentation is cheap enough to leave on in production. Percentiles are estimated from the histogram buckets.
+"""
+
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Optional
+
+from ._logger import logger, log_context
+
+# Histogram bucket upper bounds in seconds (the last, implicit bucket is +Inf)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class LatencyMetric:
+    """Call count, error count and latency histogram of a single handler/check/query"""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds: float, error: bool = False):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if error:
+                self.errors += 1
+
+    def percentile(self, pct: float) -> float:
+        """:return: Estimated latency (in seconds) at the given percentile, interpolated inside its bucket"""
+        with self._lock:
+            counts = list(self.bucket_counts)
+            count = self.count
+            maximum = self.max
+        if count == 0:
+            return 0.0
+        rank = pct / 100 * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count > 0 and cumulative + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else maximum
+                return min(maximum, lower + (upper - lower) * (rank - cumulative) / bucket_count)
+            cumulative += bucket_count
+        return maximum
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"count": self.count, "errors": self.errors, "total": self.total, "max": self.max,
+                    "bucket_counts": list(self.bucket_counts)}
+
+
+class MetricsRegistry:
+    """Holds one LatencyMetric per (kind, name), e.g. ("handler", "on_setconfig") or ("db", "pull_user_config")"""
+
+    def __init__(self):
+        self._metrics: dict[tuple[str, str], LatencyMetric] = {}
+        self._lock = Lock()
+
+    def metric(self, kind: str, name: str) -> LatencyMetric:
+        key = (kind, name)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, LatencyMetric())
+        return metric
+
+    def observe(self, kind: str, name: str, seconds: float, error: bool = False):
+        self.metric(kind, name).observe(seconds, error)
+
+    def items(self) -> list[tuple[tuple[str, str], LatencyMetric]]:
+        with self._lock:
+            return sorted(self._metrics.items())
+
+    def render_text(self) -> str:
+        """:return: Human readable summary of the metrics with at least one call (used by the /stats command)"""
+        lines = []
+        current_kind = None
+        for (kind, name), metric in self.items():
+            snapshot = metric.snapshot()
+            if snapshot['count'] == 0:
+                continue
+            if kind != current_kind:
+                lines.append(f"\n[{kind}]")
+                current_kind = kind
+            lines.append(f"{name}: n={snapshot['count']} err={snapshot['errors']} "
+                         f"p50={metric.percentile(50) * 1000:.1f}ms p95={metric.percentile(95) * 1000:.1f}ms "
+                         f"p99={metric.percentile(99) * 1000:.1f}ms")
+        return "\n".join(lines).strip() if len(lines) > 0 else "No metrics recorded yet."
+
+    def render_prometheus(self, gauges: Optional[dict] = None) -> str:
+        """
+        :param gauges: Extra {metric_name: value} gauges to export (e.g. cache sizes, queue depths)
+        :return: Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        by_kind: dict[str, list[tuple[str, LatencyMetric]]] = {}
+        for (kind, name), metric in self.items():
+            by_kind.setdefault(kind, []).append((name, metric))
+
+        # Samples of a metric family must be contiguous, so histograms and error counters are written separately
+        for kind, metrics in by_kind.items():
+            family = f"bot_{kind}_latency_seconds"
+            snapshots = [(name, metric, metric.snapshot()) for name, metric in metrics]
+            lines.append(f"# TYPE {family} histogram")
+            for name, metric, snapshot in snapshots:
+                cumulative = 0
+                for bound, bucket_count in zip((*metric.buckets, "+Inf"), snapshot["bucket_counts"]):
+                    cumulative += bucket_count
+                    lines.append(f'{family}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{family}_sum{{name="{name}"}} {snapshot["total"]}')
+                lines.append(f'{family}_count{{name="{name}"}} {snapshot["count"]}')
+            lines.append(f"# TYPE bot_{kind}_errors_total counter")
+            for name, metric, snapshot in snapshots:
+                lines.append(f'bot_{kind}_errors_total{{name="{name}"}} {snapshot["errors"]}')
+        for gauge, value in (gauges or {}).items():
+            lines.append(f"# TYPE {gauge} gauge")
+            lines.append(f"{gauge} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Process wide registry used by the bot
+registry = MetricsRegistry()
+
+
+def _log_slow_call(kind: str, name: str, seconds: float, args: tuple):
+    # Handlers receive the message first - attach the user to the structured log record when there is one
+    from_user = getattr(args[0], 'from_user', None) if len(args) > 0 else None
+    logger.warning(f"Slow {kind} {name}: {seconds * 1000:.0f}ms",
+                   extra={"handler": name, "user_id": getattr(from_user, 'id', None),
+                          "latency_ms": round(seconds * 1000, 1)})
+
+
+def timed(kind: str, name: Optional[str] = None, metrics: MetricsRegistry = None,
+          slow_threshold: Optional[float] = None):
+    """
+    (Decorator) Records the latency of every call, and whether it raised, under (kind, name).
+    Works for both plain functions and coroutine functions. While a call that receives a message runs (i.e. a
+    handler), every record it logs carries the handler name and user_id as structured extras.
+
+    :param kind: Metric group, e.g. "handler", "auth" or "db"
+    :param name: Metric name (defaults to the function name)
+    :param metrics: Registry to record into (defaults to the process wide registry)
+    :param slow_threshold: Calls taking at least this many seconds are also logged as warnings
+    """
+
+    def decorator(func: Callable):
+        metric_name = name or func.__name__
+        metric = (metrics or registry).metric(kind, metric_name)
+
+        def enter(args: tuple):
+            from_user = getattr(args[0], 'from_user', None) if len(args) > 0 else None
+            if from_user is None:
+                return None
+            return log_context.set({"handler": metric_name, "user_id": from_user.id})
+
+        def observe(started: float, error: bool, args: tuple):
+            seconds = time.perf_counter() - started
+            metric.observe(seconds, error)
+            if slow_threshold is not None and seconds >= slow_threshold:
+                _log_slow_call(kind, metric_name, seconds, args)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                context = enter(args)
+                started = time.perf_counter()
+                error = True
+                try:
+                    result = await func(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    observe(started, error, args)
+                    if context is not None:
+                        log_context.reset(context)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            context = enter(args)
+            started = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                observe(started, error, args)
+                if context is not None:
+                    log_context.reset(context)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_class(kind: str, metrics: MetricsRegistry = None):
+    """(Class decorator) Applies timed() to every public method defined on the class"""
+
+    def decorator(cls):
+        for attr_name, attr in list(vars(cls).items()):
+            if attr_name.startswith('_') or not inspect.isfunction(attr):
+                continue
+            setattr(cls, attr_name, timed(kind, attr_name, metrics)(attr))
+        return cls
+
+    return decorator
+
+
+class MetricsServer:
+    """Serves GET /metrics in the Prometheus text format from a background thread"""
+
+    def __init__(self, port: int, gauges: Callable[[], dict] = dict, listen: str = "0.0.0.0",
+                 metrics: MetricsRegistry = registry):
+        """
+        :param port: Port to bind to
+        :param gauges: Callable returning extra {metric_name: value} gauges at scrape time
+        :param listen: Interface to bind to
+        """
+        server = self
+        self.metrics = metrics
+        self.gauges = gauges
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = server.metrics.render_prometheus(server.gauges()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((listen, port), RequestHandler)
+        self.httpd.daemon_threads = True
+        self._thread = Thread(target=self.httpd.serve_forever, name="MetricsServer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,218 @@
+import asyncio
+from types import MappingProxyType
+from typing import Iterable, Mapping, Optional
+
+from .db_config import (DB_BACKEND, WHITELIST_CACHE_TTL, USER_CONFIG_CACHE_SIZE, USER_CONFIG_CACHE_TTL,
+                        DB_AUTO_MIGRATE)
+from .table_metadata import ColumnMetadata, build_column_metadata, row_to_dict, coerce_value, to_db_value
+from .caches import WhitelistCache, UserConfigCache
+from .storage_backends import (AsyncMySQLBackend, normalize_user_ids, WHITELISTED, ALREADY_WHITELISTED, BLACKLISTED,
+                               NOT_WHITELISTED, INVALID_USER_ID)
+from .migrations import run_migrations
+from ..metrics import instrument_class
+
+
+@instrument_class("db")
+class AsyncDatabaseHandler:
+    """
+    asyncio counterpart of DatabaseHandler, with the same method surface (awaitable). The queries are the ones of the
+    storage backends, awaited on an aiomysql pool (see AsyncMySQLBackend).
+
+    Create instances with `await AsyncDatabaseHandler.create()` so the connection pool and table metadata are
+    initialized before first use.
+    """
+
+    def __init__(self, backend: Optional[AsyncMySQLBackend] = None, whitelist_cache_ttl: float = WHITELIST_CACHE_TTL,
+                 user_config_cache_size: int = USER_CONFIG_CACHE_SIZE,
+                 user_config_cache_ttl: float = USER_CONFIG_CACHE_TTL):
+        """
+        :param backend: Storage backend running the queries (defaults to an AsyncMySQLBackend of the configured
+                        database)
+        :param whitelist_cache_ttl: Seconds before the cached whitelist is reloaded (0 disables the cache)
+        :param user_config_cache_size: Number of users whose decoded config is cached (least recently used evicted)
+        :param user_config_cache_ttl: Seconds before a cached user config is reloaded (0 disables the cache)
+        """
+        if backend is None:
+            if DB_BACKEND != "mysql":
+                raise ValueError(f"The asyncio engine only supports the mysql storage backend "
+                                 f"(DB_BACKEND={DB_BACKEND})")
+            backend = AsyncMySQLBackend()
+        self.backend = backend
+        self.whitelist_cache = WhitelistCache(ttl=whitelist_cache_ttl)
+        self.user_config_cache = UserConfigCache(maxsize=user_config_cache_size, ttl=user_config_cache_ttl)
+        self._table_metadata: Optional[list[ColumnMetadata]] = None
+        self._table_columns: dict[str, ColumnMetadata] = {}
+
+    @classmethod
+    async def create(cls, auto_migrate: bool = DB_AUTO_MIGRATE, **kwargs) -> "AsyncDatabaseHandler":
+        """:param auto_migrate: Create/migrate the user table to DATABASE_SCHEMA first (see migrations.py)"""
+        handler = cls(**kwargs)
+        if auto_migrate:
+            # Migrations are rare, blocking DDL - run them over a short-lived mysql.connector connection
+            await asyncio.to_thread(run_migrations)
+        await handler.initialize_connection()
+        try:
+            await handler.refresh_table_metadata()
+        except Exception:
+            # The table may not exist yet - metadata is loaded on first use instead
+            pass
+        return handler
+
+    @property
+    def pool(self):
+        """aiomysql connection pool of the storage backend"""
+        return self.backend.pool
+
+    async def initialize_connection(self):
+        """(Re)creates the connection pool, retrying with exponential backoff if the database is unreachable"""
+        await self.backend.initialize_connection()
+
+    async def load_whitelist(self) -> list[str]:
+        """Loads all whitelisted user IDs from the database"""
+        generation = self.whitelist_cache.generation
+        whitelist = await self.backend.load_whitelist()
+        self.whitelist_cache.set(whitelist, generation)
+        return whitelist
+
+    async def is_whitelisted(self, user_id: str) -> bool:
+        """Checks whitelist membership against the in-process cache, reloading it once the TTL expires"""
+        cached = self.whitelist_cache.contains(user_id)
+        if cached is not None:
+            return cached
+        return str(user_id) in {str(user) for user in await self.load_whitelist()}
+
+    def invalidate_whitelist_cache(self):
+        self.whitelist_cache.invalidate()
+
+    def whitelist_cache_stats(self) -> dict:
+        return self.whitelist_cache.stats()
+
+    async def whitelist_user(self, user_id: str):
+        """
+        Adds a new user to the database.
+
+        :param user_id: Telegram user ID (numerical string not their username)
+        """
+        outcome = (await self.whitelist_users([user_id])).get(str(user_id).strip())
+        if outcome == INVALID_USER_ID:
+            raise ValueError(f"Invalid user ID: {user_id}")
+        if outcome == ALREADY_WHITELISTED:
+            raise AssertionError(f"User ({user_id}) is already whitelisted.")
+
+    async def blacklist_user(self, user_id: str):
+        outcome = (await self.blacklist_users([user_id])).get(str(user_id).strip())
+        if outcome == INVALID_USER_ID:
+            raise ValueError(f"Invalid user ID: {user_id}")
+        if outcome == NOT_WHITELISTED:
+            raise AssertionError(f"User ({user_id}) is not on the whitelist.")
+
+    async def whitelist_users(self, user_ids: Iterable[str]) -> dict[str, str]:
+        """Async counterpart of DatabaseHandler.whitelist_users"""
+        user_ids = normalize_user_ids(user_ids, self.backend.key_type)
+        valid = [user_id for user_id, is_valid in user_ids.items() if is_valid]
+        existing = await self.backend.existing_users(valid)
+        new_users = [user_id for user_id in valid if user_id not in existing]
+        try:
+            if len(new_users) > 0:
+                await self.backend.whitelist_users(new_users)
+        finally:
+            self.invalidate_whitelist_cache()
+        return {user_id: INVALID_USER_ID if not is_valid else ALREADY_WHITELISTED if user_id in existing
+                else WHITELISTED for user_id, is_valid in user_ids.items()}
+
+    async def blacklist_users(self, user_ids: Iterable[str]) -> dict[str, str]:
+        """Async counterpart of DatabaseHandler.blacklist_users"""
+        user_ids = normalize_user_ids(user_ids, self.backend.key_type)
+        existing = await self.backend.existing_users([user_id for user_id, is_valid in user_ids.items() if is_valid])
+        try:
+            if len(existing) > 0:
+                await self.backend.blacklist_users([user_id for user_id in user_ids if user_id in existing])
+        finally:
+            self.invalidate_whitelist_cache()
+            for user_id in existing:
+                self.user_config_cache.invalidate(user_id)
+        return {user_id: INVALID_USER_ID if not is_valid else BLACKLISTED if user_id in existing
+                else NOT_WHITELISTED for user_id, is_valid in user_ids.items()}
+
+    async def pull_user_config(self, user_id: str) -> Mapping:
+        """
+        :param user_id: Telegram user ID
+        :return: The current user configuration for the Bot (read-only snapshot, see DatabaseHandler.pull_user_config)
+        """
+        cached = self.user_config_cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        generation = self.user_config_cache.generation
+        table_metadata = await self.get_table_metadata()
+        config = await self.backend.pull_user_config(user_id)
+        if config is None:
+            raise IndexError(f"User ({user_id}) not found in database.")
+        return self.user_config_cache.put(user_id, row_to_dict(table_metadata, config), generation)
+
+    async def update_user_config(self, user_id: str, config_name: str, new_value) -> Mapping:
+        """Updates a single config setting for the given user and returns the updated config"""
+        return await self.update_user_configs(user_id, {config_name: new_value})
+
+    async def update_user_configs(self, user_id: str, changes: dict) -> Mapping:
+        """
+        Applies several config changes for the given user in a single parameterized UPDATE and transaction.
+
+        :param user_id: Telegram user ID
+        :param changes: {config_name: new_value} - values are validated against the column types
+        :return: The updated user config for the given user_id
+        """
+        if len(changes) == 0:
+            return await self.pull_user_config(user_id)
+
+        table_metadata = await self.get_table_metadata()
+        # Validate every change before touching the database so the update is all-or-nothing
+        values = {config_name: to_db_value(self.coerce_config_value(config_name, value))
+                  for config_name, value in changes.items()}
+
+        try:
+            row = await self.backend.update_user_config(user_id, values)
+        finally:
+            self.user_config_cache.invalidate(user_id)
+        if row is None:
+            raise IndexError(f"User ({user_id}) not found in database.")
+        return MappingProxyType(row_to_dict(table_metadata, row))
+
+    def coerce_config_value(self, config_name: str, value):
+        """Validates a config change against the cached column metadata (see DatabaseHandler.coerce_config_value)"""
+        try:
+            column = self._table_columns[config_name]
+        except KeyError:
+            raise KeyError(f"{config_name} does not match any available config settings in database.")
+        if column.name == "user_id":
+            raise KeyError("user_id can not be changed.")
+        return coerce_value(column, value)
+
+    async def get_table_columns(self) -> list[tuple]:
+        """Returns the ordered (name, type) tuples of all table columns"""
+        return await self.backend.get_table_columns()
+
+    async def get_table_metadata(self) -> list[ColumnMetadata]:
+        """Cached column metadata of the user table (loaded on first access if startup could not load it)"""
+        if self._table_metadata is None:
+            await self.refresh_table_metadata()
+        return self._table_metadata
+
+    async def refresh_table_metadata(self) -> list[ColumnMetadata]:
+        """Reloads the cached column metadata from the live table (call after altering the table)"""
+        metadata = build_column_metadata(await self.get_table_columns())
+        self._table_columns = {column.name: column for column in metadata}
+        self._table_metadata = metadata
+        # Cached configs were decoded with the previous columns
+        self.user_config_cache.invalidate()
+        return metadata
+
+    def user_config_cache_stats(self) -> dict:
+        return self.user_config_cache.stats()
+
+    def pool_stats(self) -> dict:
+        """:return: Size and idle connection count of the connection pool"""
+        return self.backend.stats()
+
+    async def close(self):
+        await self.backend.close()
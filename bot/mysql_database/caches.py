@@ -0,0 +1,125 @@
+"""In-process caches shared by the sync and async database handlers"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+
+class WhitelistCache:
+    """Set-backed whitelist membership cache that expires after a TTL"""
+
+    def __init__(self, ttl: float):
+        """:param ttl: Seconds before the cached whitelist must be reloaded (0 disables the cache)"""
+        self.ttl = ttl
+        self._members: Optional[set[str]] = None
+        self._expiry = 0.0
+        self._lock = Lock()
+        # Bumped on every invalidation - whitelists loaded before it are not cached (they may be stale)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, user_id: str) -> Optional[bool]:
+        """:return: Cached membership of the user, or None if the cache is empty/expired (counted as a miss)"""
+        with self._lock:
+            if self._members is not None and time.monotonic() < self._expiry:
+                self.hits += 1
+                return str(user_id) in self._members
+            self.misses += 1
+            return None
+
+    def set(self, whitelist: list[str], generation: int):
+        """:param generation: Value of self.generation read before the whitelist was loaded from the database"""
+        if self.ttl > 0:
+            with self._lock:
+                if generation != self.generation:
+                    return
+                self._members = {str(user_id) for user_id in whitelist}
+                self._expiry = time.monotonic() + self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._members = None
+            self._expiry = 0.0
+
+    def stats(self) -> dict:
+        """:return: Hit/miss counters and current size of the cache"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._members) if self._members is not None else 0, "ttl": self.ttl}
+
+
+class UserConfigCache:
+    """
+    Bounded LRU cache of decoded per-user config dicts that expire after a TTL.
+
+    Entries are stored as read-only mappings, so the snapshot handed to one handler can not be changed by another.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        :param maxsize: Maximum number of cached users (least recently used entries are evicted first)
+        :param ttl: Seconds before a cached config must be reloaded (0 disables the cache)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, Mapping]] = OrderedDict()
+        self._lock = Lock()
+        # Bumped on every invalidation - reads that started before it are not cached (they may be stale)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: str) -> Optional[Mapping]:
+        """:return: The cached config snapshot, or None if it is not cached/expired (counted as a miss)"""
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[0]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, user_id: str, config: dict, generation: int) -> Mapping:
+        """
+        :param generation: Value of self.generation read before the config was loaded from the database
+        :return: Read-only snapshot of the config
+        """
+        snapshot = MappingProxyType(dict(config))
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return snapshot
+        key = str(user_id)
+        with self._lock:
+            if generation != self.generation:
+                return snapshot
+            self._entries[key] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return snapshot
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Drops the cached config of one user, or of every user if no user_id is given"""
+        with self._lock:
+            self.generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(user_id), None)
+
+    def stats(self) -> dict:
+        """:return: Hit/miss/eviction counters, hit rate and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else 0.0,
+                    "size": len(self._entries), "maxsize": self.maxsize, "ttl": self.ttl}
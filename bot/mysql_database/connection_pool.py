@@ -0,0 +1,171 @@
+import queue
+from contextlib import contextmanager
+from threading import Lock
+from time import sleep
+from typing import Callable, Optional
+
+from .db_config import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME
+
+
+def _mysql():
+    # Imported on first use - mysql.connector is slow to import and the SQLite backend never needs it
+    import mysql.connector
+    return mysql.connector
+
+
+def connect_mysql():
+    """Opens a new connection to the configured MySQL database"""
+    return _mysql().connect(
+        host=DB_HOST,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME
+    )
+
+
+class ConnectionPool:
+    """
+    Fixed-size, thread-safe pool of database connections.
+
+    Connections are borrowed for the duration of a single operation and checked back in afterwards, so concurrent
+    handler threads never share a cursor. Liveness is only checked when a connection is borrowed; dead connections
+    are replaced using reconnect-with-backoff.
+    """
+
+    def __init__(self, size: int, connect: Callable = connect_mysql, checkout_timeout: Optional[float] = None,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 8,
+                 is_alive: Callable = lambda conn: conn.is_connected(),
+                 disconnect_errors: Optional[tuple] = None):
+        """
+        :param size: Number of connections held by the pool
+        :param connect: Callable returning a new DB-API connection
+        :param is_alive: Callable(connection) checking a connection before it is borrowed
+        :param disconnect_errors: Exceptions after which a borrowed connection is presumed broken and replaced
+                                  (defaults to mysql.connector's InterfaceError and OperationalError)
+        :param checkout_timeout: Seconds to wait for a free connection before raising (None waits forever)
+        :param max_retries: Connection attempts before giving up
+        :param backoff_base: Delay (in seconds) after the first failed attempt, doubled on every retry
+        :param backoff_max: Upper bound for the delay between attempts (in seconds)
+        """
+        if size < 1:
+            raise ValueError("Connection pool size must be at least 1")
+
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._connect = connect
+        self._is_alive = is_alive
+        if disconnect_errors is None:
+            disconnect_errors = (_mysql().InterfaceError, _mysql().OperationalError)
+        self._disconnect_errors = disconnect_errors
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = Lock()
+        self._closed = False
+        self.reconnects = 0
+
+        for _ in range(size):
+            self._idle.put(self.connect_with_backoff())
+
+    def connect_with_backoff(self):
+        """Opens a new connection, retrying with exponential backoff"""
+        exc = None
+        for attempt in range(self.max_retries):
+            try:
+                return self._connect()
+            except Exception as err:
+                exc = err
+                if attempt < self.max_retries - 1:
+                    sleep(min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        raise _mysql().DatabaseError(f"Could not connect to MySQL database after {self.max_retries} retries"
+                                     f"{f' - Error: {exc}' if exc is not None else ''}")
+
+    def _borrow(self):
+        if self._closed:
+            raise _mysql().InterfaceError("Connection pool is closed")
+        try:
+            conn = self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise _mysql().PoolError(f"No free connection in pool after {self.checkout_timeout} seconds")
+
+        try:
+            if conn is None or not self._is_alive(conn):
+                self._discard(conn)
+                with self._lock:
+                    self.reconnects += 1
+                conn = self.connect_with_backoff()
+        except Exception:
+            # Keep the pool at full size even when reconnecting fails
+            self._idle.put(None)
+            raise
+        return conn
+
+    def _return(self, conn):
+        if self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    @staticmethod
+    def _discard(conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """(Context manager) Checks out a connection, rolling back and returning it to the pool afterwards"""
+        conn = self._borrow()
+        try:
+            yield conn
+        except self._disconnect_errors:
+            # The connection is likely broken - drop it and let the next borrow reconnect
+            self._discard(conn)
+            conn = None
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        else:
+            # End the transaction even after plain reads - with autocommit off (REPEATABLE READ) an open transaction
+            # keeps its read snapshot, so the next borrower would not see rows committed by other connections
+            try:
+                conn.rollback()
+            except self._disconnect_errors:
+                self._discard(conn)
+                conn = None
+        finally:
+            self._return(conn)
+
+    @contextmanager
+    def cursor(self, **cursor_kwargs):
+        """(Context manager) Checks out a connection and yields (connection, cursor) for a single operation"""
+        with self.connection() as conn:
+            cursor = conn.cursor(**cursor_kwargs)
+            try:
+                yield conn, cursor
+            finally:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+    def stats(self) -> dict:
+        """:return: Size, idle connection count and number of reconnects of the pool"""
+        return {"size": self.size, "idle": self._idle.qsize(), "reconnects": self.reconnects}
+
+    def close(self):
+        """Closes every idle connection; borrowed connections are closed when they are returned"""
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
@@ -1,48 +1,78 @@
-import time
-from time import sleep
-from typing import Optional
+from types import MappingProxyType
+from typing import Callable, Iterable, Mapping, Optional
 
-import mysql.connector
-
-from .db_config import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME
-from .database_schema import DATABASE_SCHEMA
+from .db_config import WHITELIST_CACHE_TTL, USER_CONFIG_CACHE_SIZE, USER_CONFIG_CACHE_TTL, DB_AUTO_MIGRATE
+from .connection_pool import ConnectionPool
+from .storage_backends import (StorageBackend, create_backend, normalize_user_ids, WHITELISTED, ALREADY_WHITELISTED,
+                               BLACKLISTED, NOT_WHITELISTED, INVALID_USER_ID)
+from .table_metadata import ColumnMetadata, build_column_metadata, row_to_dict, coerce_value, to_db_value
+from .caches import WhitelistCache, UserConfigCache
+from .migrations import SchemaMigrator
+from ..metrics import instrument_class
+from .._logger import logger
 
 
+@instrument_class("db")
 class DatabaseHandler:
-    def __init__(self):
-        self.db = None
-        self.cursor = None
-        self.initialize_connection()
+    def __init__(self, backend: Optional[StorageBackend] = None, whitelist_cache_ttl: float = WHITELIST_CACHE_TTL,
+                 user_config_cache_size: int = USER_CONFIG_CACHE_SIZE,
+                 user_config_cache_ttl: float = USER_CONFIG_CACHE_TTL, auto_migrate: bool = DB_AUTO_MIGRATE):
+        """
+        :param backend: Storage backend running the queries (defaults to the one selected by DB_BACKEND)
+        :param whitelist_cache_ttl: Seconds before the cached whitelist is reloaded (0 disables the cache)
+        :param user_config_cache_size: Number of users whose decoded config is cached (least recently used evicted)
+        :param user_config_cache_ttl: Seconds before a cached user config is reloaded (0 disables the cache)
+        :param auto_migrate: Create/migrate the user table to DATABASE_SCHEMA before first use (see migrate_schema)
+        """
+        self.backend = backend if backend is not None else create_backend()
 
-    def initialize_connection(self, _try: int = 1, exc: Exception = None):
-        max_retries = 5
-        connection_delay = 2  # In seconds
-        if _try > max_retries:
-            raise mysql.connector.DatabaseError(f"Could not connect to MySQL database after {max_retries} retries"
-                                                f"{f' - Error: {exc}' if exc is not None else ''}")
-        try:
+        # In-process whitelist cache (set of user_id strings), refreshed from the database after the TTL expires
+        self.whitelist_cache = WhitelistCache(ttl=whitelist_cache_ttl)
+
+        # Read-through LRU cache of decoded user configs, invalidated by every write to the user table
+        self.user_config_cache = UserConfigCache(maxsize=user_config_cache_size, ttl=user_config_cache_ttl)
+
+        # Table metadata (column order, types and decoders), loaded once and refreshed on schema changes
+        self._table_metadata: Optional[list[ColumnMetadata]] = None
+        self._table_columns: dict[str, ColumnMetadata] = {}
+
+        # Callables(cache, user_id) told about every cache invalidation made by this handler, e.g. to repeat it in
+        # other processes sharing the database (see supervisor.py and apply_invalidation)
+        self.invalidation_listeners: list[Callable[[str, Optional[str]], None]] = []
+
+        self.initialize_connection()
+        if auto_migrate:
+            self.migrate_schema()
+        else:
             try:
-                self.close()
-            except:
+                self.refresh_table_metadata()
+            except Exception:
+                # The table may not exist yet (see create_default_table) - metadata is loaded on first use instead
                 pass
-            finally:
-                self.db = mysql.connector.connect(
-                    host=DB_HOST,
-                    user=DB_USER,
-                    password=DB_PASSWORD,
-                    database=DB_NAME
-                )
-                self.cursor = self.db.cursor()
-        except Exception as exc:
-            sleep(connection_delay)  # Connection delay
-            self.initialize_connection(_try + 1, exc=exc)
+
+    @property
+    def pool(self) -> ConnectionPool:
+        """Connection pool of the storage backend"""
+        return self.backend.pool
+
+    def initialize_connection(self):
+        """(Re)creates the connection pool, retrying with backoff if the database is unreachable"""
+        self.backend.initialize_connection()
 
     def create_default_table(self):
-        if not self.db.is_connected():
-            self.initialize_connection()
+        self.backend.create_table()
+        self.refresh_table_metadata()
 
-        columns = ", ".join([f"{column['column_name']} {column['datatype']}" for column in DATABASE_SCHEMA["COLUMNS"]])
-        self.cursor.execute(f"CREATE TABLE {DATABASE_SCHEMA['TABLE_NAME']} ({columns})")
+    def migrate_schema(self, force: bool = False) -> list[str]:
+        """
+        Creates the user table or brings it in line with DATABASE_SCHEMA (typed primary key, missing columns).
+
+        :param force: Diff the live table even if the current schema was already migrated
+        :return: Names of the applied migrations
+        """
+        applied = SchemaMigrator(self.backend).migrate(force)
+        self.refresh_table_metadata()
+        return applied
 
     def load_whitelist(self) -> list[str]:
         """
@@ -50,11 +80,58 @@ class DatabaseHandler:
 
         :return: List of dictionaries that show: {"id": id, "is_admin": True/False}
         """
-        if not self.db.is_connected():
-            self.initialize_connection()
+        generation = self.whitelist_cache.generation
+        whitelist = self.backend.load_whitelist()
+        self.whitelist_cache.set(whitelist, generation)
+        return whitelist
 
-        self.cursor.execute(f"SELECT user_id FROM {DATABASE_SCHEMA['TABLE_NAME']}")
-        return [user[0] for user in self.cursor]
+    def is_whitelisted(self, user_id: str) -> bool:
+        """
+        Checks whitelist membership against the in-process cache, only hitting the database when the cache is
+        empty or older than the configured TTL.
+
+        :param user_id: Telegram user ID
+        """
+        cached = self.whitelist_cache.contains(user_id)
+        if cached is not None:
+            return cached
+        return str(user_id) in {str(user) for user in self.load_whitelist()}
+
+    def invalidate_whitelist_cache(self):
+        """Drops the cached whitelist so the next membership check reloads it from the database"""
+        self.whitelist_cache.invalidate()
+        self._notify_invalidation("whitelist")
+
+    def invalidate_user_config_cache(self, user_id: Optional[str] = None):
+        """Drops the cached config of one user (or of every user) so the next read reloads it from the database"""
+        self.user_config_cache.invalidate(user_id)
+        self._notify_invalidation("user_config", None if user_id is None else str(user_id))
+
+    def apply_invalidation(self, cache: str, user_id: Optional[str] = None):
+        """
+        Repeats a cache invalidation made by another handler on the same database (listeners are not notified again).
+
+        :param cache: "whitelist", "user_config" (of user_id, or of every user if None) or "table_metadata"
+        """
+        if cache == "whitelist":
+            self.whitelist_cache.invalidate()
+        elif cache == "user_config":
+            self.user_config_cache.invalidate(user_id)
+        elif cache == "table_metadata":
+            self._load_table_metadata()
+        else:
+            raise ValueError(f"Unknown cache: {cache}")
+
+    def _notify_invalidation(self, cache: str, user_id: Optional[str] = None):
+        for listener in self.invalidation_listeners:
+            try:
+                listener(cache, user_id)
+            except Exception as exc:
+                logger.exception(f'Could not publish the {cache} cache invalidation', exc_info=exc)
+
+    def whitelist_cache_stats(self) -> dict:
+        """:return: Hit/miss counters and current size of the whitelist cache"""
+        return self.whitelist_cache.stats()
 
     def whitelist_user(self, user_id: str):
         """
@@ -63,47 +140,74 @@ class DatabaseHandler:
         :param user_id: Telegram user ID (numerical string not their username)
         :param is_admin: Identifies whether or not the user has admin permissions.
         """
-        if not self.db.is_connected():
-            self.initialize_connection()
-
-        if user_id in self.load_whitelist():
+        outcome = self.whitelist_users([user_id]).get(str(user_id).strip())
+        if outcome == INVALID_USER_ID:
+            raise ValueError(f"Invalid user ID: {user_id}")
+        if outcome == ALREADY_WHITELISTED:
             raise AssertionError(f"User ({user_id}) is already whitelisted.")
 
-        # Build default values query string
-        values = ", ".join([column["default_value"] for column in DATABASE_SCHEMA["COLUMNS"]]).format(user_id)
-
-        self.cursor.execute(f"INSERT INTO {DATABASE_SCHEMA['TABLE_NAME']} VALUES ({values})")
-        self.db.commit()
-
     def blacklist_user(self, user_id: str):
-        if not self.db.is_connected():
-            self.initialize_connection()
-
-        if user_id not in self.load_whitelist():
+        outcome = self.blacklist_users([user_id]).get(str(user_id).strip())
+        if outcome == INVALID_USER_ID:
+            raise ValueError(f"Invalid user ID: {user_id}")
+        if outcome == NOT_WHITELISTED:
             raise AssertionError(f"User ({user_id}) is not on the whitelist.")
 
-        self.cursor.execute(f"DELETE FROM {DATABASE_SCHEMA['TABLE_NAME']} WHERE user_id = {user_id}")
-        self.db.commit()
+    def whitelist_users(self, user_ids: Iterable[str]) -> dict[str, str]:
+        """
+        Adds many users with one set-based membership query and one INSERT transaction.
 
-    def pull_user_config(self, user_id: str) -> dict:
+        :param user_ids: Telegram user IDs (duplicates are ignored)
+        :return: {user_id: outcome} in input order - WHITELISTED, ALREADY_WHITELISTED or INVALID_USER_ID
         """
-        :param user_id: Telegram user ID
-        :return: The current user configuration for the Bot
-                 NOTE: Boolean values will be represented as 1 = True, 0 = False
+        user_ids = normalize_user_ids(user_ids, self.backend.key_type)
+        valid = [user_id for user_id, is_valid in user_ids.items() if is_valid]
+        existing = self.backend.existing_users(valid)
+        new_users = [user_id for user_id in valid if user_id not in existing]
+        try:
+            if len(new_users) > 0:
+                self.backend.whitelist_users(new_users)
+        finally:
+            self.invalidate_whitelist_cache()
+        return {user_id: INVALID_USER_ID if not is_valid else ALREADY_WHITELISTED if user_id in existing
+                else WHITELISTED for user_id, is_valid in user_ids.items()}
+
+    def blacklist_users(self, user_ids: Iterable[str]) -> dict[str, str]:
         """
-        if not self.db.is_connected():
-            self.initialize_connection()
+        Removes many users with one set-based membership query and one DELETE transaction.
 
-        self.cursor.execute(f"SELECT * FROM {DATABASE_SCHEMA['TABLE_NAME']} WHERE user_id = {user_id}")
+        :param user_ids: Telegram user IDs (duplicates are ignored)
+        :return: {user_id: outcome} in input order - BLACKLISTED, NOT_WHITELISTED or INVALID_USER_ID
+        """
+        user_ids = normalize_user_ids(user_ids, self.backend.key_type)
+        existing = self.backend.existing_users([user_id for user_id, is_valid in user_ids.items() if is_valid])
         try:
-            config = [user for user in self.cursor][0]
-        except IndexError:
-            raise IndexError(f"User ({user_id}) not found in database.")
+            if len(existing) > 0:
+                self.backend.blacklist_users([user_id for user_id in user_ids if user_id in existing])
+        finally:
+            self.invalidate_whitelist_cache()
+            for user_id in existing:
+                self.invalidate_user_config_cache(user_id)
+        return {user_id: INVALID_USER_ID if not is_valid else BLACKLISTED if user_id in existing
+                else NOT_WHITELISTED for user_id, is_valid in user_ids.items()}
+
+    def pull_user_config(self, user_id: str) -> Mapping:
+        """
+        :param user_id: Telegram user ID
+        :return: The current user configuration for the Bot, as a read-only snapshot served from the config cache
+                 when possible (copy it with dict() to modify it)
+        """
+        cached = self.user_config_cache.get(user_id)
+        if cached is not None:
+            return cached
 
-        return {col[0]: val if 'bit(1)' not in str(col[1]).lower() else val == 1 for col, val in
-                zip(self.get_table_columns(), config)}
+        generation = self.user_config_cache.generation
+        config = self.backend.pull_user_config(user_id)
+        if config is None:
+            raise IndexError(f"User ({user_id}) not found in database.")
+        return self.user_config_cache.put(user_id, row_to_dict(self.table_metadata, config), generation)
 
-    def update_user_config(self, user_id: str, config_name: str, new_value) -> dict:
+    def update_user_config(self, user_id: str, config_name: str, new_value) -> Mapping:
         """
         Updates config settings in the database for the given user.
 
@@ -113,75 +217,134 @@ class DatabaseHandler:
         :return: The updated user config for the given user_id
                  NOTE: Bools will be represented as 1 = True, 0 = False
         """
-        if not self.db.is_connected():
-            self.initialize_connection()
+        return self.update_user_configs(user_id, {config_name: new_value})
 
-        if type(new_value) is str:
-            # Enclose strings in single quotes to avoid errors
-            new_value = f"'{new_value}'"
-        elif type(new_value) is bool:
-            new_value = 1 if new_value else 0
-        self.cursor.execute(f"UPDATE {DATABASE_SCHEMA['TABLE_NAME']} SET {config_name} = {new_value} WHERE user_id = {user_id}")
-        self.cursor.execute("COMMIT")
+    def update_user_configs(self, user_id: str, changes: dict) -> Mapping:
+        """
+        Applies several config changes for the given user in a single parameterized UPDATE and transaction.
 
-        return self.pull_user_config(user_id)
+        :param user_id: Telegram user ID
+        :param changes: {config_name: new_value} - values are validated against the column types
+        :return: The updated user config for the given user_id
+        """
+        if len(changes) == 0:
+            return self.pull_user_config(user_id)
 
-    def get_table_columns(self) -> list[tuple]:
-        """Returns the ordered names of all table columns"""
-        if not self.db.is_connected():
-            self.initialize_connection()
+        # Validate every change before touching the database so the update is all-or-nothing
+        values = {config_name: to_db_value(self.coerce_config_value(config_name, value))
+                  for config_name, value in changes.items()}
 
-        self.cursor.execute(f"DESCRIBE {DATABASE_SCHEMA['TABLE_NAME']}")
-        return [(col[0], col[1]) for col in self.cursor]
+        try:
+            row = self.backend.update_user_config(user_id, values)
+        finally:
+            self.invalidate_user_config_cache(user_id)
+        if row is None:
+            raise IndexError(f"User ({user_id}) not found in database.")
+        return MappingProxyType(row_to_dict(self.table_metadata, row))
+
+    def coerce_config_value(self, config_name: str, value):
+        """
+        Validates a config change against the cached column metadata.
+
+        :param config_name: Config column name (exact)
+        :param value: New value - strings (e.g. parsed from a Telegram message) are converted to the column type
+        :return: The value converted to the Python type of the column
+        """
+        try:
+            column = self.table_columns[config_name]
+        except KeyError:
+            raise KeyError(f"{config_name} does not match any available config settings in database.")
+        if column.name == "user_id":
+            raise KeyError("user_id can not be changed.")
+        return coerce_value(column, value)
+
+    def get_table_columns(self) -> list[tuple]:
+        """Returns the ordered (name, type) tuples of all table columns"""
+        return self.backend.get_table_columns()
+
+    @property
+    def table_metadata(self) -> list[ColumnMetadata]:
+        """Cached column metadata of the user table (loaded on first access if startup could not load it)"""
+        if self._table_metadata is None:
+            self.refresh_table_metadata()
+        return self._table_metadata
+
+    def get_table_metadata(self) -> list[ColumnMetadata]:
+        """Cached column metadata of the user table (see table_metadata and AsyncDatabaseHandler.get_table_metadata)"""
+        return self.table_metadata
+
+    @property
+    def table_columns(self) -> dict[str, ColumnMetadata]:
+        """Cached column metadata of the user table, keyed by column name"""
+        if self._table_metadata is None:
+            self.refresh_table_metadata()
+        return self._table_columns
+
+    def refresh_table_metadata(self) -> list[ColumnMetadata]:
+        """Reloads the cached column metadata from the live table (call after altering the table)"""
+        metadata = self._load_table_metadata()
+        self._notify_invalidation("table_metadata")
+        return metadata
+
+    def _load_table_metadata(self) -> list[ColumnMetadata]:
+        metadata = build_column_metadata(self.get_table_columns())
+        self._table_columns = {column.name: column for column in metadata}
+        self._table_metadata = metadata
+        # Cached configs were decoded with the previous columns
+        self.user_config_cache.invalidate()
+        return metadata
 
     """----- UTIL/DEBUG FUNCTIONS BELOW -----"""
     def view_table_entries(self, table_name: str):
-        if not self.db.is_connected():
-            self.initialize_connection()
-
-        self.cursor.execute(f"SELECT * FROM {table_name}")
-        for x in self.cursor:
-            print(x)
+        with self.pool.cursor() as (db, cursor):
+            cursor.execute(f"SELECT * FROM {table_name}")
+            for x in cursor:
+                print(x)
 
     def describe_table(self, table_name: str):
-        if not self.db.is_connected():
-            self.initialize_connection()
-
-        self.cursor.execute(f"DESCRIBE {table_name}")
-        for x in self.cursor:
-            print(x)
+        with self.pool.cursor() as (db, cursor):
+            cursor.execute(f"DESCRIBE {table_name}")
+            for x in cursor:
+                print(x)
 
     def show_databases(self):
         """Used for debugging"""
-        if not self.db.is_connected():
-            self.initialize_connection()
-
-        self.cursor.execute("SHOW DATABASES")
-        for x in self.cursor:
-            print(x)
+        with self.pool.cursor() as (db, cursor):
+            cursor.execute("SHOW DATABASES")
+            for x in cursor:
+                print(x)
 
     def remove_table(self, table_name: str):
-        if not self.db.is_connected():
-            self.initialize_connection()
-
-        self.cursor.execute(f"DROP TABLE {table_name}")
+        with self.pool.cursor() as (db, cursor):
+            cursor.execute(f"DROP TABLE {table_name}")
 
     def add_column(self, column_name: str, data_type: str, default_value: Optional):
         """
         :param column_name: The name of the new column
         :param data_type: The MySQL datatype (case sensitive) for entries in the new column
-        :param default_value: The default value for entries in the new column (wrap strings in single quotes)
+        :param default_value: The default value for entries in the new column (wrap strings in single quotes) -
+                              applied as a server-side default or backfilled in batches, never in one full-table UPDATE
         """
-        self.cursor.execute(f"ALTER TABLE {DATABASE_SCHEMA['TABLE_NAME']} "
-                            f"ADD COLUMN {column_name} {data_type} NOT NULL")
-        self.set_column_values(column_name, default_value)
+        self.backend.add_column(column_name, data_type, default_value)
+        self.refresh_table_metadata()
 
     def remove_column(self, column_name: str):
-        self.cursor.execute(f"ALTER TABLE {DATABASE_SCHEMA['TABLE_NAME']} DROP COLUMN {column_name}")
+        self.backend.remove_column(column_name)
+        self.refresh_table_metadata()
 
     def set_column_values(self, column_name: str, value: Optional):
-        self.cursor.execute(f"UPDATE {DATABASE_SCHEMA['TABLE_NAME']} SET {column_name} = {value}")
-        self.cursor.execute("COMMIT")
+        try:
+            self.backend.set_column_values(column_name, value)
+        finally:
+            self.invalidate_user_config_cache()
+
+    def user_config_cache_stats(self) -> dict:
+        """:return: Hit/miss/eviction counters, hit rate and current size of the user config cache"""
+        return self.user_config_cache.stats()
+
+    def pool_stats(self) -> dict:
+        """:return: Size, idle connection count and number of reconnects of the connection pool"""
+        return self.backend.stats()
 
     def close(self):
-        self.cursor.close()
+        self.backend.close()
@@ -3,7 +3,7 @@
 DATABASE_SCHEMA = {
     "TABLE_NAME": "Users",
     "COLUMNS": [
-        dict(column_name="user_id", datatype="TINYTEXT", default_value="{}"),  # To be formatted to Telegram user ID
+        dict(column_name="user_id", datatype="BIGINT", default_value="{}", primary_key=True),  # Telegram user ID
         dict(column_name="contract_type", datatype="TINYTEXT", default_value="'option'"),
         dict(column_name="loop_count", datatype="INT(10)", default_value="10000"),
         dict(column_name="max_qty", datatype="INT(10)", default_value="4"),
@@ -17,6 +17,10 @@ DATABASE_SCHEMA = {
     ]
 }
 
-# To add settings, add a new dict constructor to the end of the "COLUMNS" list
+# To add settings, add a new dict constructor to the end of the "COLUMNS" list - on the next start the new column is
+# added to the live table with its default value (see migrations.py)
 
 # BIT(1) datatype columns are currently presumed to be boolean values, with 1 == True and 0 == False
+
+# The primary_key column (user_id) is the lookup key of every query - Telegram user IDs are numbers, so keep it an
+# integer type (BIGINT) that can be indexed
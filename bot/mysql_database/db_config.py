@@ -1,12 +1,34 @@
 import os
 
-"""----- Database Configuration -----"""
+"""----- Storage Backend Configuration -----"""
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql")  # "mysql" (external server) or "sqlite" (embedded database file, WAL mode)
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "bot.sqlite3")  # Database file of the SQLite backend
+
+"""----- Database Configuration (MySQL backend) -----"""
 DB_PASSWORD = os.getenv("MYSQL_DB_PASSWORD", "<or-hardcode-here>")
 DB_HOST = os.getenv("MYSQL_DB_HOST_IP", "<or-hardcode-here>")
 DB_USER = os.getenv("MYSQL_DB_HOST_IP", "root")
 DB_NAME = os.getenv("DB_NAME", "<or-hardcode-here>")
 DB_TABLE = os.getenv("DB_NAME", "<or-hardcode-here>")  # The table name in the database in which user data is stored
 
+"""----- Connection Pool Configuration -----"""
+# Pooled connections - one per handler thread by default (TG_HANDLER_WORKERS of tg_config, read here so the database
+# package does not depend on the bot's configuration), so no handler waits for a connection
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", os.getenv("TG_HANDLER_WORKERS", 8)))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # Seconds to wait for a free connection
+DB_ASYNC_POOL_SIZE = int(os.getenv("DB_ASYNC_POOL_SIZE", 20))  # Maximum pooled connections for the asyncio engine
+
+"""----- Schema Migration Configuration -----"""
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"  # Migrate the user table to DATABASE_SCHEMA on startup
+DB_MIGRATION_BATCH_SIZE = int(os.getenv("DB_MIGRATION_BATCH_SIZE", 1000))  # Rows per transaction when backfilling
+
+"""----- Cache Configuration -----"""
+WHITELIST_CACHE_TTL = float(os.getenv("WHITELIST_CACHE_TTL", 60))  # In seconds (0 disables the whitelist cache)
+USER_CONFIG_CACHE_SIZE = int(os.getenv("USER_CONFIG_CACHE_SIZE", 1024))  # Users whose decoded config is kept cached
+USER_CONFIG_CACHE_TTL = float(os.getenv("USER_CONFIG_CACHE_TTL", 300))  # In seconds (0 disables the config cache)
+
 
-for var in [DB_PASSWORD, DB_HOST, DB_USER, DB_NAME, DB_TABLE]:
-    assert var != "<or-hardcode-here>"
\ No newline at end of file
+assert DB_BACKEND in ("mysql", "sqlite")
+if DB_BACKEND == "mysql":
+    for var in [DB_PASSWORD, DB_HOST, DB_USER, DB_NAME, DB_TABLE]:
+        assert var != "<or-hardcode-here>"
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""
+Schema migrations for the user table, planned by diffing DATABASE_SCHEMA against the live table.
+
+Applied migrations are recorded in the schema_migrations table together with a fingerprint of DATABASE_SCHEMA, so a
+start with an unchanged schema costs a single lookup instead of a diff. Migrations only ever create the table, fix the
+key column and add missing columns; type changes of other columns and columns missing from the schema are logged
+and left for the operator (dropping or converting them could lose data).
+"""
+
+import hashlib
+import json
+from datetime import datetime
+from typing import Callable, NamedTuple
+
+from .database_schema import DATABASE_SCHEMA
+from .storage_backends import StorageBackend, create_backend, key_column
+from .._logger import logger
+
+MIGRATIONS_TABLE = "schema_migrations"
+
+
+class Migration(NamedTuple):
+    name: str  # Recorded in schema_migrations, e.g. "add_column:Users.max_qty"
+    description: str
+    apply: Callable[[], None]
+
+
+def schema_fingerprint(schema: dict = DATABASE_SCHEMA) -> str:
+    return hashlib.sha1(json.dumps(schema, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _base_type(datatype) -> str:
+    # "INT(10)" == "int" (MySQL 8 omits display widths) and "FLOAT(6)" == "float"
+    if isinstance(datatype, (bytes, bytearray)):
+        datatype = datatype.decode()
+    return str(datatype).lower().split('(')[0].split(' ')[0].strip()
+
+
+class SchemaMigrator:
+    def __init__(self, backend: StorageBackend, schema: dict = DATABASE_SCHEMA):
+        """
+        :param backend: Storage backend holding the user table (with an initialized connection pool)
+        :param schema: Target schema (see database_schema.py)
+        """
+        self.backend = backend
+        self.schema = schema
+        self.table = schema["TABLE_NAME"]
+
+    def ensure_migrations_table(self):
+        with self.backend.pool.cursor() as (db, cursor):
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} "
+                           f"(name VARCHAR(191) NOT NULL PRIMARY KEY, applied_at VARCHAR(32) NOT NULL)")
+
+    def applied_migrations(self) -> list[str]:
+        """:return: Names of the recorded migrations, oldest first"""
+        with self.backend.pool.cursor() as (db, cursor):
+            cursor.execute(f"SELECT name FROM {MIGRATIONS_TABLE} ORDER BY applied_at")
+            return [row[0] for row in cursor]
+
+    def record(self, name: str):
+        placeholder = self.backend.placeholder
+        with self.backend.pool.cursor() as (db, cursor):
+            cursor.execute(f"INSERT INTO {MIGRATIONS_TABLE} (name, applied_at) VALUES ({placeholder}, {placeholder})",
+                           (name, datetime.utcnow().isoformat(sep=' ', timespec='seconds')))
+            db.commit()
+
+    def plan(self) -> list[Migration]:
+        """:return: The migrations needed to bring the live table in line with the schema, in order"""
+        backend = self.backend
+        if not backend.table_exists(self.table):
+            return [Migration(f"create_table:{self.table}", f"Create table {self.table}", backend.create_table)]
+
+        live_types = {name: _base_type(datatype) for name, datatype in backend.get_table_columns()}
+        migrations = []
+
+        key = key_column(self.schema)
+        key_name = key['column_name']
+        retype = live_types.get(key_name) != _base_type(key['datatype'])
+        add_primary_key = backend.primary_key_columns() != [key_name]
+        if retype or add_primary_key:
+            migrations.append(Migration(
+                f"key:{self.table}.{key_name}:{_base_type(key['datatype'])}",
+                f"Make {key_name} a {key['datatype']} primary key (was {live_types.get(key_name)})",
+                lambda: backend.migrate_key(key, retype, add_primary_key)))
+
+        for column in self.schema["COLUMNS"]:
+            name = column['column_name']
+            if name not in live_types:
+                migrations.append(Migration(
+                    f"add_column:{self.table}.{name}",
+                    f"Add column {name} {column['datatype']} (default {column['default_value']})",
+                    lambda column=column: backend.add_column(column['column_name'], column['datatype'],
+                                                             column['default_value'])))
+            elif column is not key and live_types[name] != _base_type(column['datatype']):
+                logger.warning(f"Column {self.table}.{name} is {live_types[name]} but the schema declares "
+                               f"{column['datatype']} - convert it manually")
+
+        schema_columns = {column['column_name'] for column in self.schema["COLUMNS"]}
+        for name in live_types:
+            if name not in schema_columns:
+                logger.warning(f"Column {self.table}.{name} is not in DATABASE_SCHEMA - remove it manually "
+                               f"(see DatabaseHandler.remove_column)")
+        return migrations
+
+    def migrate(self, force: bool = False) -> list[str]:
+        """
+        Applies the planned migrations, recording each of them and finally the schema fingerprint.
+
+        :param force: Diff the live table even if the current schema fingerprint is already recorded
+                      (e.g. after the table was altered by hand)
+        :return: Names of the applied migrations
+        """
+        self.ensure_migrations_table()
+        applied = set(self.applied_migrations())
+        fingerprint = f"schema:{schema_fingerprint(self.schema)}"
+        if fingerprint in applied and not force:
+            return []
+
+        done = []
+        for migration in self.plan():
+            logger.info(f"Applying migration {migration.name}: {migration.description}")
+            migration.apply()
+            if migration.name not in applied:
+                self.record(migration.name)
+                applied.add(migration.name)
+            done.append(migration.name)
+        if fingerprint not in applied:
+            self.record(fingerprint)
+        return done
+
+
+def run_migrations(force: bool = False) -> list[str]:
+    """Migrates the database selected by DB_BACKEND over a short-lived single connection (see SchemaMigrator)"""
+    backend = create_backend(pool_size=1)
+    backend.initialize_connection()
+    try:
+        return SchemaMigrator(backend).migrate(force)
+    finally:
+        backend.close()
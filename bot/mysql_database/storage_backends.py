@@ -0,0 +1,471 @@
+"""
+Storage backends behind DatabaseHandler.
+
+A backend owns the connection pool and runs the SQL for one database engine; validation, caching and row decoding
+stay in DatabaseHandler (and AsyncDatabaseHandler). Both backends create and address the user table from
+DATABASE_SCHEMA, and are selected with DB_BACKEND (see db_config.py). AsyncMySQLBackend runs the same queries on an
+aiomysql pool for the asyncio engine.
+"""
+
+import asyncio
+import functools
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Optional
+
+from .db_config import (DB_BACKEND, DB_POOL_SIZE, DB_POOL_TIMEOUT, SQLITE_DB_PATH, DB_MIGRATION_BATCH_SIZE,
+                        DB_ASYNC_POOL_SIZE, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME)
+from .database_schema import DATABASE_SCHEMA
+from .connection_pool import ConnectionPool, connect_mysql
+from .table_metadata import build_column_metadata
+from ..steps import run_steps, run_steps_async
+
+
+def key_column(schema: dict = DATABASE_SCHEMA) -> dict:
+    """:return: The schema column marked as primary key (the user_id column if none is marked)"""
+    for column in schema["COLUMNS"]:
+        if column.get("primary_key"):
+            return column
+    return next(column for column in schema["COLUMNS"] if column["column_name"] == "user_id")
+
+
+def key_type(schema: dict = DATABASE_SCHEMA) -> type:
+    """:return: Python type user IDs are bound as, so lookups compare like types and can use the primary key"""
+    return build_column_metadata([(key_column(schema)["column_name"], key_column(schema)["datatype"])])[0].python_type
+
+
+def to_key(user_id, user_key_type: type):
+    try:
+        return user_key_type(user_id)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid user ID: {user_id}")
+
+
+# Per user outcomes of the bulk whitelist/blacklist operations
+WHITELISTED = "whitelisted"
+ALREADY_WHITELISTED = "already whitelisted"
+BLACKLISTED = "blacklisted"
+NOT_WHITELISTED = "not whitelisted"
+INVALID_USER_ID = "invalid user ID"
+
+
+def normalize_user_ids(user_ids: Iterable, user_key_type: type) -> dict[str, bool]:
+    """:return: {user_id: is_valid} of the unique, stripped user IDs in input order"""
+    normalized = {}
+    for user_id in user_ids:
+        user_id = str(user_id).strip()
+        if len(user_id) > 0 and user_id not in normalized:
+            try:
+                to_key(user_id, user_key_type)
+                normalized[user_id] = True
+            except ValueError:
+                normalized[user_id] = False
+    return normalized
+
+
+def column_definitions(schema: dict = DATABASE_SCHEMA) -> str:
+    """:return: Column definitions (including the primary key) for CREATE TABLE"""
+    key = key_column(schema)
+    definitions = [f"{column['column_name']} {column['datatype']}{' NOT NULL' if column is key else ''}"
+                   for column in schema["COLUMNS"]]
+    return ", ".join(definitions + [f"PRIMARY KEY ({key['column_name']})"])
+
+
+def query(operation: Callable) -> Callable:
+    """
+    (Decorator) Turns a generator method taking (connection, cursor, *args) into a backend method taking (*args),
+    run on a borrowed connection by StorageBackend.run. The generator yields every cursor/connection call (see
+    steps.py), so the statements are written once for the blocking and the asyncio backends.
+    """
+
+    @functools.wraps(operation)
+    def method(self, *args, **kwargs):
+        return self.run(functools.partial(operation, self), *args, **kwargs)
+
+    return method
+
+
+class StorageBackend(ABC):
+    """
+    Runs the user table queries for one database engine.
+
+    Rows are returned as tuples in table column order (see DatabaseHandler for the decoded dicts). Subclasses set the
+    query placeholder style and implement the engine specific statements.
+    """
+
+    placeholder = "%s"
+    insert_ignore = "INSERT IGNORE"  # INSERT variant that skips rows whose key already exists
+    # Maximum number of user IDs bound in a single IN (...) list
+    max_bound_keys = 500
+
+    def __init__(self, pool_size: int = DB_POOL_SIZE):
+        """:param pool_size: Number of pooled connections (each operation borrows one)"""
+        self.pool_size = pool_size
+        self.pool: Optional[ConnectionPool] = None
+        self.table = DATABASE_SCHEMA['TABLE_NAME']
+        self.key_type = key_type()
+
+    def _key(self, user_id):
+        return to_key(user_id, self.key_type)
+
+    @abstractmethod
+    def create_pool(self) -> ConnectionPool:
+        """:return: A new connection pool for this backend"""
+
+    def run(self, operation: Callable, *args, **kwargs):
+        """:return: The result of a query operation (see query), run on a connection borrowed from the pool"""
+        with self.pool.cursor() as (db, cursor):
+            return run_steps(operation(db, cursor, *args, **kwargs))
+
+    @abstractmethod
+    def get_table_columns(self) -> list[tuple]:
+        """:return: Ordered (column_name, column_type) tuples of the user table"""
+
+    @abstractmethod
+    def add_column(self, column_name: str, data_type: str, default_value: Optional):
+        """Adds a column, setting every existing row to default_value (an SQL literal) without a full table rewrite"""
+
+    @abstractmethod
+    def table_exists(self, table: str) -> bool:
+        pass
+
+    @abstractmethod
+    def primary_key_columns(self) -> list[str]:
+        """:return: Names of the primary key columns of the user table (empty if it has none)"""
+
+    @abstractmethod
+    def migrate_key(self, column: dict, retype: bool, add_primary_key: bool):
+        """
+        Converts the key column of the user table to the schema type and/or makes it the primary key.
+
+        :param column: Schema definition of the key column
+        :param retype: Whether the live column type differs from the schema
+        :param add_primary_key: Whether the column has to become the primary key
+        """
+
+    def initialize_connection(self):
+        """(Re)creates the connection pool, retrying with backoff if the database is unreachable"""
+        try:
+            self.close()
+        except Exception:
+            pass
+        finally:
+            self.pool = self.create_pool()
+
+    @query
+    def create_table(self, db, cursor):
+        yield cursor.execute(f"CREATE TABLE {self.table} ({column_definitions()})")
+
+    @query
+    def load_whitelist(self, db, cursor) -> list[str]:
+        yield cursor.execute(f"SELECT user_id FROM {self.table}")
+        users = yield cursor.fetchall()
+        return [str(user[0]) for user in users]
+
+    @query
+    def whitelist_user(self, db, cursor, user_id: str):
+        """Inserts a row for the user with the schema default values"""
+        # The user_id column's default value is the "{}" template - bound as a parameter instead of formatted in
+        values = ", ".join([column["default_value"] for column in DATABASE_SCHEMA["COLUMNS"]]).format(self.placeholder)
+        yield cursor.execute(f"INSERT INTO {self.table} VALUES ({values})", (self._key(user_id),))
+        yield db.commit()
+
+    @query
+    def blacklist_user(self, db, cursor, user_id: str):
+        yield cursor.execute(f"DELETE FROM {self.table} WHERE user_id = {self.placeholder}", (self._key(user_id),))
+        yield db.commit()
+
+    @query
+    def existing_users(self, db, cursor, user_ids: list[str]) -> set[str]:
+        """:return: The given user IDs that are in the table (one IN query per max_bound_keys IDs)"""
+        existing = set()
+        for start in range(0, len(user_ids), self.max_bound_keys):
+            chunk = [self._key(user_id) for user_id in user_ids[start:start + self.max_bound_keys]]
+            yield cursor.execute(f"SELECT user_id FROM {self.table} WHERE user_id IN "
+                                 f"({', '.join([self.placeholder] * len(chunk))})", chunk)
+            rows = yield cursor.fetchall()
+            existing.update(str(row[0]) for row in rows)
+        return existing
+
+    @query
+    def whitelist_users(self, db, cursor, user_ids: list[str]):
+        """Inserts rows with the schema default values for all users in one transaction (existing users are skipped)"""
+        if len(user_ids) == 0:
+            return
+        values = ", ".join([column["default_value"] for column in DATABASE_SCHEMA["COLUMNS"]]).format(self.placeholder)
+        yield cursor.executemany(f"{self.insert_ignore} INTO {self.table} VALUES ({values})",
+                                 [(self._key(user_id),) for user_id in user_ids])
+        yield db.commit()
+
+    @query
+    def blacklist_users(self, db, cursor, user_ids: list[str]):
+        """Deletes the rows of all users in one transaction"""
+        if len(user_ids) == 0:
+            return
+        yield cursor.executemany(f"DELETE FROM {self.table} WHERE user_id = {self.placeholder}",
+                                 [(self._key(user_id),) for user_id in user_ids])
+        yield db.commit()
+
+    @query
+    def pull_user_config(self, db, cursor, user_id: str) -> Optional[tuple]:
+        """:return: The user's row, or None if the user is not in the table"""
+        yield cursor.execute(f"SELECT * FROM {self.table} WHERE user_id = {self.placeholder}", (self._key(user_id),))
+        return (yield cursor.fetchone())
+
+    @query
+    def update_user_config(self, db, cursor, user_id: str, values: dict) -> Optional[tuple]:
+        """
+        Applies {config_name: db_value} in a single parameterized UPDATE and transaction.
+
+        :return: The updated row, or None (rolled back) if the user is not in the table
+        """
+        key = self._key(user_id)
+        assignments = ", ".join(f"{config_name} = {self.placeholder}" for config_name in values)
+        yield cursor.execute(f"UPDATE {self.table} SET {assignments} WHERE user_id = {self.placeholder}",
+                             (*values.values(), key))
+        yield cursor.execute(f"SELECT * FROM {self.table} WHERE user_id = {self.placeholder}", (key,))
+        row = yield cursor.fetchone()
+        if row is None:
+            yield db.rollback()
+            return None
+        yield db.commit()
+        return row
+
+    @query
+    def remove_column(self, db, cursor, column_name: str):
+        yield cursor.execute(f"ALTER TABLE {self.table} DROP COLUMN {column_name}")
+
+    @query
+    def set_column_values(self, db, cursor, column_name: str, value: Optional):
+        yield cursor.execute(f"UPDATE {self.table} SET {column_name} = {value}")
+        yield db.commit()
+
+    def stats(self) -> dict:
+        """:return: Size, idle connection count and number of reconnects of the connection pool"""
+        return self.pool.stats()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+
+class MySQLBackend(StorageBackend):
+    """User table on an external MySQL server (mysql.connector)"""
+
+    def __init__(self, pool_size: int = DB_POOL_SIZE, connect: Callable = connect_mysql):
+        """
+        :param pool_size: Number of pooled MySQL connections
+        :param connect: Callable returning a new DB-API connection (defaults to the configured MySQL database)
+        """
+        super().__init__(pool_size)
+        self._connect = connect
+
+    def create_pool(self) -> ConnectionPool:
+        return ConnectionPool(size=self.pool_size, connect=self._connect, checkout_timeout=DB_POOL_TIMEOUT)
+
+    @query
+    def get_table_columns(self, db, cursor) -> list[tuple]:
+        yield cursor.execute(f"DESCRIBE {self.table}")
+        columns = yield cursor.fetchall()
+        return [(col[0], col[1]) for col in columns]
+
+    def add_column(self, column_name: str, data_type: str, default_value: Optional):
+        if data_type.split('(')[0].strip().lower().endswith(('text', 'blob')):
+            # TEXT/BLOB columns can not have a literal DEFAULT - backfill existing rows in bounded batches instead
+            with self.pool.cursor() as (db, cursor):
+                cursor.execute(f"ALTER TABLE {self.table} ADD COLUMN {column_name} {data_type}")
+            self.backfill_column(column_name, default_value)
+        else:
+            # Existing rows read the server-side default - an in-place (INSTANT) change on MySQL 8, no row rewrite
+            with self.pool.cursor() as (db, cursor):
+                cursor.execute(f"ALTER TABLE {self.table} ADD COLUMN {column_name} {data_type} NOT NULL "
+                               f"DEFAULT {default_value}")
+
+    def backfill_column(self, column_name: str, value: Optional, batch_size: int = DB_MIGRATION_BATCH_SIZE):
+        """Sets the NULL values of a column to value in batches of batch_size rows (one transaction per batch)"""
+        if value is None or str(value).upper() == "NULL":
+            return
+        while True:
+            with self.pool.cursor() as (db, cursor):
+                cursor.execute(f"UPDATE {self.table} SET {column_name} = {value} WHERE {column_name} IS NULL "
+                               f"LIMIT {int(batch_size)}")
+                updated = cursor.rowcount
+                db.commit()
+            if updated < batch_size:
+                break
+
+    @query
+    def table_exists(self, db, cursor, table: str) -> bool:
+        yield cursor.execute("SHOW TABLES LIKE %s", (table,))
+        return (yield cursor.fetchone()) is not None
+
+    @query
+    def primary_key_columns(self, db, cursor) -> list[str]:
+        yield cursor.execute(f"DESCRIBE {self.table}")
+        columns = yield cursor.fetchall()
+        return [col[0] for col in columns if col[3] == 'PRI']
+
+    def migrate_key(self, column: dict, retype: bool, add_primary_key: bool):
+        changes = []
+        if retype:
+            changes.append(f"MODIFY COLUMN {column['column_name']} {column['datatype']} NOT NULL")
+        if add_primary_key:
+            if len(self.primary_key_columns()) > 0:
+                changes.append("DROP PRIMARY KEY")
+            changes.append(f"ADD PRIMARY KEY ({column['column_name']})")
+        if len(changes) > 0:
+            with self.pool.cursor() as (db, cursor):
+                cursor.execute(f"ALTER TABLE {self.table} {', '.join(changes)}")
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    User table in an embedded SQLite database file - no server, and lookups never leave the process.
+
+    The database runs in WAL mode so readers do not block the writer (and vice versa); writers are serialized by
+    SQLite and wait up to DB_POOL_TIMEOUT seconds for the write lock. The MySQL column types of DATABASE_SCHEMA map
+    onto SQLite type affinities (TINYTEXT -> TEXT, FLOAT(6) -> REAL, INT/BIT -> INTEGER/NUMERIC).
+    """
+
+    placeholder = "?"
+    insert_ignore = "INSERT OR IGNORE"
+
+    def __init__(self, path: str = SQLITE_DB_PATH, pool_size: int = DB_POOL_SIZE, connect: Optional[Callable] = None):
+        """
+        :param path: Database file (created if missing)
+        :param pool_size: Number of pooled SQLite connections
+        :param connect: Callable returning a new DB-API connection (defaults to connect_sqlite(path))
+        """
+        super().__init__(pool_size)
+        self.path = path
+        self._connect = connect or (lambda: connect_sqlite(self.path))
+
+    def create_pool(self) -> ConnectionPool:
+        # SQLite connections never drop, and its OperationalError (e.g. "database is locked") is not a disconnect
+        return ConnectionPool(size=self.pool_size, connect=self._connect, checkout_timeout=DB_POOL_TIMEOUT,
+                              is_alive=lambda conn: True, disconnect_errors=())
+
+    @query
+    def get_table_columns(self, db, cursor) -> list[tuple]:
+        yield cursor.execute("SELECT name, type FROM pragma_table_info(?)", (self.table,))
+        columns = yield cursor.fetchall()
+        return [(col[0], col[1]) for col in columns]
+
+    @query
+    def add_column(self, db, cursor, column_name: str, data_type: str, default_value: Optional):
+        # The default is stored in the schema only - existing rows read it without being rewritten
+        yield cursor.execute(f"ALTER TABLE {self.table} ADD COLUMN {column_name} {data_type} NOT NULL "
+                             f"DEFAULT {default_value}")
+
+    @query
+    def table_exists(self, db, cursor, table: str) -> bool:
+        yield cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        return (yield cursor.fetchone()) is not None
+
+    @query
+    def primary_key_columns(self, db, cursor) -> list[str]:
+        yield cursor.execute("SELECT name FROM pragma_table_info(?) WHERE pk > 0 ORDER BY pk", (self.table,))
+        columns = yield cursor.fetchall()
+        return [col[0] for col in columns]
+
+    def migrate_key(self, column: dict, retype: bool, add_primary_key: bool):
+        # SQLite can not alter a column or add a primary key in place - copy the rows into a rebuilt table.
+        # Values that look like integers are stored as integers by the column affinity; duplicates abort the copy
+        key_name = column['column_name']
+        live_columns = self.get_table_columns()
+        definitions = [f"{name} {column['datatype']} NOT NULL" if name == key_name else f"{name} {datatype}"
+                       for name, datatype in live_columns]
+        names = ", ".join(name for name, _ in live_columns)
+        with self.pool.cursor() as (db, cursor):
+            cursor.execute("BEGIN")
+            cursor.execute(f"CREATE TABLE {self.table}__rebuild ({', '.join(definitions)}, PRIMARY KEY ({key_name}))")
+            cursor.execute(f"INSERT INTO {self.table}__rebuild ({names}) SELECT {names} FROM {self.table}")
+            cursor.execute(f"DROP TABLE {self.table}")
+            cursor.execute(f"ALTER TABLE {self.table}__rebuild RENAME TO {self.table}")
+            db.commit()
+
+
+def _aiomysql():
+    # Imported on first use - only the asyncio engine needs aiomysql
+    import aiomysql
+    return aiomysql
+
+
+class AsyncMySQLBackend(MySQLBackend):
+    """
+    MySQL backend of the asyncio engine - runs the same queries on an aiomysql pool, so every query method returns an
+    awaitable instead of blocking.
+
+    Only the queries defined with @query can be awaited; schema migrations (add_column, migrate_key, ...) are blocking
+    DDL and run over a MySQLBackend instead (see migrations.run_migrations).
+    """
+
+    def __init__(self, pool_size: int = DB_ASYNC_POOL_SIZE):
+        """:param pool_size: Maximum number of pooled MySQL connections (each in-flight operation borrows one)"""
+        super().__init__(pool_size)
+
+    async def create_pool(self):
+        return await _aiomysql().create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME,
+                                             minsize=1, maxsize=self.pool_size, pool_recycle=3600)
+
+    async def initialize_connection(self, max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 8):
+        """(Re)creates the connection pool, retrying with exponential backoff if the database is unreachable"""
+        await self.close()
+        exc = None
+        for attempt in range(max_retries):
+            try:
+                self.pool = await self.create_pool()
+                return
+            except Exception as err:
+                exc = err
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(min(backoff_max, backoff_base * 2 ** attempt))
+        raise _aiomysql().DatabaseError(f"Could not connect to MySQL database after {max_retries} retries"
+                                         f"{f' - Error: {exc}' if exc is not None else ''}")
+
+    async def run(self, operation: Callable, *args, **kwargs):
+        """:return: The result of a query operation (see query), awaiting its calls on a borrowed connection"""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                try:
+                    return await run_steps_async(operation(conn, cursor, *args, **kwargs))
+                finally:
+                    # Also after plain reads - an open transaction keeps its REPEATABLE READ snapshot (and aiomysql
+                    # closes connections released mid-transaction)
+                    await conn.rollback()
+
+    def stats(self) -> dict:
+        """:return: Size and idle connection count of the connection pool"""
+        if self.pool is None:
+            return {"size": 0, "idle": 0}
+        return {"size": self.pool.size, "idle": self.pool.freesize}
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+
+def connect_sqlite(path: str = SQLITE_DB_PATH) -> sqlite3.Connection:
+    """Opens a connection to the SQLite database file in WAL mode"""
+    # Pooled connections are borrowed by different handler threads (never by two at once)
+    conn = sqlite3.connect(path, timeout=DB_POOL_TIMEOUT, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # Durable across application crashes; fsyncs only at checkpoints
+    return conn
+
+
+def database_errors() -> tuple:
+    """:return: Exception types raised by a failing database (mysql.connector's only once it was imported)"""
+    mysql_errors = sys.modules.get("mysql.connector.errors")
+    return (sqlite3.DatabaseError,) if mysql_errors is None else (sqlite3.DatabaseError, mysql_errors.DatabaseError)
+
+
+def create_backend(name: str = DB_BACKEND, **kwargs) -> StorageBackend:
+    """:return: The storage backend selected by name ("mysql" or "sqlite")"""
+    backends = {"mysql": MySQLBackend, "sqlite": SQLiteBackend}
+    if name not in backends:
+        raise ValueError(f"Unknown storage backend: {name} (available: {', '.join(backends)})")
+    return backends[name](**kwargs)
@@ -0,0 +1,75 @@
+"""Column metadata for the user table, resolved once from DESCRIBE output and reused for every row conversion"""
+
+from typing import Any, Callable, NamedTuple, Optional
+
+
+class ColumnMetadata(NamedTuple):
+    name: str
+    datatype: str  # Lowercase MySQL column type, e.g. "int(10)", "bit(1)", "tinytext"
+    python_type: type  # Python type values of this column are converted to when set by users
+    decoder: Optional[Callable[[Any], Any]]  # Converts raw DB values (None = pass through unchanged)
+
+
+def _decode_bit(value) -> bool:
+    # BIT(1) columns are presumed to be booleans (see database_schema.py)
+    if isinstance(value, (bytes, bytearray)):
+        return int.from_bytes(value, 'big') == 1
+    return value == 1
+
+
+def _python_type(datatype: str) -> type:
+    base_type = datatype.split('(')[0].strip()
+    if datatype.startswith('bit(1)') or base_type in ('bool', 'boolean'):
+        return bool
+    if base_type in ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint'):
+        return int
+    if base_type in ('float', 'double', 'real', 'decimal', 'numeric'):
+        return float
+    return str
+
+
+def build_column_metadata(columns: list[tuple]) -> list[ColumnMetadata]:
+    """
+    :param columns: Ordered (column_name, column_type) tuples as returned by DESCRIBE
+    :return: Ordered column metadata with precomputed decoders
+    """
+    metadata = []
+    for name, datatype in columns:
+        if isinstance(datatype, (bytes, bytearray)):
+            datatype = datatype.decode()
+        datatype = str(datatype).lower()
+        python_type = _python_type(datatype)
+        metadata.append(ColumnMetadata(name=name, datatype=datatype, python_type=python_type,
+                                       decoder=_decode_bit if python_type is bool else None))
+    return metadata
+
+
+def row_to_dict(columns: list[ColumnMetadata], row: tuple) -> dict:
+    """Converts a full table row to a {column_name: value} dict in a single pass"""
+    return {col.name: val if col.decoder is None else col.decoder(val) for col, val in zip(columns, row)}
+
+
+def coerce_value(column: ColumnMetadata, value):
+    """
+    :param column: Metadata of the column the value is written to
+    :param value: New value - strings (e.g. parsed from a Telegram message) are converted to the column type
+    :return: The value converted to the Python type of the column
+    """
+    if column.python_type is bool:
+        if type(value) is bool:
+            return value
+        if str(value).lower() in ('true', '1'):
+            return True
+        if str(value).lower() in ('false', '0'):
+            return False
+        raise ValueError(f"{column.name} expects a boolean (true/false), got {value}")
+
+    try:
+        return column.python_type(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{column.name} expects a {column.python_type.__name__}, got {value}")
+
+
+def to_db_value(value):
+    """Converts a coerced Python value to a query parameter (bools are stored as BIT(1) 1/0)"""
+    return int(value) if type(value) is bool else value
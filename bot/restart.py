@@ -0,0 +1,105 @@
+"""Restart handling for run_bot - backoff between restarts, coalesced crash alerts and requested restarts"""
+
+import random
+import time
+from threading import Lock, Timer
+from typing import Callable, Optional
+
+from .tg_config import ERROR_RESTART_DELAY, ERROR_RESTART_MAX_DELAY, ERROR_RESTART_RESET_AFTER, CRASH_ALERT_WINDOW
+from ._logger import logger
+
+
+class RestartRequested(Exception):
+    """Raised by a handler (e.g. /restartbot) to restart polling right away, without a delay or crash alert"""
+
+    def __init__(self, requested_by=None):
+        super().__init__(f"Restart requested by {requested_by}")
+        self.requested_by = requested_by
+
+
+class Backoff:
+    """
+    Jittered exponential backoff between restarts: the n-th consecutive restart waits a random delay between half and
+    all of base * 2^n seconds (capped at maximum), so a crash loop neither hammers the Bot API nor keeps many
+    instances restarting in lockstep. Once the bot stayed up for reset_after seconds the delay starts over at base.
+    """
+
+    def __init__(self, base: float = ERROR_RESTART_DELAY, maximum: float = ERROR_RESTART_MAX_DELAY,
+                 reset_after: float = ERROR_RESTART_RESET_AFTER):
+        self.base = base
+        self.maximum = maximum
+        self.reset_after = reset_after
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next_delay(self, uptime: Optional[float] = None) -> float:
+        """
+        :param uptime: Seconds the bot ran before it stopped (resets the backoff if at least reset_after)
+        :return: Seconds to wait before the next restart
+        """
+        if uptime is not None and uptime >= self.reset_after:
+            self.reset()
+        delay = min(self.maximum, self.base * 2 ** self.attempt)
+        self.attempt += 1
+        return random.uniform(delay / 2, delay)
+
+
+class AlertCoalescer:
+    """
+    Sends the first alert of a window right away and folds the alerts raised during the rest of the window into a
+    single summary that is sent when the window closes, so a crash loop does not flood the administrators.
+    """
+
+    def __init__(self, send: Callable[[str], object], window: float = CRASH_ALERT_WINDOW):
+        """
+        :param send: Callable delivering an alert (e.g. TelebotTemplate.alert_admins)
+        :param window: Seconds after an alert during which further alerts are only summarized
+        """
+        self.send = send
+        self.window = window
+        self.sent = 0
+        self.suppressed = 0
+        self._window_end: Optional[float] = None
+        self._pending: list[str] = []
+        self._timer: Optional[Timer] = None
+        self._lock = Lock()
+
+    def alert(self, message: str):
+        now = time.monotonic()
+        with self._lock:
+            if self._window_end is not None and now < self._window_end:
+                self._pending.append(message)
+                self.suppressed += 1
+                if self._timer is None:
+                    self._timer = Timer(self._window_end - now, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._window_end = now + self.window
+            self.sent += 1
+        self._send(message)
+
+    def flush(self):
+        """Sends the summary of the alerts suppressed in the current window (if any)"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if len(pending) == 0:
+                return
+            self.sent += 1
+        self._send(f"{len(pending)} more alert(s) in the last {self.window:g} seconds, "
+                   f"most recent:\n{pending[-1]}")
+
+    def _send(self, message: str):
+        try:
+            self.send(message)
+        except Exception as exc:
+            logger.exception('Could not send alert', exc_info=exc)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sent": self.sent, "suppressed": self.suppressed, "pending": len(self._pending)}
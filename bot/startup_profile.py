@@ -0,0 +1,120 @@
+"""
+Startup profiling (TG_STARTUP_PROFILE=1) - reports what importing each module and each initialization phase of the
+bot cost, so regressions in cold start and restart time are easy to pin down.
+
+Only depends on the standard library, so main.py can install it before anything else of the bot is imported.
+"""
+
+import sys
+import time
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+from threading import Lock
+
+# Modules no command path needs at startup - a profile lists them if something imported them eagerly
+HEAVY_MODULES = ("numpy", "pandas", "openpyxl", "xlwt", "xlsxwriter", "mysql.connector", "aiomysql")
+
+
+class _TimedLoader:
+    """Wraps a module loader so exec_module() (the module body) is timed by the StartupProfiler"""
+
+    def __init__(self, loader, profiler: "StartupProfiler"):
+        self._loader = loader
+        self._profiler = profiler
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        with self._profiler.time_import(module.__name__):
+            self._loader.exec_module(module)
+
+    def __getattr__(self, name):
+        # get_resource_reader, get_source, is_package, ... of the wrapped loader
+        return getattr(self._loader, name)
+
+
+class StartupProfiler(MetaPathFinder):
+    """Records per module import times (while installed) and the duration of named initialization phases"""
+
+    def __init__(self):
+        self.enabled = False
+        self.imports: dict[str, list[float]] = {}  # {module: [self seconds, cumulative seconds]}
+        self.phases: list[tuple[str, float]] = []
+        self.started = time.perf_counter()
+        self._stack: list[list[float]] = []  # [started, seconds spent importing nested modules] per open import
+        self._lock = Lock()
+        self._reported = False
+
+    def install(self):
+        """Starts recording imports (first in sys.meta_path, so every later import is timed)"""
+        if not self.enabled:
+            self.enabled = True
+            self.started = time.perf_counter()
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    @contextmanager
+    def time_import(self, module: str):
+        # Imports nest (a module body imports its dependencies) - self time excludes the nested ones
+        frame = [time.perf_counter(), 0.0]
+        with self._lock:
+            self._stack.append(frame)
+        try:
+            yield
+        finally:
+            cumulative = time.perf_counter() - frame[0]
+            with self._lock:
+                self._stack.remove(frame)
+                if len(self._stack) > 0:
+                    self._stack[-1][1] += cumulative
+                self.imports[module] = [cumulative - frame[1], cumulative]
+
+    @contextmanager
+    def phase(self, name: str):
+        """Records how long the enclosed initialization step took (cheap enough to leave in when disabled)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def render_text(self, top: int = 20) -> str:
+        lines = [f"Startup took {(time.perf_counter() - self.started) * 1000:.0f}ms", "", "Phases:"]
+        lines += [f"  {name}: {seconds * 1000:.1f}ms" for name, seconds in self.phases]
+        with self._lock:
+            imports = sorted(self.imports.items(), key=lambda item: item[1][1], reverse=True)
+        lines += ["", f"Slowest imports of {len(imports)} (self / cumulative):"]
+        lines += [f"  {module}: {self_time * 1000:.1f}ms / {cumulative * 1000:.1f}ms"
+                  for module, (self_time, cumulative) in imports[:top]]
+        heavy = [module for module in HEAVY_MODULES if module in sys.modules]
+        if len(heavy) > 0:
+            lines += ["", f"Heavy modules imported during startup: {', '.join(heavy)}"]
+        return "\n".join(lines)
+
+    def report(self):
+        """Logs the profile once (when enabled) and stops timing imports"""
+        if not self.enabled or self._reported:
+            return
+        self._reported = True
+        self.uninstall()
+        from ._logger import logger
+        logger.info(f"Startup profile:\n{self.render_text()}")
+
+
+# Process wide profiler - installed by main.py when TG_STARTUP_PROFILE=1
+startup_profiler = StartupProfiler()
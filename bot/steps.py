@@ -0,0 +1,37 @@
+"""
+Drivers for code written once for both the sync and the asyncio engine.
+
+Such code is a generator that yields every call which may block (a Bot API request, a database query, ...) and is
+sent the call's result back, e.g. `config = yield bot.db_client.pull_user_config(user_id)`. With the sync engine the
+call already returned its result, which run_steps passes straight back; with the asyncio engine the call returned an
+awaitable, which run_steps_async awaits first. Exceptions raised by an awaited call are thrown into the generator at
+its yield, so try/except blocks around a yield behave the same with both engines.
+"""
+
+import inspect
+from typing import Generator
+
+
+def run_steps(steps: Generator):
+    """:return: The return value of the generator, after sending every yielded value back as it is"""
+    result = None
+    try:
+        while True:
+            result = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_steps_async(steps: Generator):
+    """:return: The return value of the generator, after awaiting every yielded awaitable and sending its result back"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            result = (await step) if inspect.isawaitable(step) else step
+        except Exception as exc:
+            error = exc
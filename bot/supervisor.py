@@ -0,0 +1,421 @@
+"""
+Multiprocess execution engine (TG_EXECUTION_ENGINE=multiprocess) - one supervisor process polls Telegram and hands
+the updates to a pool of worker processes, each running its own TelebotTemplate and DatabaseHandler.
+
+Updates are routed by the user they came from, so the updates of one user are handled by the same worker, in order,
+while different users are handled in parallel without sharing a GIL. Cache invalidations made by one worker (e.g.
+/whitelist or /setconfig) are repeated by the other workers, and a worker that crashes is restarted on its own.
+"""
+
+import multiprocessing
+import queue
+import time
+from collections import deque
+from threading import Thread, Event, Lock, Condition
+from typing import Optional
+
+from .tg_config import *
+from ._logger import logger, DroppingQueueHandler, queue_handler
+from .io_handler import get_administrators, UpdateOffsetStore
+from .mysql_database.db_config import DB_AUTO_MIGRATE
+from .mysql_database.database_handler import DatabaseHandler
+from .broadcast import Broadcaster
+from .restart import Backoff, AlertCoalescer
+from .metrics import MetricsServer
+from .telegram_bot import TelebotTemplate
+
+from telebot import TeleBot, apihelper
+from telebot.types import Update
+
+# Updates a worker takes from its queue per process_new_updates call
+WORKER_BATCH_SIZE = 100
+
+
+class _HandledOffsetReporter:
+    """Offset store of a worker's TelebotTemplate - reports handled update IDs to the supervisor, which persists them"""
+
+    def __init__(self, index: int, events):
+        self.index = index
+        self.events = events
+
+    def load(self) -> int:
+        return 0
+
+    def save(self, update_id: int):
+        self.events.put(("handled", self.index, update_id))
+
+
+class _WorkerBot(TelebotTemplate):
+    """TelebotTemplate of a worker process - the supervisor owns polling, so there is nothing to restart in a worker"""
+
+    def restart(self, message):
+        self.reply_to(message, 'Restarting is not supported in multiprocess mode - restart the bot process instead.')
+
+
+def _run_worker(index: int, workers: int, updates, invalidations, events):
+    """Entry point of a worker process - handles the updates routed to it until it receives None"""
+    # Log through the supervisor, so a single process writes (and rotates) the logfile
+    logger.removeHandler(queue_handler)
+    logger.addHandler(DroppingQueueHandler(_LogRecordQueue(index, events)))
+
+    db_client = DatabaseHandler(auto_migrate=False)
+    db_client.invalidation_listeners.append(lambda cache, user_id: events.put(("invalidate", index, cache, user_id)))
+    # Every update routed here has user ID % workers == index, so the handler threads shard on user ID // workers
+    bot = _WorkerBot(db_client, offset_store=_HandledOffsetReporter(index, events), metrics_port=0,
+                     shard_stride=workers)
+
+    def apply_invalidations():
+        while True:
+            cache, user_id = invalidations.get()
+            try:
+                db_client.apply_invalidation(cache, user_id)
+            except Exception as exc:
+                logger.exception(f'Worker {index} could not invalidate the {cache} cache', exc_info=exc)
+
+    Thread(target=apply_invalidations, name="CacheInvalidations", daemon=True).start()
+
+    stopping = False
+    try:
+        while not stopping:
+            batch = [updates.get()]
+            while len(batch) < WORKER_BATCH_SIZE:
+                try:
+                    batch.append(updates.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            if len(batch) > 0:
+                bot.process_new_updates([Update.de_json(update) for update in batch])
+            # Like polling, a handler exception the exception_handler did not handle ends the worker (it is restarted)
+            bot.dispatcher.raise_exceptions()
+    except KeyboardInterrupt:
+        pass  # The supervisor got it too and stops the workers
+
+    if not bot.dispatcher.drain(timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        logger.warning(f'Worker {index} exiting with unhandled updates after waiting {SHUTDOWN_DRAIN_TIMEOUT} seconds')
+    bot.save_update_offset()
+    bot.jobs.shutdown()
+    db_client.close()
+
+
+class _LogRecordQueue:
+    """Queue-like adapter sending a worker's log records to the supervisor over the event queue"""
+
+    def __init__(self, index: int, events):
+        self.index = index
+        self.events = events
+
+    def put_nowait(self, record):
+        self.events.put_nowait(("log", self.index, record))
+
+
+class WorkerHandle:
+    """State the supervisor keeps for one worker process (replaced queues and process on every restart)"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.updates = None
+        self.invalidations = None
+        self.started = 0.0
+        self.restart_at: Optional[float] = None
+        self.backoff = Backoff()
+        self.restarts = 0
+        self.handled = 0
+        self.outstanding: deque[dict] = deque()  # Updates routed to the worker and not acknowledged yet
+        self.redelivered: set[int] = set()  # IDs of the outstanding updates already delivered to a previous worker
+        self.updates_per_s = 0.0
+        self.reported = (0, time.monotonic())  # (handled, time) at the last throughput report
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    """
+    Polls Telegram, routes every update to a worker process by user ID, persists the offset of the handled updates,
+    relays cache invalidations between the workers and restarts (with backoff and coalesced admin alerts) the ones
+    that exit.
+    """
+
+    def __init__(self, workers: int = PROCESS_WORKERS, queue_size: int = PROCESS_QUEUE_SIZE,
+                 report_interval: float = WORKER_REPORT_INTERVAL, metrics_port: int = METRICS_PORT):
+        """
+        :param workers: Number of worker processes
+        :param queue_size: Maximum number of updates queued per worker (polling blocks while a worker's queue is full)
+        :param report_interval: Seconds between the per worker throughput reports in the log
+        :param metrics_port: Port of the Prometheus /metrics endpoint (0 disables it)
+        """
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.context = multiprocessing.get_context("spawn")
+        self.events = self.context.Queue()
+        self.workers = [WorkerHandle(index) for index in range(workers)]
+        self._lock = Lock()  # Guards the WorkerHandles
+        self._handled = Condition(self._lock)  # Notified when a worker acknowledges handled updates
+        self._draining = Event()  # Set once the workers are asked to stop (exits are no longer restarted)
+        self._stopping = Event()
+        self._round_robin = 0
+
+        # Last update ID dispatched to a worker, and where the last handled one is persisted
+        self.offset_store = UpdateOffsetStore(UPDATE_OFFSET_FILE)
+        self.last_update_id = 0
+
+        # The workers' bots answer users - this one only sends the supervisor's alerts
+        self.broadcaster = Broadcaster(TeleBot(TELEGRAM_BOT_TOKEN, threaded=False))
+        self.crash_alerts = AlertCoalescer(self.alert_admins)
+        self.metrics_server: Optional[MetricsServer] = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(metrics_port, gauges=self.metrics_gauges)
+            self.metrics_server.start()
+
+    def alert_admins(self, message: str):
+        return self.broadcaster.broadcast(get_administrators(), message)
+
+    @staticmethod
+    def route_key(update: dict) -> Optional[int]:
+        """:return: The ID of the user (or chat) a raw update belongs to, None for updates without one"""
+        for payload in update.values():
+            if isinstance(payload, dict):
+                user = payload.get('from') or payload.get('user')
+                if user is not None:
+                    return user['id']
+                chat = payload.get('chat')
+                if chat is not None:
+                    return chat['id']
+        return None
+
+    def route(self, update: dict) -> WorkerHandle:
+        key = self.route_key(update)
+        if key is None:
+            self._round_robin += 1
+            key = self._round_robin
+        return self.workers[key % len(self.workers)]
+
+    def start_worker(self, worker: WorkerHandle):
+        """
+        Starts (or restarts) a worker, call with _lock held. The updates a dead worker did not acknowledge are
+        delivered to its replacement - once, so an update that crashes the worker cannot keep it in a crash loop.
+        """
+        redelivered = [update for update in worker.outstanding if update['update_id'] not in worker.redelivered]
+        if worker.process is not None:
+            logger.warning(f'Restarting worker {worker.index}: {len(redelivered)} unacknowledged updates redelivered, '
+                           f'{len(worker.outstanding) - len(redelivered)} dropped')
+        # Fresh queues - the ones of a killed worker are left locked when it died waiting for an update
+        for old_queue in (worker.updates, worker.invalidations):
+            if old_queue is not None:
+                old_queue.cancel_join_thread()
+                old_queue.close()
+        worker.updates = self.context.Queue(maxsize=self.queue_size + len(redelivered))
+        worker.invalidations = self.context.Queue()
+        for update in redelivered:
+            worker.updates.put_nowait(update)
+        worker.outstanding = deque(redelivered)
+        worker.redelivered = {update['update_id'] for update in redelivered}
+
+        # Not daemonic - a worker starts the job processes of /runjob. stop() joins (or terminates) the workers instead
+        worker.process = self.context.Process(target=_run_worker, name=f"BotWorker-{worker.index}", daemon=False,
+                                              args=(worker.index, len(self.workers), worker.updates,
+                                                    worker.invalidations, self.events))
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+
+    def dispatch(self, update: dict):
+        """Queues a raw update on its worker (waits while the worker's queue is full)"""
+        worker = self.route(update)
+        warned = False
+        while True:
+            with self._lock:
+                try:
+                    worker.updates.put_nowait(update)
+                    worker.outstanding.append(update)
+                    return
+                except queue.Full:
+                    pass
+            if not warned:
+                logger.warning(f"Worker {worker.index} queue is full ({self.queue_size} updates) - polling paused")
+                warned = True
+            time.sleep(0.1)
+
+    def handled_update_id(self) -> int:
+        """:return: The highest update ID below which every dispatched update was handled, call with _lock held"""
+        pending = [worker.outstanding[0]['update_id'] for worker in self.workers if len(worker.outstanding) > 0]
+        return min(pending) - 1 if len(pending) > 0 else self.last_update_id
+
+    def save_update_offset(self):
+        """Persists the highest update ID below which every dispatched update was handled"""
+        with self._lock:
+            handled = self.handled_update_id()
+        try:
+            self.offset_store.save(handled)
+        except OSError as exc:
+            logger.warning(f"Could not persist the update offset: {exc}")
+
+    def handle_event(self, event: tuple):
+        kind, index = event[0], event[1]
+        if kind == "handled":
+            worker = self.workers[index]
+            with self._lock:
+                while len(worker.outstanding) > 0 and worker.outstanding[0]['update_id'] <= event[2]:
+                    worker.redelivered.discard(worker.outstanding.popleft()['update_id'])
+                    worker.handled += 1
+                self._handled.notify_all()
+            self.save_update_offset()
+        elif kind == "invalidate":
+            with self._lock:
+                targets = [worker.invalidations for worker in self.workers if worker.index != index]
+            for invalidations in targets:
+                invalidations.put(event[2:])
+        elif kind == "log":
+            logger.handle(event[2])
+
+    def _relay_events(self):
+        while not self._stopping.is_set():
+            try:
+                event = self.events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.handle_event(event)
+            except Exception as exc:
+                logger.exception('Could not handle a worker event', exc_info=exc)
+
+    def _monitor(self):
+        next_report = time.monotonic() + self.report_interval
+        while not self._stopping.wait(0.5):
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.is_alive() or self._draining.is_set():
+                    continue
+                if worker.restart_at is None:
+                    delay = worker.backoff.next_delay(uptime=now - worker.started)
+                    err_msg = (f'Worker {worker.index} exited with code {worker.process.exitcode} - '
+                               f'restarting in {delay:.1f} seconds...')
+                    logger.error(err_msg)
+                    self.crash_alerts.alert(err_msg)
+                    worker.restart_at = now + delay
+                elif now >= worker.restart_at:
+                    with self._lock:
+                        self.start_worker(worker)
+                        worker.restarts += 1
+                    self.save_update_offset()
+            if now >= next_report:
+                self.report_throughput()
+                next_report = now + self.report_interval
+
+    def report_throughput(self):
+        """Logs (and updates the gauges of) the updates each worker handled since the last report"""
+        now = time.monotonic()
+        lines = []
+        with self._lock:
+            for worker in self.workers:
+                handled, since = worker.reported
+                worker.updates_per_s = (worker.handled - handled) / max(now - since, 1e-9)
+                worker.reported = (worker.handled, now)
+                lines.append(f"  worker {worker.index}: {worker.handled} handled ({worker.updates_per_s:.1f}/s), "
+                             f"{len(worker.outstanding)} outstanding, {worker.restarts} restarts")
+        logger.info("Worker throughput:\n" + "\n".join(lines))
+
+    def metrics_gauges(self) -> dict:
+        """:return: Point-in-time per worker gauges exported next to the latency metrics"""
+        gauges = {}
+        with self._lock:
+            for worker in self.workers:
+                gauges.update({f"bot_worker_{worker.index}_handled_total": worker.handled,
+                               f"bot_worker_{worker.index}_updates_per_s": worker.updates_per_s,
+                               f"bot_worker_{worker.index}_outstanding": len(worker.outstanding),
+                               f"bot_worker_{worker.index}_restarts": worker.restarts})
+        for name, value in self.crash_alerts.stats().items():
+            gauges[f"bot_crash_alerts_{name}"] = value
+        return gauges
+
+    def poll(self):
+        """
+        Long polls Telegram and dispatches the updates until interrupted. Only handled updates are confirmed (the
+        offset is the one save_update_offset persists), so updates a worker had not finished when the bot stopped
+        are delivered again after a restart. Unconfirmed updates come back with every call and are skipped - while
+        some are outstanding, polling waits for a worker to acknowledge one first (at most a second).
+        """
+        backoff = Backoff()
+        while True:
+            with self._handled:
+                if self.handled_update_id() < self.last_update_id:
+                    self._handled.wait(timeout=1)
+                offset = self.handled_update_id() + 1
+            try:
+                updates = apihelper.get_updates(TELEGRAM_BOT_TOKEN, offset=offset, limit=WORKER_BATCH_SIZE,
+                                                timeout=20, long_polling_timeout=20)
+                backoff.reset()
+            except Exception as exc:
+                delay = backoff.next_delay()
+                err_msg = f'Could not fetch updates - retrying in {delay:.1f} seconds: {exc}'
+                logger.error(err_msg)
+                self.crash_alerts.alert(err_msg)
+                time.sleep(delay)
+                continue
+            for update in updates:
+                if update['update_id'] > self.last_update_id:
+                    self.dispatch(update)
+                    self.last_update_id = update['update_id']
+            if len(updates) > 0:
+                self.save_update_offset()
+
+    def run(self):
+        if DB_AUTO_MIGRATE:
+            # Once, before the workers (they start with auto_migrate=False) open their own connections
+            DatabaseHandler().close()
+        self.last_update_id = self.offset_store.load()
+
+        with self._lock:
+            for worker in self.workers:
+                self.start_worker(worker)
+        threads = [Thread(target=self._relay_events, name="WorkerEvents", daemon=True),
+                   Thread(target=self._monitor, name="WorkerMonitor", daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        logger.info(f"Bot started (multiprocess, {len(self.workers)} workers)")
+        try:
+            self.poll()
+        except KeyboardInterrupt:
+            logger.info("Bot stopping for keyboard interrupt...")
+        finally:
+            self.stop(threads)
+
+    def stop(self, threads: list[Thread]):
+        """Lets the workers finish their queued updates, then persists the offset of the handled ones"""
+        self._draining.set()
+        for worker in self.workers:
+            if worker.is_alive():
+                try:
+                    worker.updates.put(None, timeout=1)
+                except queue.Full:
+                    pass  # Stopped below
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT + 5
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=max(0.0, deadline - time.monotonic()))
+                if worker.process.is_alive():
+                    logger.warning(f'Worker {worker.index} did not stop - terminating it')
+                    worker.process.terminate()
+                    worker.process.join(timeout=5)
+                    if worker.process.is_alive():
+                        worker.process.kill()
+                        worker.process.join()
+                worker.updates.cancel_join_thread()
+
+        self._stopping.set()
+        for thread in threads:
+            thread.join()
+        while True:
+            try:
+                self.handle_event(self.events.get(timeout=0.1))
+            except queue.Empty:
+                break
+        self.save_update_offset()
+        self.crash_alerts.flush()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
@@ -1,130 +1,196 @@
+import functools
 import os
+import signal
 import time
+from collections import deque
+from os.path import basename
+from threading import Condition, Lock, current_thread, main_thread
+from typing import Optional
 
 from .tg_config import *
 from ._logger import logger
-from .io_handler import get_temp_dir, create_zip_archive, walk_dir, clr_temp_dir, get_administrators, get_logfile
+from .io_handler import (get_temp_dir, create_zip_archive, walk_dir, clr_temp_dir, get_administrators,
+                         administrator_registry, UpdateOffsetStore)
 from .mysql_database.database_handler import DatabaseHandler
+from .mysql_database.storage_backends import database_errors
+from .broadcast import Broadcaster, DeliveryReport
+from .webhook import WebhookServer
+from .dispatcher import ShardedDispatcher
+from .restart import RestartRequested, Backoff, AlertCoalescer
+from .jobs import JobManager, Job, DONE as JOB_DONE
+from .startup_profile import startup_profiler
+from .commands import COMMANDS, Command
+from .steps import run_steps
+from . import handlers
+from .metrics import timed, MetricsServer
+from ._logger import logging_stats
 
-from telebot import TeleBot
+from telebot import TeleBot, apihelper
+from telebot.types import Message, User
 from requests.exceptions import ReadTimeout
-from mysql.connector.errors import DatabaseError
+
+
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
 
 
 class TelebotTemplate(TeleBot):
-    def __init__(self):
-        super().__init__(token=TELEGRAM_BOT_TOKEN)
+    def __init__(self, db_client: Optional[DatabaseHandler] = None, offset_store: Optional[UpdateOffsetStore] = None,
+                 metrics_port: int = METRICS_PORT, shard_stride: int = 1):
+        """
+        :param db_client: Database handler to use (defaults to a new DatabaseHandler for the configured database)
+        :param offset_store: Where the last handled update ID is persisted (defaults to TG_UPDATE_OFFSET_FILE)
+        :param metrics_port: Port of the Prometheus /metrics endpoint (0 disables it)
+        :param shard_stride: Passed to ShardedDispatcher as key_stride (the number of worker processes in
+            multiprocess mode)
+        """
+        # No threads for pyTelegramBotAPI's own worker pool - handlers run on the ShardedDispatcher installed below
+        super().__init__(token=TELEGRAM_BOT_TOKEN, num_threads=0)
+        # Last handled update ID, persisted so polling resumes after it (see save_update_offset)
+        self.offset_store = offset_store if offset_store is not None else UpdateOffsetStore(UPDATE_OFFSET_FILE)
+        self._dispatched_batches: deque[tuple[int, int]] = deque()  # (dispatcher sequence, highest update ID)
+        self._dispatched_update_id = 0  # Highest update ID handed to the handlers
+        self._handled_update_id = 0  # Highest update ID below which every update was handled (the persisted one)
+        self._offset_lock = Lock()
+        self._offset_changed = Condition(self._offset_lock)  # Notified when _handled_update_id advances
+        self.worker_pool = self.dispatcher = ShardedDispatcher(self, on_overload=self.reply_overloaded,
+                                                               on_task_done=self.save_update_offset,
+                                                               key_stride=shard_stride)
 
-        self.db_client = DatabaseHandler()
-        logger.info(f'{self.get_me().first_name} initialized')
+        self._identity: Optional[User] = None
+        with startup_profiler.phase("database"):
+            self.db_client = db_client if db_client is not None else DatabaseHandler()
+        self.broadcaster = Broadcaster(self)
+        self.crash_alerts = AlertCoalescer(self.alert_admins)
+        self.jobs = JobManager(self.deliver_job)
+        self.webhook_server: Optional[WebhookServer] = None
+        self.metrics_server: Optional[MetricsServer] = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(metrics_port, gauges=self.metrics_gauges)
+            self.metrics_server.start()
+        with startup_profiler.phase("bot identity (getMe)"):
+            logger.info(f'{self.identity().first_name} initialized')
 
-        @self.message_handler(commands=['help'])
-        @self.user_is_whitelisted
-        def on_help(message):
-            self.reply_to(message, f'View the documentation for the bot here:\n{EXTERNAL_DOCUMENTATION_LINK}')
+        for command in COMMANDS:
+            self.register_command(command)
 
-        @self.message_handler(commands=['viewconfig'])
-        @self.user_is_whitelisted
-        def on_viewconfig(message):
-            """Returns the current configuration of the bot (used as reference for /setconfig)"""
-            try:
-                config = self.db_client.pull_user_config(user_id=message.from_user.id)
-                msg = f"{message.from_user.username} {self.get_me().first_name} Configuration:\n\n"
-                for k, v in config.items():
-                    # msg += f"{key.strip()} settings:\n"
-                    # for k, v in variables.items():
-                    msg += f'{k}={v}\n'
-                    # msg += '\n'
-                self.reply_to(message, msg)
+    def message_handler(self, *args, **kwargs):
+        """Registers a message handler (see TeleBot.message_handler), recording its latency and errors"""
+        register = super().message_handler(*args, **kwargs)
 
-            except Exception as exc:
-                logger.exception('Could not call /viewconfig', exc_info=exc)
-                self.reply_to(message, str(exc))
-
-        @self.message_handler(commands=['setconfig'])
-        @self.user_is_whitelisted
-        def on_setconfig(message):
-            """Used to change configuration variables of the bot"""
-            msg = ""
-            failed = []
-            user_id = message.from_user.id
-            config = self.db_client.pull_user_config(user_id)
-            try:
-                for change in self.split_message(message.text):
-                    try:
-                        conf, val = change.split('=')
-
-                        # Account for bool case:
-                        if val.lower() == 'true' or val.lower() == 'false':
-                            val = val.lower() == 'true'
-
-                        try:
-                            var_type = type(config[conf])
-                        except KeyError:
-                            raise KeyError(f"{conf} does not match any available config settings in database.")
-
-                        # Attempt to push the config update to the database:
-                        self.db_client.update_user_config(user_id=user_id, config_name=conf,
-                                                          new_value=var_type(val))
-
-                        msg += f"{conf} set to {val}\n"
-                        logger.info(f"{user_id}: {conf} set to {val} ({var_type})\n")
-                    except Exception as exc:
-                        failed.append((change, str(exc)))
-                        continue
-
-                if len(msg) > 0:
-                    self.reply_to(message, "Successfully set configuration:\n\n" + msg)
-
-                if len(failed) > 0:
-                    fail_msg = "Failed to set:\n\n"
-                    for fail in failed:
-                        fail_msg += f"- {fail[0]} (Error: {fail[1]})\n"
-                    self.reply_to(message, fail_msg)
-            except Exception as exc:
-                logger.exception('Could not set config', exc_info=exc)
-                self.reply_to(message, str(exc))
+        def decorator(handler):
+            register(timed("handler", slow_threshold=SLOW_HANDLER_THRESHOLD)(handler))
+            return handler
+
+        return decorator
+
+    def register_command(self, command: Command):
+        """Registers a command (see commands.py) behind its guard, running its Bot API and database calls directly"""
+
+        @functools.wraps(command.body)
+        def handler(message):
+            return run_steps(command.body(self, message))
+
+        self.message_handler(**command.filters)(getattr(self, command.guard)(handler))
+
+    def run_blocking(self, func, *args, **kwargs):
+        """Runs blocking work of a command (see commands.py) - on the calling handler thread"""
+        return func(*args, **kwargs)
+
+    def identity(self, refresh: bool = False) -> User:
+        """
+        :param refresh: Fetch the identity again (e.g. after the bot was renamed in BotFather)
+        :return: The bot's own User, fetched with get_me() once and cached
+        """
+        if self._identity is None or refresh:
+            self._identity = self.get_me()
+        return self._identity
+
+    def restart(self, message: Message):
+        """Restarts polling in-process (the database pool, caches and handler threads stay warm)"""
+        self.reply_to(message, 'Bot restarting...')
+        raise RestartRequested(message.from_user.id)
+
+    def get_updates(self, offset=None, *args, **kwargs):
+        """
+        Fetches updates (see TeleBot.get_updates), confirming only the ones whose handlers have finished. Telegram
+        deletes an update once a getUpdates call asks for a higher offset, so confirming the dispatched updates would
+        lose the ones still queued for a handler when the bot stops. The unconfirmed updates come back with every
+        call (process_new_updates drops them) - while some are pending, this waits for a handler to finish first
+        (at most a second), and when more than a batch is pending no new updates are fetched until they are handled.
+        """
+        if BOT_MODE == "polling" and offset is not None and offset > 0:
+            with self._offset_changed:
+                if self._handled_update_id < self._dispatched_update_id:
+                    self._offset_changed.wait(timeout=1)
+                offset = min(offset, self._handled_update_id + 1)
+        return super().get_updates(offset, *args, **kwargs)
 
-        @self.message_handler(commands=['whitelist'])
-        @self.user_is_administrator
-        def on_whitelist(message):
-            """Used to change configuration variables of the bot"""
+    def process_new_updates(self, updates):
+        """
+        Dispatches updates to the handlers (see TeleBot.process_new_updates), remembering the batch's offset.
+        When polling, updates at or below the highest update ID already dispatched are dropped - get_updates only
+        confirms handled updates, so the ones still queued for a handler are returned again.
+        """
+        if BOT_MODE == "polling":
+            with self._offset_lock:
+                updates = [update for update in updates if update.update_id > self._dispatched_update_id]
+                if len(updates) > 0:
+                    self._dispatched_update_id = max(update.update_id for update in updates)
+        super().process_new_updates(updates)
+        if BOT_MODE == "polling" and len(updates) > 0:
+            with self._offset_lock:
+                self._dispatched_batches.append((self.dispatcher.sequence, max(update.update_id for update in updates)))
+            self.save_update_offset()
+
+    def save_update_offset(self):
+        """
+        Persists the highest update ID of the newest batch whose handlers have all finished (run after every handler,
+        writes at most once per batch)
+        """
+        watermark = self.dispatcher.completed_watermark()
+        handled = None
+        with self._offset_lock:
+            while len(self._dispatched_batches) > 0 and self._dispatched_batches[0][0] <= watermark:
+                handled = self._dispatched_batches.popleft()[1]
+            if handled is not None and handled > self._handled_update_id:
+                self._handled_update_id = handled
+                self._offset_changed.notify_all()
+        if handled is not None:
             try:
-                splt_msg = self.split_message(message.text)
-                if len(splt_msg) > 0:
-                    new_users = splt_msg[0].split(",")
-                    for user in new_users:
-                        self.db_client.whitelist_user(user)
-                    self.reply_to(message, f'Whitelisted: {new_users}')
-                    logger.info(f'Whitelisted: {new_users}')
-                else:
-                    msg = f"{self.get_me().full_name} Whitelist:\n"
-                    for user in self.db_client.load_whitelist():
-                        msg += f"- {user}\n"
-                    self.reply_to(message, msg)
-            except Exception as exc:
-                self.reply_to(message, str(exc))
+                self.offset_store.save(handled)
+            except OSError as exc:
+                logger.warning(f"Could not persist the update offset: {exc}")
 
-        @self.message_handler(commands=['restartbot'])
-        @self.user_is_administrator
-        def on_restartbot(message):
-            self.reply_to(message, f'Bot restarting - '
-                                   f'Please wait {ERROR_RESTART_DELAY} seconds')
-            raise Exception("Bot restart called")
+    def metrics_gauges(self) -> dict:
+        """:return: Point-in-time gauges exported next to the latency metrics"""
+        gauges = {}
+        for name, value in self.db_client.whitelist_cache_stats().items():
+            gauges[f"bot_whitelist_cache_{name}"] = value
+        for name, value in self.db_client.user_config_cache_stats().items():
+            gauges[f"bot_user_config_cache_{name}"] = value
+        for name, value in self.db_client.pool_stats().items():
+            gauges[f"bot_db_pool_{name}"] = value
+        for name, value in logging_stats().items():
+            gauges[f"bot_log_{name}"] = value
+        for name, value in self.dispatcher.stats().items():
+            gauges[f"bot_dispatch_{name}"] = value
+        for name, value in self.crash_alerts.stats().items():
+            gauges[f"bot_crash_alerts_{name}"] = value
+        for name, value in self.jobs.stats().items():
+            gauges[f"bot_jobs_{name}"] = value
+        if self.webhook_server is not None:
+            for name, value in self.webhook_server.stats().items():
+                gauges[f"bot_webhook_{name}"] = value
+        return gauges
 
-        @self.message_handler(commands=['getlogs'])
-        @self.user_is_administrator
-        def on_getlogs(message):
-            self.reply_to(message, f'Fetching logfile...')
-            self.send_document(message.chat.id, open(get_logfile(), 'rb'))
+    def reply_overloaded(self, update):
+        """Answers a message that was rejected because its handler queue is full (see ShardedDispatcher)"""
+        if isinstance(update, Message):
+            self.reply_to(update, handlers.overloaded_text())
 
     def split_message(self, message, convert_type=None) -> list:
-        if convert_type is None:
-            return [chunk.strip() for chunk in message.split(" ")[1:] if
-                    not all(char == " " for char in chunk) and len(chunk) > 0]
-        else:
-            return [convert_type(chunk.strip()) for chunk in message.split(" ")[1:] if
-                    not all(char == " " for char in chunk) and len(chunk) > 0]
+        return handlers.split_message(message, convert_type)
 
     def user_is_whitelisted(self, func):
         """
@@ -133,14 +199,16 @@ class TelebotTemplate(TeleBot):
         :param func: Expects the function to be a message handler, with the 'message' class as the first argument 
         """
 
+        is_whitelisted = timed("auth", "user_is_whitelisted")(lambda user_id: self.db_client.is_whitelisted(user_id))
+
+        @functools.wraps(func)
         def wrapper(*args, **kw):
             message = args[0]
             user_id = str(message.from_user.id)
-            if user_id in self.db_client.load_whitelist():
+            if is_whitelisted(user_id):
                 return func(*args, **kw)
             else:
-                self.reply_to(message, f"{message.from_user.username} is not whitelisted.\n"
-                                       f"Please send your user ID ({user_id}) the developer: {DEVELOPER_CONTACT}")
+                self.reply_to(message, handlers.not_whitelisted_text(message))
                 return False
 
         return wrapper
@@ -152,45 +220,115 @@ class TelebotTemplate(TeleBot):
         :param func: Expects the function to be a message handler, with the 'message' class as the first argument
         """
 
+        is_administrator = timed("auth", "user_is_administrator")(administrator_registry.is_administrator)
+
+        @functools.wraps(func)
         def wrapper(*args, **kw):
             message = args[0]
             user_id = str(message.from_user.id)
-            if user_id in get_administrators():
+            if is_administrator(user_id):
                 return func(*args, **kw)
             else:
-                self.reply_to(message,
-                              f"{message.from_user.username} ({message.from_user.id}) is not an administrator.")
+                self.reply_to(message, handlers.not_administrator_text(message))
                 return False
 
         return wrapper
 
-    def alert_users(self, message: str) -> None:
-        for user in self.db_client.load_whitelist():
-            self.send_message(chat_id=user, text=message)
+    def alert_users(self, message: str) -> DeliveryReport:
+        return self.broadcaster.broadcast(self.db_client.load_whitelist(), message)
 
-    def alert_admins(self, message: str) -> None:
-        for user in get_administrators():
-            self.send_message(chat_id=user, text=message)
+    def alert_admins(self, message: str) -> DeliveryReport:
+        return self.broadcaster.broadcast(get_administrators(), message)
+
+    def deliver_job(self, job: Job):
+        """Sends the report of a finished job (or why it has none) to the chat it was started from"""
+        if job.state != JOB_DONE:
+            self.send_message(job.chat_id, handlers.job_result_text(job))
+        elif os.path.getsize(job.result_path) > TELEGRAM_UPLOAD_LIMIT:
+            self.send_message(job.chat_id, f'{handlers.job_result_text(job)}, but its report exceeds the upload '
+                                           f'limit of {TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)} MB.')
+        else:
+            with open(job.result_path, 'rb') as report:
+                self.send_document(job.chat_id, report, visible_file_name=basename(job.result_path),
+                                   caption=handlers.job_result_text(job))
+
+    def run_webhook(self):
+        """Registers the webhook with Telegram and serves updates through the embedded receiver until it stops"""
+        self.webhook_server = WebhookServer(self)
+        self.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN)
+        try:
+            self.webhook_server.serve_forever()
+        finally:
+            self.webhook_server.shutdown()
+            self.webhook_server = None
 
     def run_bot(self):
+        startup_profiler.report()
+        if BOT_MODE == "polling":
+            # Resume after the last handled update - the updates after it were not confirmed (see get_updates), so
+            # Telegram delivers them again
+            with self._offset_lock:
+                self._handled_update_id = max(self._handled_update_id, self.offset_store.load())
+            self.last_update_id = max(self.last_update_id, self._handled_update_id)
+
+        # TeleBot.polling returns (instead of raising) on Ctrl-C - remember the interrupt to tell it from an API error
+        interrupted = False
+
+        def on_interrupt(signum, frame):
+            nonlocal interrupted
+            interrupted = True
+            raise KeyboardInterrupt
+
+        previous_handler = None
+        if current_thread() is main_thread():
+            previous_handler = signal.signal(signal.SIGINT, on_interrupt)
+
+        # Restarts reuse this instance, so the database pool, caches, handler threads and bot identity stay warm
+        backoff = Backoff()
         while True:
+            started = time.monotonic()
             try:
-                logger.info("Bot started")
-                # Poll for changes
-                self.polling()
+                logger.info(f"Bot started ({BOT_MODE})")
+                if BOT_MODE == "webhook":
+                    self.run_webhook()
+                else:
+                    # Poll for changes (returns after a Bot API error)
+                    self.polling()
+                if interrupted:
+                    logger.info("Bot stopping for keyboard interrupt...")
+                    break
+                delay = backoff.next_delay(uptime=time.monotonic() - started)
+                logger.warning(f'Bot stopped receiving updates - restarting in {delay:.1f} seconds...')
+                time.sleep(delay)
+            except RestartRequested as exc:
+                logger.info(f'{exc} - restarting')
+                backoff.reset()
             except ReadTimeout:
-                err_msg = f'Bot has crashed due to read timeout - restarting in {ERROR_RESTART_DELAY} seconds...'
+                delay = backoff.next_delay(uptime=time.monotonic() - started)
+                err_msg = f'Bot has crashed due to read timeout - restarting in {delay:.1f} seconds...'
                 logger.error(err_msg)
-                self.alert_admins(err_msg)
-                time.sleep(ERROR_RESTART_DELAY)
-            except DatabaseError as exc:
-                logger.exception(f'MySQL error has occurred', exc_info=exc)
+                self.crash_alerts.alert(err_msg)
+                time.sleep(delay)
+            except database_errors() as exc:
+                logger.exception('Database error has occurred', exc_info=exc)
                 self.alert_admins(f'A critical database error has occurred:\n{exc}')
                 break
             except KeyboardInterrupt:
                 logger.info("Bot stopping for keyboard interrupt...")
                 break
             except Exception as exc:
-                logger.exception(f'Bot has unexpectedly crashed - restarting in {ERROR_RESTART_DELAY}:', exc_info=exc)
-                self.alert_admins(f'Bot has unexpectedly crashed - Error {exc}')
-                time.sleep(ERROR_RESTART_DELAY)
+                delay = backoff.next_delay(uptime=time.monotonic() - started)
+                logger.exception(f'Bot has unexpectedly crashed - restarting in {delay:.1f} seconds:', exc_info=exc)
+                self.crash_alerts.alert(f'Bot has unexpectedly crashed - Error {exc}')
+                time.sleep(delay)
+            finally:
+                self.save_update_offset()
+
+        # Let the queued updates finish so the persisted offset covers them
+        if not self.dispatcher.drain(timeout=SHUTDOWN_DRAIN_TIMEOUT):
+            logger.warning(f'Exiting with unhandled updates after waiting {SHUTDOWN_DRAIN_TIMEOUT} seconds')
+        self.save_update_offset()
+        self.jobs.shutdown()
+        self.crash_alerts.flush()
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
@@ -2,9 +2,69 @@ import os
 
 """----- TELEGRAM CONFIGURATION -----"""
 TELEGRAM_BOT_TOKEN = os.getenv("TG_BOT_TOKEN", "<or-hardcode-here>")
-ERROR_RESTART_DELAY = 5  # In seconds
+ERROR_RESTART_DELAY = 5  # Delay (in seconds) before restarting after a crash, doubled per consecutive crash
+ERROR_RESTART_MAX_DELAY = 300  # Upper bound of the restart delay (in seconds)
+ERROR_RESTART_RESET_AFTER = 60  # Uptime (in seconds) after which the restart delay starts over
+CRASH_ALERT_WINDOW = 600  # Crash alerts within this many seconds of the first one are sent as one summary
+UPDATE_OFFSET_FILE = os.getenv("TG_UPDATE_OFFSET_FILE", "update_offset.json")  # Last handled update ID (polling)
+SHUTDOWN_DRAIN_TIMEOUT = 10  # Seconds to wait for queued updates to be handled before the bot exits
 EXTERNAL_DOCUMENTATION_LINK = "<insert_external_documentation_link_here>"
 DEVELOPER_CONTACT = "<insert_developer_contact_here>"
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024  # Maximum size (in bytes) of documents sent by the bot
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # Maximum size (in bytes) of documents the bot can download
+TELEGRAM_API_URL = os.getenv("TG_API_URL")  # Optional Bot API server override, e.g. "http://localhost:8081/bot{0}/{1}"
 
+"""----- BROADCAST CONFIGURATION -----"""
+BROADCAST_WORKERS = int(os.getenv("TG_BROADCAST_WORKERS", 8))  # Concurrent send requests per broadcast
+BROADCAST_GLOBAL_RATE = 30  # Messages per second across all chats
+BROADCAST_PER_CHAT_RATE = 1  # Messages per second to the same private chat
+BROADCAST_GROUP_CHAT_RATE = 20 / 60  # Messages per second to the same group chat
+BROADCAST_MAX_RETRIES = 3  # Retries per message after a 429 (retry_after), timeout or server error
 
-assert TELEGRAM_BOT_TOKEN != "<or-hardcode-here>"
\ No newline at end of file
+"""----- UPDATE INGESTION CONFIGURATION -----"""
+EXECUTION_ENGINE = os.getenv("TG_EXECUTION_ENGINE", "sync")  # "sync" (TelebotTemplate), "async" or "multiprocess"
+BOT_MODE = os.getenv("TG_BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("TG_WEBHOOK_URL")  # Public HTTPS URL registered with Telegram, e.g. "https://example.com/tg"
+WEBHOOK_LISTEN = os.getenv("TG_WEBHOOK_LISTEN", "0.0.0.0")  # Interface the embedded receiver binds to
+WEBHOOK_PORT = int(os.getenv("TG_WEBHOOK_PORT", 8443))  # Port the embedded receiver binds to (behind a TLS proxy)
+WEBHOOK_PATH = os.getenv("TG_WEBHOOK_PATH", "/")  # URL path the receiver accepts updates on
+WEBHOOK_SECRET_TOKEN = os.getenv("TG_WEBHOOK_SECRET_TOKEN")  # Sent back by Telegram in every webhook request
+WEBHOOK_QUEUE_SIZE = 1000  # Maximum number of received updates waiting for dispatch
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024  # Larger webhook requests are rejected (413) before their body is read
+
+"""----- HANDLER DISPATCH CONFIGURATION -----"""
+HANDLER_WORKERS = int(os.getenv("TG_HANDLER_WORKERS", 8))  # Handler threads (updates of one user share a thread)
+HANDLER_QUEUE_SIZE = int(os.getenv("TG_HANDLER_QUEUE_SIZE", 100))  # Maximum number of queued updates per thread
+HANDLER_OVERLOAD_POLICY = os.getenv("TG_HANDLER_OVERLOAD_POLICY", "reply")  # When a queue is full: "reply" or "drop"
+HANDLER_OVERLOAD_REPLY_INTERVAL = 30  # Seconds before a user whose update was rejected is asked to retry again
+HANDLER_OVERLOAD_REPLY_QUEUE_SIZE = 100  # Retry messages waiting to be sent (further ones are skipped)
+
+"""----- MULTIPROCESS CONFIGURATION (TG_EXECUTION_ENGINE=multiprocess, see supervisor.py) -----"""
+PROCESS_WORKERS = int(os.getenv("TG_PROCESS_WORKERS", os.cpu_count() or 2))  # Worker processes handling updates
+PROCESS_QUEUE_SIZE = 1000  # Maximum number of updates queued per worker process
+WORKER_REPORT_INTERVAL = 60  # Seconds between the per worker throughput reports in the log
+
+"""----- JOB CONFIGURATION (background jobs, see jobs.py) -----"""
+JOB_WORKERS = int(os.getenv("TG_JOB_WORKERS", 2))  # Processes running jobs (per bot process)
+JOB_MAX_PER_USER = 2  # Queued or running jobs a user may have at a time
+JOB_HISTORY = 10  # Finished jobs per user kept for /jobstatus
+JOB_MAX_LOOP_COUNT = 10_000_000  # Upper bound of the loop_count (simulations) of a job
+JOB_MAX_GRID_POINTS = 100_000  # Upper bound of the price intervals swept by a job
+JOB_MAX_QTY = 1000  # Upper bound of the max_qty of a job (one report column per quantity)
+JOB_CHUNK_SIZE = 1_000_000  # Simulations generated at a time (bounds the memory of a job)
+
+"""----- METRICS CONFIGURATION -----"""
+METRICS_PORT = int(os.getenv("TG_METRICS_PORT", 0))  # Port of the Prometheus /metrics endpoint (0 disables it)
+SLOW_HANDLER_THRESHOLD = 2  # Handlers taking longer than this (in seconds) are logged with their latency
+STARTUP_PROFILE = os.getenv("TG_STARTUP_PROFILE", "0") == "1"  # Log per module import and init times on startup
+
+
+assert TELEGRAM_BOT_TOKEN != "<or-hardcode-here>"
+assert EXECUTION_ENGINE in ("sync", "async", "multiprocess")
+assert EXECUTION_ENGINE != "multiprocess" or (BOT_MODE == "polling" and PROCESS_WORKERS > 0)
+assert BOT_MODE in ("polling", "webhook")
+assert BOT_MODE != "webhook" or WEBHOOK_SECRET_TOKEN, "TG_WEBHOOK_SECRET_TOKEN must be set in webhook mode"
+assert HANDLER_WORKERS > 0 and HANDLER_QUEUE_SIZE > 0
+assert HANDLER_OVERLOAD_POLICY in ("reply", "drop")
+assert JOB_WORKERS > 0 and JOB_MAX_PER_USER > 0
+assert BOT_MODE != "webhook" or WEBHOOK_URL is not None
\ No newline at end of file
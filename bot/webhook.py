@@ -0,0 +1,169 @@
+"""Embedded webhook receiver - an alternative to long polling for update ingestion"""
+
+import hmac
+import json
+import queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from typing import Optional
+
+from telebot.types import Update
+
+from .tg_config import (WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_QUEUE_SIZE,
+                        WEBHOOK_MAX_BODY_SIZE)
+from ._logger import logger
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Receives updates POSTed by Telegram and feeds them into the bot's existing handler dispatch.
+
+    Requests are validated against the secret token and their size, parsed and put on a bounded queue; a single
+    dispatcher thread drains the queue into bot.process_new_updates(). When the queue is full the receiver answers 503
+    so Telegram retries the delivery later instead of the process buffering without bound.
+    """
+
+    # Maximum number of queued updates handed to process_new_updates() at once
+    MAX_BATCH_SIZE = 100
+
+    def __init__(self, bot, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 max_body_size: int = WEBHOOK_MAX_BODY_SIZE):
+        """
+        :param bot: The TeleBot instance whose handlers process the updates
+        :param listen: Interface to bind the HTTP receiver to
+        :param port: Port to bind the HTTP receiver to
+        :param path: URL path updates are POSTed to
+        :param secret_token: Expected value of the X-Telegram-Bot-Api-Secret-Token header (None disables the check)
+        :param queue_size: Maximum number of received updates waiting to be dispatched
+        :param max_body_size: Requests with a larger Content-Length are rejected without reading their body
+        """
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self.updates: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.received = 0
+        self.rejected = 0  # Bad secret token / oversized or malformed body
+        self.dropped = 0  # Queue full
+        self._counter_lock = Lock()
+        self._dispatcher: Optional[Thread] = None
+        self._server_thread: Optional[Thread] = None
+        self._running = False
+        self.httpd = ThreadingHTTPServer((listen, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.handle_post(self)
+
+            def log_message(self, format, *args):
+                # Access logs would add console I/O to every update
+                pass
+
+        return RequestHandler
+
+    def _count(self, counter: str):
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def handle_post(self, request: BaseHTTPRequestHandler):
+        if request.path.split('?')[0] != self.path:
+            self._count('rejected')
+            return self._respond(request, 404)
+
+        if self.secret_token is not None and not hmac.compare_digest(
+                request.headers.get(SECRET_TOKEN_HEADER, ''), self.secret_token):
+            self._count('rejected')
+            return self._respond(request, 401)
+
+        try:
+            content_length = int(request.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = -1
+        if content_length < 0 or content_length > self.max_body_size:
+            self._count('rejected')
+            request.close_connection = True  # The unread body must not be parsed as the next request
+            return self._respond(request, 413 if content_length > 0 else 400)
+
+        try:
+            body = request.rfile.read(content_length)
+            update = Update.de_json(json.loads(body))
+        except Exception as exc:
+            logger.warning(f"Rejected malformed webhook update: {exc}")
+            self._count('rejected')
+            return self._respond(request, 400)
+
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            self._count('dropped')
+            return self._respond(request, 503)
+
+        self._count('received')
+        self._respond(request, 200)
+
+    @staticmethod
+    def _respond(request: BaseHTTPRequestHandler, status: int):
+        request.send_response(status)
+        request.send_header('Content-Length', '0')
+        request.end_headers()
+
+    def _dispatch(self):
+        # Keeps going after shutdown() until the queue is empty - Telegram was already told these updates arrived
+        while self._running or not self.updates.empty():
+            try:
+                batch = [self.updates.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.MAX_BATCH_SIZE:
+                try:
+                    batch.append(self.updates.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.bot.process_new_updates(batch)
+            except Exception as exc:
+                logger.exception('Could not process webhook updates', exc_info=exc)
+
+    def start(self):
+        """Starts the HTTP receiver and the dispatcher in background threads"""
+        self._running = True
+        self._dispatcher = Thread(target=self._dispatch, name="WebhookDispatcher", daemon=True)
+        self._dispatcher.start()
+        self._server_thread = Thread(target=self.httpd.serve_forever, name="WebhookServer", daemon=True)
+        self._server_thread.start()
+        logger.info(f"Webhook receiver listening on {self.httpd.server_address[0]}:{self.httpd.server_address[1]}"
+                    f"{self.path}")
+
+    def serve_forever(self):
+        """
+        Starts the receiver and blocks until it is shut down. Like TeleBot.polling, handler exceptions the bot's
+        exception_handler did not handle (e.g. RestartRequested raised by /restartbot) are re-raised here.
+        """
+        self.start()
+        worker_pool = self.bot.worker_pool
+        while self._server_thread.is_alive():
+            if worker_pool.exception_event.wait(0.5):
+                try:
+                    worker_pool.raise_exceptions()
+                finally:
+                    worker_pool.clear_exceptions()
+
+    def shutdown(self):
+        self._running = False
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+
+    def stats(self) -> dict:
+        """:return: Received/rejected/dropped counters and current queue depth"""
+        with self._counter_lock:
+            return {"received": self.received, "rejected": self.rejected, "dropped": self.dropped,
+                    "queue_depth": self.updates.qsize()}
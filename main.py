@@ -1,5 +1,25 @@
-from bot.telegram_bot import TelebotTemplate
+from bot.tg_config import EXECUTION_ENGINE, STARTUP_PROFILE
+from bot.startup_profile import startup_profiler
 
 if __name__ == "__main__":
-    telegram_bot = TelebotTemplate()
-    telegram_bot.run_bot()
+    if STARTUP_PROFILE:
+        startup_profiler.install()
+
+    if EXECUTION_ENGINE == "async":
+        import asyncio
+        with startup_profiler.phase("import bot.async_telegram_bot"):
+            from bot.async_telegram_bot import AsyncTelebotTemplate
+
+        asyncio.run(AsyncTelebotTemplate().run_bot())
+    elif EXECUTION_ENGINE == "multiprocess":
+        with startup_profiler.phase("import bot.supervisor"):
+            from bot.supervisor import Supervisor
+
+        Supervisor().run()
+    else:
+        with startup_profiler.phase("import bot.telegram_bot"):
+            from bot.telegram_bot import TelebotTemplate
+
+        with startup_profiler.phase("TelebotTemplate()"):
+            telegram_bot = TelebotTemplate()
+        telegram_bot.run_bot()
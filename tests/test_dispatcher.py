@@ -0,0 +1,174 @@
+import os
+import time
+import unittest
+from threading import Event, Lock
+from types import SimpleNamespace
+
+os.environ.setdefault("TG_BOT_TOKEN", "123456:test-token")
+
+from bot.dispatcher import ShardedDispatcher  # noqa: E402
+
+TIMEOUT = 5
+
+
+def update_from(user_id: int):
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id))
+
+
+class DispatcherTestCase(unittest.TestCase):
+    def make_dispatcher(self, **kwargs) -> ShardedDispatcher:
+        dispatcher = ShardedDispatcher(SimpleNamespace(exception_handler=None), **kwargs)
+        self.addCleanup(dispatcher.close)
+        return dispatcher
+
+    def block_shard(self, dispatcher: ShardedDispatcher, user_id: int) -> Event:
+        """Occupies the worker of the user's shard until the returned event is set"""
+        started, release = Event(), Event()
+        self.addCleanup(release.set)
+        dispatcher.put(lambda update: (started.set(), release.wait(TIMEOUT)), update_from(user_id))
+        self.assertTrue(started.wait(TIMEOUT))
+        return release
+
+
+class TestOrdering(DispatcherTestCase):
+    def test_updates_of_a_user_run_in_order(self):
+        dispatcher = self.make_dispatcher(workers=3, queue_size=100)
+        handled, lock = {user_id: [] for user_id in range(6)}, Lock()
+
+        def handle(update, number):
+            with lock:
+                handled[update.from_user.id].append(number)
+
+        for number in range(50):
+            for user_id in handled:
+                dispatcher.put(handle, update_from(user_id), number)
+
+        self.assertTrue(dispatcher.drain(TIMEOUT))
+        for user_id, numbers in handled.items():
+            self.assertEqual(numbers, list(range(50)), f"user {user_id}")
+
+    def test_users_are_sharded_by_id(self):
+        dispatcher = self.make_dispatcher(workers=4, key_stride=2)
+        self.assertEqual(dispatcher.shard(update_from(3)), dispatcher.shard(update_from(3)))
+        self.assertEqual(dispatcher.shard(update_from(2)), 1)
+        self.assertEqual(dispatcher.shard(update_from(8)), 0)
+        self.assertEqual(dispatcher.shard(SimpleNamespace(chat=SimpleNamespace(id=6))), 3)
+
+    def test_unhandled_exceptions_are_raised_on_the_caller(self):
+        dispatcher = self.make_dispatcher(workers=1)
+        dispatcher.put(lambda update: 1 / 0, update_from(1))
+        self.assertTrue(dispatcher.drain(TIMEOUT))
+        self.assertRaises(ZeroDivisionError, dispatcher.raise_exceptions)
+        dispatcher.clear_exceptions()
+        self.assertFalse(dispatcher.exception_event.is_set())
+
+
+class TestOverflow(DispatcherTestCase):
+    def test_full_shard_drops_and_answers_each_user_once(self):
+        answered, all_answered = [], Event()
+
+        def on_overload(update):
+            answered.append(update.from_user.id)
+            if len(answered) == 2:
+                all_answered.set()
+
+        dispatcher = self.make_dispatcher(workers=1, queue_size=1, on_overload=on_overload)
+        release = self.block_shard(dispatcher, user_id=1)
+        handled = []
+        dispatcher.put(handled.append, update_from(1))  # Queued
+        for user_id in (1, 1, 2, 1, 2):
+            dispatcher.put(handled.append, update_from(user_id))  # Rejected
+
+        self.assertTrue(all_answered.wait(TIMEOUT))
+        release.set()
+        self.assertTrue(dispatcher.drain(TIMEOUT))
+        dispatcher.close()  # Joins the OverloadReplies thread, which counts a reply once on_overload returned
+        self.assertEqual([update.from_user.id for update in handled], [1])
+        self.assertEqual(sorted(answered), [1, 2])
+        stats = dispatcher.stats()
+        self.assertEqual(stats["dropped"], 5)
+        self.assertEqual(stats["overload_replies"], 2)
+        self.assertEqual(stats["overload_replies_skipped"], 3)
+        self.assertEqual(stats["shard_0_max_queue_depth"], 1)
+
+    def test_user_is_answered_again_after_the_interval(self):
+        answered, all_answered = [], Event()
+
+        def on_overload(update):
+            answered.append(update.from_user.id)
+            if len(answered) == 2:
+                all_answered.set()
+
+        dispatcher = self.make_dispatcher(workers=1, queue_size=1, on_overload=on_overload,
+                                          overload_reply_interval=0)
+        release = self.block_shard(dispatcher, user_id=1)
+        for _ in range(3):
+            dispatcher.put(lambda update: None, update_from(1))
+
+        self.assertTrue(all_answered.wait(TIMEOUT))
+        self.assertEqual(answered, [1, 1])
+        self.assertEqual(dispatcher.stats()["overload_replies_skipped"], 0)
+
+    def test_drop_policy_does_not_answer(self):
+        answered = []
+        dispatcher = self.make_dispatcher(workers=1, queue_size=1, overload_policy="drop",
+                                          on_overload=answered.append)
+        release = self.block_shard(dispatcher, user_id=1)
+        dispatcher.put(lambda update: None, update_from(1))
+        dispatcher.put(lambda update: None, update_from(1))
+        release.set()
+        self.assertTrue(dispatcher.drain(TIMEOUT))
+        dispatcher.close()
+        self.assertEqual(dispatcher.stats()["dropped"], 1)
+        self.assertEqual(answered, [])
+
+
+class TestCompletedWatermark(DispatcherTestCase):
+    def test_watermark_waits_for_the_oldest_unfinished_task(self):
+        dispatcher = self.make_dispatcher(workers=2)
+        self.assertEqual(dispatcher.completed_watermark(), 0)
+        release = self.block_shard(dispatcher, user_id=0)  # Task 1
+        dispatcher.put(lambda update: None, update_from(1))  # Task 2, on the other shard
+        dispatcher.put(lambda update: None, update_from(3))  # Task 3
+
+        # Tasks 2 and 3 finish, but task 1 still runs - a restart has to hand it out again
+        self.assertTrue(self.wait_for(lambda: dispatcher.stats()["shard_1_processed"] == 2))
+        self.assertEqual(dispatcher.completed_watermark(), 0)
+
+        release.set()
+        self.assertTrue(dispatcher.drain(TIMEOUT))
+        self.assertEqual(dispatcher.completed_watermark(), 3)
+
+    def test_dropped_tasks_do_not_hold_the_watermark_back(self):
+        dispatcher = self.make_dispatcher(workers=1, queue_size=1, overload_policy="drop")
+        release = self.block_shard(dispatcher, user_id=1)  # Task 1
+        dispatcher.put(lambda update: None, update_from(1))  # Task 2
+        dispatcher.put(lambda update: None, update_from(1))  # Task 3, dropped
+        self.assertEqual(dispatcher.completed_watermark(), 0)
+
+        release.set()
+        self.assertTrue(dispatcher.drain(TIMEOUT))
+        self.assertEqual(dispatcher.completed_watermark(), 3)
+
+    def test_task_done_callback_sees_its_task_completed(self):
+        watermarks = []
+        dispatcher = self.make_dispatcher(workers=1)
+        dispatcher.on_task_done = lambda: watermarks.append(dispatcher.completed_watermark())
+        for _ in range(3):
+            dispatcher.put(lambda update: None, update_from(1))
+        self.assertTrue(dispatcher.drain(TIMEOUT))
+        self.assertTrue(self.wait_for(lambda: len(watermarks) == 3))
+        self.assertEqual(watermarks, [1, 2, 3])
+
+    @staticmethod
+    def wait_for(condition) -> bool:
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("TG_BOT_TOKEN", "123456:test-token")
+
+from bot.restart import Backoff, AlertCoalescer  # noqa: E402
+
+
+class TestBackoff(unittest.TestCase):
+    def setUp(self):
+        # The upper end of the jitter range, so the delays are exact
+        patcher = mock.patch("bot.restart.random.uniform", side_effect=lambda low, high: high)
+        self.uniform = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_delay_doubles_up_to_the_maximum(self):
+        backoff = Backoff(base=5, maximum=60, reset_after=100)
+        self.assertEqual([backoff.next_delay(uptime=1) for _ in range(6)], [5, 10, 20, 40, 60, 60])
+
+    def test_delay_is_jittered_between_half_and_all_of_it(self):
+        backoff = Backoff(base=5, maximum=60, reset_after=100)
+        backoff.next_delay()
+        backoff.next_delay()
+        self.uniform.assert_called_with(5, 10)
+
+    def test_long_uptime_starts_over(self):
+        backoff = Backoff(base=5, maximum=60, reset_after=100)
+        for _ in range(3):
+            backoff.next_delay(uptime=1)
+        self.assertEqual(backoff.next_delay(uptime=99), 40)
+        self.assertEqual(backoff.next_delay(uptime=100), 5)
+        self.assertEqual(backoff.next_delay(), 10)
+
+    def test_reset(self):
+        backoff = Backoff(base=5, maximum=60, reset_after=100)
+        backoff.next_delay()
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(), 5)
+
+
+class TestAlertCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("bot.restart.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sent = []
+        self.alerts = AlertCoalescer(self.sent.append, window=60)
+        self.addCleanup(self.alerts.flush)  # Cancels the summary timer
+
+    def test_first_alert_is_sent_right_away(self):
+        self.alerts.alert("crash 1")
+        self.assertEqual(self.sent, ["crash 1"])
+        self.assertEqual(self.alerts.stats(), {"sent": 1, "suppressed": 0, "pending": 0})
+
+    def test_alerts_within_the_window_are_summarized(self):
+        self.alerts.alert("crash 1")
+        self.now += 10
+        self.alerts.alert("crash 2")
+        self.alerts.alert("crash 3")
+        self.assertEqual(self.sent, ["crash 1"])
+        self.assertEqual(self.alerts.stats(), {"sent": 1, "suppressed": 2, "pending": 2})
+
+        self.alerts.flush()
+        self.assertEqual(self.sent[1:], ["2 more alert(s) in the last 60 seconds, most recent:\ncrash 3"])
+        self.assertEqual(self.alerts.stats(), {"sent": 2, "suppressed": 2, "pending": 0})
+
+    def test_summary_is_scheduled_for_the_end_of_the_window(self):
+        self.alerts.alert("crash 1")
+        self.now += 10
+        self.alerts.alert("crash 2")
+        self.assertIsNotNone(self.alerts._timer)
+        self.assertEqual(self.alerts._timer.interval, 50)
+
+    def test_alert_after_the_window_is_sent_right_away(self):
+        self.alerts.alert("crash 1")
+        self.now += 60
+        self.alerts.alert("crash 2")
+        self.assertEqual(self.sent, ["crash 1", "crash 2"])
+
+    def test_flush_without_suppressed_alerts_sends_nothing(self):
+        self.alerts.alert("crash 1")
+        self.alerts.flush()
+        self.assertEqual(self.sent, ["crash 1"])
+
+    def test_failing_send_is_logged(self):
+        alerts = AlertCoalescer(mock.Mock(side_effect=ConnectionError), window=60)
+        with mock.patch("bot.restart.logger") as logger:
+            alerts.alert("crash 1")
+        logger.exception.assert_called_once()
+        self.assertEqual(alerts.stats()["sent"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()